@@ -0,0 +1,214 @@
+import math
+import time
+import asyncio
+import logging
+import collections
+
+from aiohttp import web
+
+from webapp import async_orm, json_codec, metrics
+from webapp.api_error import APIBusyError, APIRateLimitError
+from webapp.cache import LRUCache
+
+__author__ = 'Adam Lee'
+
+'''准入控制：数据库变慢时，请求在有界的队列里等待，超出预算的直接返回503 + Retry-After，
+而不是在连接池上无限堆积。
+
+每个路由有自己的并发数和等待队列，默认值来自它的优先级：
+	critical  登录、注册、静态文件，限额宽，不因连接池等待而拒绝
+	default   其他路由
+	heavy     列表等重的路由，限额窄，连接池最近的等待超过预算时最先被拒绝
+/api/login、/api/register另外按客户端做令牌桶限流，超出时返回429。
+'''
+
+
+class Limiter:
+	'''Concurrency limit with a bounded FIFO wait queue.
+	'''
+
+	def __init__(self, concurrency, queue, queue_timeout):
+		self.concurrency = concurrency
+		self.queue = queue
+		self.queue_timeout = queue_timeout
+		self.active = 0
+		self._waiters = collections.deque()
+
+	@property
+	def waiting(self):
+		return len(self._waiters)
+
+	async def acquire(self):
+		'''Return None once a slot is held, otherwise why not: 'queue_full' or 'queue_timeout'.
+		'''
+		if self.active < self.concurrency and not self._waiters:
+			self.active += 1
+			return None
+		if len(self._waiters) >= self.queue:
+			return 'queue_full'
+		waiter = asyncio.get_running_loop().create_future()
+		self._waiters.append(waiter)
+		try:
+			await asyncio.wait_for(waiter, self.queue_timeout)
+			return None
+		except asyncio.TimeoutError:
+			# 超时的同时release()已经把名额交给了它(3.12起wait_for可能这样返回)：名额归这个请求
+			if waiter.done() and not waiter.cancelled():
+				return None
+			self._discard(waiter)
+			return 'queue_timeout'
+		except asyncio.CancelledError:
+			# 已经把名额交给了这个请求，它却被取消了：还回去
+			if waiter.done() and not waiter.cancelled():
+				self.release()
+			else:
+				self._discard(waiter)
+			raise
+
+	# 名额直接交给排在最前面的等待者，active不变
+	def release(self):
+		while self._waiters:
+			waiter = self._waiters.popleft()
+			if not waiter.done():
+				waiter.set_result(None)
+				return
+		self.active -= 1
+
+	def _discard(self, waiter):
+		try:
+			self._waiters.remove(waiter)
+		except ValueError:
+			pass
+
+
+class TokenBucket:
+	'''Per-client token buckets: rate tokens per second, at most burst saved up.
+	'''
+
+	def __init__(self, rate, burst, max_clients=10000):
+		self.rate = rate
+		self.burst = burst
+		self._buckets = LRUCache(maxsize=max_clients)
+
+	def take(self, client):
+		'''Take a token; return 0 when allowed, otherwise seconds until the next token.
+		'''
+		now = time.monotonic()
+		bucket = self._buckets.get(client, count=False)
+		if bucket is None:
+			tokens = self.burst
+		else:
+			tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+		if tokens < 1:
+			self._buckets.set(client, (tokens, now))
+			return (1 - tokens) / self.rate
+		self._buckets.set(client, (tokens - 1, now))
+		return 0
+
+
+class Route:
+	def __init__(self, name, priority, concurrency, queue, queue_timeout, pool_wait_budget=None, rate_limit=None):
+		self.name = name
+		self.priority = priority
+		self.limiter = Limiter(concurrency, queue, queue_timeout)
+		self.pool_wait_budget = pool_wait_budget
+		self.rate_limit = rate_limit
+		self.admitted = 0
+		self.rejected = collections.Counter()  # 原因 -> 次数
+		self.queue_wait = metrics.Histogram()
+
+
+class AdmissionController:
+	'''Admit, queue or shed requests per route; see the module docstring.
+	'''
+
+	def __init__(self, classes, routes=None, rate_limits=None, retry_after=1, max_clients=10000, trust_forwarded=False):
+		self.classes = classes
+		self.route_options = routes or {}
+		self.rate_limits = {path: TokenBucket(max_clients=max_clients, **options) for path, options in (rate_limits or {}).items()}
+		self.retry_after = retry_after
+		self.trust_forwarded = trust_forwarded
+		self.routes = {}
+
+	def route_of(self, request):
+		resource = request.match_info.route.resource
+		name = resource.canonical if resource is not None else '<unmatched>'
+		route = self.routes.get(name)
+		if route is None:
+			options = dict(self.route_options.get(name) or {})
+			if 'priority' not in options:
+				options['priority'] = 'critical' if getattr(request.match_info.handler, '__static__', False) else 'default'
+			options = dict(self.classes[options['priority']], **options)
+			route = self.routes[name] = Route(name, rate_limit=self.rate_limits.get(name), **options)
+		return route
+
+	def client_of(self, request):
+		if self.trust_forwarded:
+			forwarded = request.headers.get('X-Forwarded-For')
+			if forwarded:
+				return forwarded.split(',')[0].strip()
+		return request.remote
+
+	def _reject(self, route, reason, status, error, retry_after):
+		route.rejected[reason] += 1
+		logging.debug('shed %s (%s): %s', route.name, route.priority, reason)
+		body = json_codec.dumps(dict(error=error.error, data=error.data, message=error.message))
+		return web.Response(status=status, body=body, content_type='application/json',
+							headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+	async def __call__(self, request, handler):
+		route = self.route_of(request)
+		if route.rate_limit is not None:
+			wait = route.rate_limit.take(self.client_of(request))
+			if wait:
+				return self._reject(route, 'rate', 429, APIRateLimitError('Too many requests, please retry later.'), wait)
+		if route.pool_wait_budget is not None and async_orm.recent_wait() > route.pool_wait_budget:
+			return self._reject(route, 'pool', 503, APIBusyError('Server is busy, please retry later.'), self.retry_after)
+		start = time.perf_counter()
+		reason = await route.limiter.acquire()
+		if reason is not None:
+			return self._reject(route, reason, 503, APIBusyError('Server is busy, please retry later.'), self.retry_after)
+		route.queue_wait.observe(time.perf_counter() - start)
+		route.admitted += 1
+		try:
+			return await handler(request)
+		finally:
+			route.limiter.release()
+
+	def stats(self):
+		return {name: dict(
+			priority=route.priority,
+			active=route.limiter.active,
+			waiting=route.limiter.waiting,
+			admitted=route.admitted,
+			rejected=dict(route.rejected),
+			queue_wait=route.queue_wait.stats()
+		) for name, route in self.routes.items()}
+
+
+controller = None
+
+
+# 根据configs.admission创建controller，enabled为False时不限制
+def setup(enabled=True, classes=None, routes=None, rate_limits=None, retry_after=1, max_clients=10000, trust_forwarded=False):
+	global controller
+	controller = None
+	if enabled:
+		controller = AdmissionController(classes, routes, rate_limits, retry_after, max_clients, trust_forwarded)
+	return controller
+
+
+@metrics.register_collector
+def _collect():
+	if controller is None:
+		return []
+	lines = []
+	for name, route in controller.routes.items():
+		label = 'route="%s",priority="%s"' % (name, route.priority)
+		lines.append('admission_active{%s} %d' % (label, route.limiter.active))
+		lines.append('admission_waiting{%s} %d' % (label, route.limiter.waiting))
+		lines.append('admission_admitted_total{%s} %d' % (label, route.admitted))
+		for reason, n in route.rejected.items():
+			lines.append('admission_rejected_total{%s,reason="%s"} %d' % (label, reason, n))
+		lines.extend(route.queue_wait.samples('admission_queue_wait_seconds', label))
+	return lines
@@ -1,6 +1,3 @@
-import logging
-
-logging.basicConfig(level=logging.INFO)
 __author__ = 'Adam Lee'
 
 
@@ -28,3 +25,29 @@ class APIValueError(APIError):
 	def __init__(self, field, message=''):
 		super().__init__('value:invalid', field, message)
 
+
+class APIPermissionError(APIError):
+	'''
+	    Indicate the api has no permission.
+	'''
+
+	def __init__(self, message=''):
+		super().__init__('permission:forbidden', 'permission', message)
+
+
+class APIBusyError(APIError):
+	'''
+	    Indicate the server is overloaded and the request can be retried later.
+	'''
+
+	def __init__(self, message=''):
+		super().__init__('server:busy', '', message)
+
+
+class APIRateLimitError(APIError):
+	'''
+	    Indicate the client sent too many requests and should retry later.
+	'''
+
+	def __init__(self, message=''):
+		super().__init__('server:rate_limited', '', message)
@@ -1,27 +1,77 @@
+import re
+import time
+import asyncio
 import logging
+import weakref
+import collections
+import functools
+import contextlib
+import contextvars
 import aiomysql
 
+from webapp import metrics, sql_profiler
+from webapp.cache import LRUCache
+from webapp.logs import sql_log
+from webapp.query_cache import query_cache
+
 __author__ = 'Adam Lee'
 
 '''ORM操作数据库
 '''
 
-logging.basicConfig(level=logging.INFO)
 
 
 # 统一调用的log方法
 def log(sql):
-	logging.info('SQL：{}'.format(sql))
+	sql_log.info('SQL：%s', sql)
 
 
 __pool = None
+# 所有命名的连接池：'primary'以及各个从库
+__pools = {}
 
 
-# 异步IO接连mysql
-async def create_pool(loop, **kw):
-	logging.info('create database connection pool...')
-	global __pool
-	__pool = await aiomysql.create_pool(
+# 把?占位符换成驱动的%s，同样的语句只转换一次
+@functools.lru_cache(maxsize=1024)
+def driver_sql(sql):
+	return sql.replace('?', '%s')
+
+
+# 记录findAll/findNumber的语句（每种形状一份参数样本），供schema_tool做EXPLAIN
+_captured = None
+
+
+def capture_queries(enabled=True, limit=500):
+	global _captured
+	_captured = LRUCache(maxsize=limit) if enabled else None
+
+
+def captured_queries():
+	return [] if _captured is None else [[sql, args] for sql, args in _captured.items()]
+
+
+def _capture(sql, args):
+	if _captured is not None and sql not in _captured:
+		_captured.set(sql, list(args or ()))
+
+
+# Model动态拼出的SELECT语句：(model, where, orderBy, limit形状) -> sql
+_compiled = LRUCache(maxsize=1024)
+
+
+def query_stats():
+	'''Size and reuse counters of the compiled-query and driver-SQL caches.
+	'''
+	info = driver_sql.cache_info()
+	compiled = _compiled.stats()
+	return dict(
+		compiled=dict(size=compiled['size'], maxsize=compiled['maxsize'], reused=compiled['hits'], built=compiled['misses']),
+		driver_sql=dict(size=info.currsize, maxsize=info.maxsize, reused=info.hits, built=info.misses)
+	)
+
+
+async def _open_pool(loop, kw):
+	return await aiomysql.create_pool(
 		loop=loop,
 		host=kw.get('host', 'localhost'),
 		port=kw.get('port', 3306),
@@ -35,49 +85,604 @@ async def create_pool(loop, **kw):
 	)
 
 
+# 连接检查的选项，create_pool时从配置读取
+_lifetime = dict(max_lifetime=None, pre_ping_idle=None)
+
+
+# 异步IO接连mysql
+# kw为主库配置，kw['replicas']为只读从库列表，每项覆盖主库配置中的host/port等
+async def create_pool(loop, **kw):
+	logging.info('create database connection pool...')
+	global __pool
+	__pool = await _open_pool(loop, kw)
+	__pools['primary'] = __pool
+	for i, override in enumerate(kw.get('replicas') or []):
+		name = override.get('name', 'replica%d' % i)
+		options = dict(kw)
+		options.update(override)
+		logging.info('create replica connection pool {} ({}:{})...'.format(name, options.get('host', 'localhost'), options.get('port', 3306)))
+		__pools[name] = await _open_pool(loop, options)
+		_router.replicas.append(_Replica(name, __pools[name]))
+	_router.configure(
+		balance=kw.get('balance', 'round_robin'),
+		read_your_writes=kw.get('read_your_writes', 1.0),
+		health_check_interval=kw.get('health_check_interval', 5.0)
+	)
+	if _router.replicas:
+		_router.start()
+	_lifetime['max_lifetime'] = kw.get('max_lifetime')
+	_lifetime['pre_ping_idle'] = kw.get('pre_ping_idle')
+	adaptive = kw.get('adaptive') or {}
+	if adaptive.get('enabled'):
+		_tuner.configure(**{k: v for k, v in adaptive.items() if k != 'enabled'})
+		_tuner.start()
+
+
 # 销毁连接池
 async def destroy_pool():
 	global __pool
-	if __pool is not None:
-		__pool.close()
-		await __pool.wait_closed()
+	await _router.stop()
+	await _tuner.stop()
+	for pool in __pools.values():
+		pool.close()
+		await pool.wait_closed()
+	__pools.clear()
+	__pool = None
+
+
+def _named_pools():
+	return list(__pools.items())
+
+
+def get_pool(name='primary'):
+	return __pools[name]
+
+
+def pool_names():
+	return list(__pools)
+
+
+class _Replica:
+	def __init__(self, name, pool):
+		self.name = name
+		self.pool = pool
+		self.healthy = True
+		self.reads = 0
+
+	def in_use(self):
+		return self.pool.size - self.pool.freesize
+
+
+# 读写分离：读请求分发到健康的从库，写请求、事务以及写后的一段时间内的读走主库
+class _ReplicaRouter:
+	def __init__(self):
+		self.replicas = []
+		self.balance = 'round_robin'
+		self.read_your_writes = 1.0
+		self.health_check_interval = 5.0
+		self.fallbacks = 0
+		self._next = 0
+		self._task = None
+
+	def configure(self, balance, read_your_writes, health_check_interval):
+		if balance not in ('round_robin', 'least_busy'):
+			raise ValueError('Invalid balance: {}'.format(balance))
+		self.balance = balance
+		self.read_your_writes = read_your_writes
+		self.health_check_interval = health_check_interval
+
+	def pick(self):
+		'''Return a healthy replica or None when reads must go to the primary.
+		'''
+		healthy = [r for r in self.replicas if r.healthy]
+		if not healthy:
+			if self.replicas:
+				self.fallbacks += 1
+			return None
+		if self.balance == 'least_busy':
+			replica = min(healthy, key=_Replica.in_use)
+		else:
+			replica = healthy[self._next % len(healthy)]
+			self._next += 1
+		replica.reads += 1
+		return replica
+
+	async def check(self, replica):
+		try:
+			async with replica.pool.acquire() as conn:
+				await conn.ping(reconnect=True)
+			if not replica.healthy:
+				logging.info('replica {} is back'.format(replica.name))
+			replica.healthy = True
+		except Exception as e:
+			self.mark_down(replica, e)
+
+	def mark_down(self, replica, error):
+		if replica.healthy:
+			logging.warning('replica {} is down: {}'.format(replica.name, error))
+		replica.healthy = False
+
+	async def _health_loop(self):
+		while True:
+			await asyncio.sleep(self.health_check_interval)
+			for replica in self.replicas:
+				await self.check(replica)
+
+	def start(self):
+		if self._task is None:
+			self._task = asyncio.ensure_future(self._health_loop())
+
+	async def stop(self):
+		if self._task is not None:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+		self.replicas = []
+
+	def stats(self):
+		return dict(
+			balance=self.balance,
+			fallbacks=self.fallbacks,
+			replicas=[dict(name=r.name, healthy=r.healthy, reads=r.reads, in_use=r.in_use()) for r in self.replicas]
+		)
+
+
+_router = _ReplicaRouter()
+
+# 当前请求最后一次写库的时间，read_your_writes秒内的读仍然走主库
+_last_write = contextvars.ContextVar('async_orm_last_write', default=0.0)
+# read_primary()之内的读都走主库，也不使用查询缓存
+_primary_only = contextvars.ContextVar('async_orm_primary_only', default=False)
+
+
+# 不能接受从库延迟的读(例如鉴权)：with read_primary(): ...
+@contextlib.contextmanager
+def read_primary():
+	token = _primary_only.set(True)
+	try:
+		yield
+	finally:
+		_primary_only.reset(token)
+
+
+def replica_stats():
+	return _router.stats()
+
+
+# 自适应连接池大小需要改变aiomysql.Pool的maxsize，aiomysql没有公开的接口。
+# 对Pool内部的访问只在下面两个函数里，并且只在验证过的aiomysql版本上启用：
+#   Pool.maxsize读的是空闲连接deque(_free)的maxlen，换一个maxlen为新大小的deque就是调整大小；
+#   Pool._wakeup()通知等待连接的协程。
+# 升级aiomysql时确认这些仍然成立后，再把新版本加进_TESTED_AIOMYSQL
+_TESTED_AIOMYSQL = ('0.1', '0.2', '0.3')
+
+
+def _resizable(pool):
+	version = '.'.join(aiomysql.__version__.split('.')[:2])
+	return version in _TESTED_AIOMYSQL and isinstance(getattr(pool, '_free', None), collections.deque) and hasattr(pool, '_wakeup')
+
+
+# 调整maxsize；缩小时先关掉一个空闲连接，保证空闲和借出的连接数不超过新的maxsize
+def _resize(pool, maxsize):
+	grow = maxsize > pool.maxsize
+	if not grow and pool.size > maxsize and pool._free:
+		pool._free.pop().close()
+	pool._free = collections.deque(pool._free, maxlen=maxsize)
+	if grow:
+		asyncio.ensure_future(pool._wakeup())
+
+
+# 按最近的等待时间在[min, max]之间增减maxsize
+class _PoolTuner:
+	def __init__(self):
+		self.min = 1
+		self.max = 20
+		self.grow_wait = 0.02
+		self.shrink_wait = 0.001
+		self.interval = 5.0
+		self._task = None
+		self._unsupported = set()
+
+	def configure(self, min=1, max=20, grow_wait=0.02, shrink_wait=0.001, interval=5.0):
+		self.min = min
+		self.max = max
+		self.grow_wait = grow_wait
+		self.shrink_wait = shrink_wait
+		self.interval = interval
+
+	def adjust(self, name, pool):
+		if not _resizable(pool):
+			if name not in self._unsupported:
+				self._unsupported.add(name)
+				logging.warning('adaptive pool sizing is not supported with aiomysql {}, pool {} keeps maxsize {}'.format(
+					aiomysql.__version__, name, pool.maxsize))
+			return
+		wait = _stats_of(name).take_interval()
+		maxsize = pool.maxsize
+		if wait > self.grow_wait and maxsize < self.max:
+			_resize(pool, maxsize + 1)
+			logging.info('grow pool {} to {} (avg wait {:.1f}ms)'.format(name, maxsize + 1, wait * 1000))
+		elif wait < self.shrink_wait and maxsize > max(self.min, pool.minsize) and pool.freesize > 0:
+			_resize(pool, maxsize - 1)
+			logging.info('shrink pool {} to {}'.format(name, maxsize - 1))
+
+	async def _loop(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			for name, pool in _named_pools():
+				try:
+					self.adjust(name, pool)
+				except Exception as e:
+					logging.exception('adjust pool {} failed: {}'.format(name, e))
+
+	def start(self):
+		if self._task is None:
+			self._task = asyncio.ensure_future(self._loop())
+
+	async def stop(self):
+		if self._task is not None:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+
+
+_tuner = _PoolTuner()
+
+
+def pool_stats():
+	'''Per-pool size/in-use/idle counts with checkout wait histograms, and query latency histograms.
+	'''
+	pools = {}
+	for name, pool in __pools.items():
+		stats = _stats_of(name)
+		pools[name] = dict(
+			size=pool.size,
+			maxsize=pool.maxsize,
+			in_use=pool.size - pool.freesize,
+			idle=pool.freesize,
+			checkouts=stats.checkouts,
+			recycled=stats.recycled,
+			ping_failures=stats.ping_failures,
+			recent_wait=stats.recent_wait.value,
+			wait=stats.wait.stats()
+		)
+	return dict(pools=pools, queries={kind: h.stats() for kind, h in _query_latency.items()})
+
+
+def recent_wait(name='primary', half_life=1.0):
+	'''Recent connection checkout wait (EWMA, seconds) of a pool.
+
+	The average only moves on checkouts, so it decays while none happen; otherwise
+	a pool nobody is allowed to use would look congested forever.
+	'''
+	stats = _pool_stats.get(name)
+	if stats is None:
+		return 0.0
+	idle = time.monotonic() - stats.last_checkout
+	return stats.recent_wait.value * 0.5 ** (idle / half_life)
+
+
+@metrics.register_collector
+def _collect():
+	lines = []
+	for name, pool in __pools.items():
+		stats = _stats_of(name)
+		label = 'pool="%s"' % name
+		lines.append('db_pool_size{%s} %d' % (label, pool.size))
+		lines.append('db_pool_maxsize{%s} %d' % (label, pool.maxsize))
+		lines.append('db_pool_in_use{%s} %d' % (label, pool.size - pool.freesize))
+		lines.append('db_pool_idle{%s} %d' % (label, pool.freesize))
+		lines.append('db_pool_recycled_total{%s} %d' % (label, stats.recycled))
+		lines.append('db_pool_ping_failures_total{%s} %d' % (label, stats.ping_failures))
+		lines.extend(stats.wait.samples('db_pool_wait_seconds', label))
+	for kind, h in _query_latency.items():
+		lines.extend(h.samples('db_query_seconds', 'kind="%s"' % kind))
+	return lines
+
+
+# 当前上下文中事务占用的连接，select/execute优先使用它
+_tx_state = contextvars.ContextVar('async_orm_transaction', default=None)
+
+
+class _TransactionState:
+	def __init__(self, conn):
+		self.conn = conn
+		self.depth = 0
+		self.tables = set()  # 事务中写过的表，结束时再次使查询缓存失效
+
+
+# 每个连接池的指标：借出连接的等待时间、回收和预检失败次数
+class _PoolStats:
+	def __init__(self):
+		self.wait = metrics.Histogram()
+		self.recent_wait = metrics.EWMA()
+		self.checkouts = 0
+		self.recycled = 0
+		self.ping_failures = 0
+		self.interval_wait = 0.0
+		self.interval_checkouts = 0
+		self.last_checkout = 0.0
+
+	def observe_wait(self, seconds):
+		self.wait.observe(seconds)
+		self.recent_wait.update(seconds)
+		self.last_checkout = time.monotonic()
+		self.checkouts += 1
+		self.interval_wait += seconds
+		self.interval_checkouts += 1
+
+	def take_interval(self):
+		'''Average wait since the last call, 0 when nothing was checked out.
+		'''
+		avg = (self.interval_wait / self.interval_checkouts) if self.interval_checkouts else 0.0
+		self.interval_wait = 0.0
+		self.interval_checkouts = 0
+		return avg
+
+
+_pool_stats = {}
+_query_latency = dict(select=metrics.Histogram(), execute=metrics.Histogram())
+# 连接第一次被借出的时间，用于max_lifetime
+_born = weakref.WeakKeyDictionary()
+
+
+def _stats_of(name):
+	stats = _pool_stats.get(name)
+	if stats is None:
+		stats = _pool_stats[name] = _PoolStats()
+	return stats
+
+
+# 连接是否可以使用：超过max_lifetime的回收，空闲太久的先ping一下
+async def _usable(conn, stats):
+	now = time.monotonic()
+	max_lifetime = _lifetime['max_lifetime']
+	if max_lifetime and now - _born.setdefault(conn, now) > max_lifetime:
+		stats.recycled += 1
+		return False
+	pre_ping_idle = _lifetime['pre_ping_idle']
+	last_usage = getattr(conn, 'last_usage', None)
+	if pre_ping_idle and last_usage is not None and asyncio.get_event_loop().time() - last_usage > pre_ping_idle:
+		try:
+			await conn.ping(reconnect=False)
+		except Exception as e:
+			logging.info('drop stale connection: {}'.format(e))
+			stats.ping_failures += 1
+			return False
+	return True
+
+
+# 从连接池借出连接并记录等待时间
+async def _checkout(name, pool):
+	stats = _stats_of(name)
+	start = time.monotonic()
+	attempts = 0
+	while True:
+		conn = await pool.acquire()
+		attempts += 1
+		if attempts > pool.maxsize or await _usable(conn, stats):
+			break
+		conn.close()
+		pool.release(conn)
+	stats.observe_wait(time.monotonic() - start)
+	return conn
+
+
+async def _acquire():
+	global __pool
+	return await _checkout('primary', __pool)
+
+
+def _release(conn):
+	global __pool
+	__pool.release(conn)
+
+
+def _read_replica():
+	if not _router.replicas or _tx_state.get() is not None or _primary_only.get():
+		return None
+	if time.monotonic() - _last_write.get() < _router.read_your_writes:
+		return None
+	return _router.pick()
+
+
+# 取得连接：在事务内复用事务的连接，否则从连接池借出并在结束后归还
+# readonly的语句可以分发到从库
+@contextlib.asynccontextmanager
+async def _connection(readonly=False):
+	state = _tx_state.get()
+	if state is not None:
+		yield state.conn
+		return
+	replica = _read_replica() if readonly else None
+	if replica is not None:
+		try:
+			conn = await _checkout(replica.name, replica.pool)
+		except Exception as e:
+			_router.mark_down(replica, e)
+			replica = None
+	if replica is None:
+		conn = await _acquire()
+	try:
+		yield conn
+	finally:
+		if replica is None:
+			_release(conn)
+		else:
+			replica.pool.release(conn)
+
+
+# 事务
+class Transaction:
+	'''async with transaction() as tx: every select/execute inside runs on tx.conn.
+
+	Nested blocks become savepoints; the outermost block commits or rolls back
+	and returns the connection to the pool.
+	'''
+
+	def __init__(self):
+		self.conn = None
+		self._state = None
+		self._token = None
+		self._savepoint = None
+
+	async def _run(self, sql):
+		async with self.conn.cursor() as cursor:
+			await cursor.execute(sql)
+
+	async def __aenter__(self):
+		state = _tx_state.get()
+		if state is None:
+			state = _TransactionState(await _acquire())
+			try:
+				await state.conn.begin()
+			except BaseException:
+				_release(state.conn)
+				raise
+			self._token = _tx_state.set(state)
+		else:
+			state.depth += 1
+			self._savepoint = 'sp_%d' % state.depth
+		self._state = state
+		self.conn = state.conn
+		if self._savepoint:
+			try:
+				await self._run('savepoint %s' % self._savepoint)
+			except BaseException:
+				state.depth -= 1
+				raise
+		return self
+
+	async def __aexit__(self, exc_type, exc, tb):
+		state = self._state
+		if self._savepoint:
+			state.depth -= 1
+			if exc_type is None:
+				await self._run('release savepoint %s' % self._savepoint)
+			else:
+				await self._run('rollback to savepoint %s' % self._savepoint)
+			return False
+		_tx_state.reset(self._token)
+		try:
+			if exc_type is None:
+				await self.conn.commit()
+			else:
+				await self.conn.rollback()
+		finally:
+			_release(self.conn)
+			for table in state.tables:
+				await query_cache.invalidate(table)
+		return False
+
+
+def transaction():
+	return Transaction()
+
+
+def in_transaction():
+	return _tx_state.get() is not None
 
 
 # 执行SELECT语句，完成查找 sql是sql语句
-async def select(sql, args, size=None):
+# cache为Model的查询缓存选项{'table', 'ttl'}，事务内和read_primary()内不使用缓存
+async def select(sql, args, size=None, cache=None):
+	if cache is not None and query_cache.enabled and not in_transaction() and not _primary_only.get():
+		key, rs = await query_cache.get(cache['table'], sql, args, size)
+		if rs is not None:
+			return rs
+		rs = await _select(sql, args, size)
+		await query_cache.set(key, rs, cache.get('ttl'))
+		return rs
+	return await _select(sql, args, size)
+
+
+async def _select(sql, args, size):
 	log(sql)
-	global __pool
-	async with __pool.get() as conn:
+	async with _connection(readonly=True) as conn:
 		async with conn.cursor(aiomysql.DictCursor) as cursor:
-			await cursor.execute(sql.replace('?', '%s'), args or ())
+			start = time.monotonic()
+			await cursor.execute(driver_sql(sql), args or ())
 			if size:
 				rs = await cursor.fetchmany(size)
 			else:
 				rs = await cursor.fetchall()
-		logging.info('rows returned: %s' % len(rs))
+			elapsed = time.monotonic() - start
+		_query_latency['select'].observe(elapsed)
+		sql_profiler.observe(sql, args, elapsed, len(rs))
+		sql_log.debug('rows returned: %s', len(rs))
 		return rs
 
 
+# 用服务端游标逐批读取SELECT结果，内存占用与表大小无关
+# 游标读完之前连接不能执行其他语句，所以不能在事务中使用：事务内的查询都走同一个连接
+async def iter_select(sql, args, chunk_size=500):
+	if in_transaction():
+		raise RuntimeError('iter_select() holds a server-side cursor and cannot run inside a transaction; use select() instead.')
+	log(sql)
+	async with _connection(readonly=True) as conn:
+		async with conn.cursor(aiomysql.SSDictCursor) as cursor:
+			start = time.monotonic()
+			await cursor.execute(driver_sql(sql), args or ())
+			elapsed = time.monotonic() - start
+			_query_latency['select'].observe(elapsed)
+			sql_profiler.observe(sql, args, elapsed, None)
+			while True:
+				rs = await cursor.fetchmany(chunk_size)
+				if not rs:
+					break
+				yield rs
+
+
 # 通用的execute()执行INSERT、UPDATE、DELETE语句
 async def execute(sql, args, autocommit=True):
+	if not autocommit and not in_transaction():
+		async with transaction():
+			return await execute(sql, args)
 	log(sql)
-	global __pool
-	async with __pool.get() as conn:
-		if not autocommit:
-			await conn.begin()
-		try:
-			async with conn.cursor(aiomysql.DictCursor) as cursor:
-				await cursor.execute(sql.replace('?', '%s'), args)
-				affected = cursor.rowcount
-			if not autocommit:
-				await conn.commit()
-		except Exception:
-			if not autocommit:
-				await conn.rollback()
-			raise
-		finally:
-			conn.close()
-		return affected
+	async with _connection() as conn:
+		async with conn.cursor(aiomysql.DictCursor) as cursor:
+			start = time.monotonic()
+			await cursor.execute(driver_sql(sql), args)
+			elapsed = time.monotonic() - start
+			affected = cursor.rowcount
+	_query_latency['execute'].observe(elapsed)
+	sql_profiler.observe(sql, args, elapsed, affected)
+	_last_write.set(time.monotonic())
+	table = written_table(sql)
+	if table:
+		_clear_loaders(table)
+		await query_cache.invalidate(table)
+		state = _tx_state.get()
+		if state is not None:
+			state.tables.add(table)
+	return affected
+
+
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.IGNORECASE)
+
+
+def written_table(sql):
+	m = _RE_WRITE_TABLE.match(sql)
+	return m.group(1) if m else None
+
+
+# 在同一个连接、同一个事务中依次执行多条语句，返回影响的总行数
+async def execute_batch(statements):
+	affected = 0
+	async with transaction():
+		for sql, args in statements:
+			affected += await execute(sql, args)
+	return affected
+
+
+# 批量操作每批的默认行数
+BATCH_SIZE = 100
 
 
 # 数字转为特定字符串
@@ -126,8 +731,223 @@ class FloatField(Field):
 
 # text字段
 class TextField(Field):
-	def __init__(self, name=None, default=None):
-		super().__init__(name, 'text', False, default)
+	def __init__(self, name=None, default=None, column_type='text'):
+		super().__init__(name, column_type, False, default)
+
+
+# 索引声明，例如 __indexes__ = (Index('email', unique=True), Index('blog_id', 'created_at'))
+class Index:
+	def __init__(self, *columns, unique=False, name=None):
+		self.columns = columns
+		self.unique = unique
+		self.name = name or 'idx_%s' % '_'.join(columns)
+
+	def __str__(self):
+		return '<{}{}, {}>'.format('Unique' if self.unique else '', self.__class__.__name__, ', '.join(self.columns))
+
+
+# 紧凑的行对象：由ModelMetaclass按__mappings__生成__slots__子类
+class Row:
+	'''Read-mostly record with one slot per column, used by findAll(compact=True).
+
+	Attribute access goes straight to the slot descriptor; the mapping-style
+	helpers keep it usable from Jinja2 templates and JSON encoding. Relation
+	slots only show up in keys()/items() once they have been prefetched.
+	'''
+	__slots__ = ()
+	__model__ = None
+	__columns__ = ()
+	__relation_names__ = ()
+
+	def __init__(self, **kw):
+		for name in self.__columns__:
+			setattr(self, name, kw.get(name))
+		for name in self.__relation_names__:
+			if name in kw:
+				setattr(self, name, kw[name])
+
+	@classmethod
+	def _make(cls, r):
+		obj = cls.__new__(cls)
+		for name in cls.__columns__:
+			setattr(obj, name, r.get(name))
+		return obj
+
+	# 只按列名和关联名取值，不会取到get/items之类的方法
+	def __getitem__(self, key):
+		if key not in self.__columns__ and key not in self.__relation_names__:
+			raise KeyError(key)
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __contains__(self, key):
+		return key in self.keys()
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def __eq__(self, other):
+		if isinstance(other, Row):
+			other = other._asdict()
+		return self._asdict() == other
+
+	def __repr__(self):
+		return '{}({})'.format(self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self.items()))
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def keys(self):
+		if not self.__relation_names__:
+			return list(self.__columns__)
+		return list(self.__columns__) + [name for name in self.__relation_names__ if hasattr(self, name)]
+
+	def values(self):
+		return [getattr(self, name) for name in self.keys()]
+
+	def items(self):
+		return [(name, getattr(self, name)) for name in self.keys()]
+
+	def _asdict(self):
+		return dict(self.items())
+
+	def to_model(self):
+		return self.__model__(**self._asdict())
+
+
+# 所有Model，按类名登记，用于解析关联关系中的字符串
+_models = {}
+
+
+# 关联关系
+class Relation:
+	'''Base of BelongsTo/HasMany; model may be the class or its name.
+	'''
+
+	def __init__(self, model, key):
+		self._model = model
+		self.key = key
+		self.name = None
+
+	@property
+	def model(self):
+		if isinstance(self._model, str):
+			self._model = _models[self._model]
+		return self._model
+
+	def __str__(self):
+		model = self._model if isinstance(self._model, str) else self._model.__name__
+		return '<{}, {}:{}>'.format(self.__class__.__name__, model, self.key)
+
+
+# 多对一：本表的key列 -> 目标表主键，例如 Blog.user = BelongsTo('User', 'user_id')
+class BelongsTo(Relation):
+	async def load(self, owner, objs, compact):
+		keys = _unique(obj.get(self.key) for obj in objs)
+		related = await self.model.findIn(self.model.__primary_key__, keys, compact=compact)
+		pk = self.model.__primary_key__
+		found = {r.get(pk): r for r in related}
+		for obj in objs:
+			setattr(obj, self.name, found.get(obj.get(self.key)))
+		return related
+
+
+# 一对多：目标表的key列 -> 本表主键，例如 Blog.comments = HasMany('Comment', 'blog_id')
+class HasMany(Relation):
+	async def load(self, owner, objs, compact):
+		pk = owner.__primary_key__
+		keys = _unique(obj.get(pk) for obj in objs)
+		related = await self.model.findIn(self.key, keys, compact=compact)
+		groups = {}
+		for r in related:
+			groups.setdefault(r.get(self.key), []).append(r)
+		for obj in objs:
+			setattr(obj, self.name, groups.get(obj.get(pk), []))
+		return related
+
+
+def _unique(values):
+	seen = set()
+	result = []
+	for v in values:
+		if v is not None and v not in seen:
+			seen.add(v)
+			result.append(v)
+	return result
+
+
+# IN查询每批最多的参数个数
+IN_BATCH_SIZE = 1000
+
+
+# 按请求合并find(pk)：同一轮事件循环里的多次调用合并成一条IN查询，结果在请求内复用
+class DataLoader:
+	def __init__(self, model):
+		self.model = model
+		self._futures = {}
+		self._pending = {}
+
+	def load(self, pk):
+		fut = self._futures.get(pk)
+		if fut is None:
+			loop = asyncio.get_event_loop()
+			fut = self._futures[pk] = loop.create_future()
+			self._pending[pk] = fut
+			if len(self._pending) == 1:
+				loop.call_soon(self._schedule)
+		return fut
+
+	def clear(self):
+		self._futures = {k: f for k, f in self._futures.items() if not f.done()}
+
+	def _schedule(self):
+		asyncio.ensure_future(self._dispatch())
+
+	async def _dispatch(self):
+		pending, self._pending = self._pending, {}
+		try:
+			rows = await self.model.findIn(self.model.__primary_key__, list(pending))
+		except Exception as e:
+			for pk, fut in pending.items():
+				self._futures.pop(pk, None)
+				if not fut.done():
+					fut.set_exception(e)
+			return
+		found = {r.get(self.model.__primary_key__): r for r in rows}
+		for pk, fut in pending.items():
+			if not fut.done():
+				fut.set_result(found.get(pk))
+
+
+# 当前请求的DataLoader：{model: DataLoader}，为None时find()直接查询
+_loaders = contextvars.ContextVar('async_orm_loaders', default=None)
+
+
+@contextlib.contextmanager
+def loader_scope():
+	'''with loader_scope(): Model.find(pk) calls inside are batched and memoized.
+	'''
+	token = _loaders.set({})
+	try:
+		yield
+	finally:
+		_loaders.reset(token)
+
+
+def _clear_loaders(table):
+	loaders = _loaders.get()
+	if loaders:
+		for model, loader in loaders.items():
+			if model.__table_name__ == table:
+				loader.clear()
 
 
 # model的元类
@@ -139,10 +959,15 @@ class ModelMetaclass(type):
 		table_name = attrs.get('__table_name__', None) or name
 		logging.info('found model: {} (table: {})'.format(name, table_name))
 		mappings = dict()
+		relations = dict()
 		fields = []
 		primary_key = None
 		for key, value in attrs.items():
-			if isinstance(value, Field):
+			if isinstance(value, Relation):
+				logging.info(' found relation: {} ==> {}'.format(key, value))
+				value.name = key
+				relations[key] = value
+			elif isinstance(value, Field):
 				logging.info(' found mapping: {} ==> {}'.format(key, value))
 				mappings[key] = value
 				if value.primary_key:
@@ -155,7 +980,7 @@ class ModelMetaclass(type):
 		if not primary_key:
 			raise Exception('Primary key not found.')
 
-		for k in mappings.keys():
+		for k in list(mappings.keys()) + list(relations.keys()):
 			attrs.pop(k)
 
 		escaped_fields = list(map(lambda f: '`%s`' % f, fields))
@@ -163,11 +988,33 @@ class ModelMetaclass(type):
 		attrs['__table_name__'] = table_name
 		attrs['__primary_key__'] = primary_key  # 主键属性名
 		attrs['__fields__'] = fields  # 除主键外的属性名
+		attrs['__relations__'] = relations
+		attrs['__indexes__'] = tuple(attrs.get('__indexes__', ()))
 		attrs['__select__'] = 'select `%s`, %s from `%s`' % (primary_key, ', '.join(escaped_fields), table_name)
+		attrs['__select_pk__'] = '%s where `%s`=?' % (attrs['__select__'], primary_key)
 		attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (table_name, ', '.join(escaped_fields), primary_key, create_args_string(len(escaped_fields) + 1))
+		# 多行insert：__insert_head__ + ', '.join([__insert_row__] * n)
+		attrs['__insert_head__'] = 'insert into `%s` (%s, `%s`) values ' % (table_name, ', '.join(escaped_fields), primary_key)
+		attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
+		attrs['__upsert_tail__'] = ' on duplicate key update %s' % ', '.join(map(lambda f: '%s=values(%s)' % (f, f), escaped_fields))
 		attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (table_name, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primary_key)
 		attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (table_name, primary_key)
-		return type.__new__(cls, name, bases, attrs)
+		attrs['__listeners__'] = []  # save/update/remove 之后的回调
+		# 有updated_at字段的表每次写入时更新它，可以和count(*)一起作为数据的版本
+		attrs['__updated_at__'] = 'updated_at' if 'updated_at' in fields else None
+		# 查询缓存：在Model上声明 __cache__ = dict(ttl=秒) 开启
+		cache = attrs.get('__cache__', None)
+		attrs['__select_cache__'] = dict(cache, table=table_name) if cache is not None else None
+		model = type.__new__(cls, name, bases, attrs)
+		columns = tuple([primary_key] + fields)
+		model.__row__ = type('%sRow' % name, (Row,), {
+			'__slots__': columns + tuple(relations),
+			'__model__': model,
+			'__columns__': columns,
+			'__relation_names__': tuple(relations)
+		})
+		_models[name] = model
+		return model
 
 
 class Model(dict, metaclass=ModelMetaclass):
@@ -192,42 +1039,181 @@ class Model(dict, metaclass=ModelMetaclass):
 			field = self.__mappings__[key]
 			if field.default is not None:
 				value = field.default() if callable(field.default) else field.default
-				logging.debug('using default value for {}: {}'.format(key, str(value)))
+				logging.debug('using default value for %s: %s', key, value)
 				setattr(self, key, value)
 		return value
 
+	def _touch(self):
+		if self.__updated_at__ is not None:
+			setattr(self, self.__updated_at__, time.time())
+
+	@classmethod
+	def add_listener(cls, fn):
+		'''
+		register fn(action, instance) called after save/update/remove succeeds.
+		:param fn: 
+		:return: 
+		'''
+		cls.__listeners__.append(fn)
+		return fn
+
+	def _notify(self, action):
+		for fn in self.__listeners__:
+			try:
+				fn(action, self)
+			except Exception as e:
+				logging.exception('model listener failed: {}'.format(e))
+
+	@classmethod
+	def _build_select(cls, where=None, args=None, **kw):
+		args = [] if args is None else list(args)
+		orderBy = kw.get("orderBy", None)
+		limit = kw.get('limit', None)
+		if limit is None:
+			shape = 0
+		elif isinstance(limit, int):
+			shape = 1
+			args.append(limit)
+		elif isinstance(limit, tuple) and len(limit) == 2:
+			shape = 2
+			args.extend(limit)
+		else:
+			raise ValueError('Invalid limit value: {}'.format(str(limit)))
+		key = (cls, where, orderBy, shape)
+		sql = _compiled.get(key)
+		if sql is None:
+			sql = [cls.__select__]
+			if where:
+				sql.append('where')
+				sql.append(where)
+			if orderBy:
+				sql.append('order by')
+				sql.append(orderBy)
+			if shape:
+				sql.append('limit')
+				sql.append('?' if shape == 1 else '?, ?')
+			sql = ' '.join(sql)
+			_compiled.set(key, sql)
+		return sql, args
+
 	@classmethod
 	async def findAll(cls, where=None, args=None, **kw):
 		'''
 		find objects by where clause.	
 		:param where: 
 		:param args: 
-		:param kw: 
+		:param kw: orderBy, limit, compact=True to return __slots__ rows instead of Model instances,
+		    prefetch=['user', 'comments.user'] to load relations in bulk
 		:return: 
 		'''
-		sql = [cls.__select__]
-		if where:
-			sql.append('where')
-			sql.append(where)
-		if args is None:
-			args = []
-		orderBy = kw.get("orderBy", None)
-		if orderBy:
-			sql.append('order by')
-			sql.append(orderBy)
-		limit = kw.get('limit', None)
-		if limit is not None:
-			sql.append('limit')
-			if isinstance(limit, int):
-				sql.append('?')
-				args.append(limit)
-			elif isinstance(limit, tuple) and len(limit) == 2:
-				sql.append('?, ?')
-				args.extend(limit)
-			else:
-				raise ValueError('Invalid limit value: {}'.format(str(limit)))
-		rs = await select(' '.join(sql), args)
-		return [cls(**r) for r in rs]
+		compact = kw.pop('compact', False)
+		prefetch = kw.pop('prefetch', None)
+		sql, args = cls._build_select(where, args, **kw)
+		_capture(sql, args)
+		rs = await select(sql, args, cache=cls.__select_cache__)
+		if compact:
+			make = cls.__row__._make
+			objs = [make(r) for r in rs]
+		else:
+			objs = [cls(**r) for r in rs]
+		if prefetch and objs:
+			await cls.prefetch(objs, prefetch)
+		return objs
+
+	@classmethod
+	async def findIn(cls, column, values, **kw):
+		'''
+		find objects whose column is in values, IN_BATCH_SIZE values per query.
+		:param column: 
+		:param values: 
+		:param kw: as findAll
+		:return: 
+		'''
+		values = list(values)
+		objs = []
+		for i in range(0, len(values), IN_BATCH_SIZE):
+			batch = values[i:i + IN_BATCH_SIZE]
+			objs.extend(await cls.findAll('`%s` in (%s)' % (column, create_args_string(len(batch))), batch, **kw))
+		return objs
+
+	@classmethod
+	async def prefetch(cls, objs, paths):
+		'''
+		load relations of objs with one IN query per relation and attach them:
+		    await Blog.prefetch(blogs, ['user', 'comments.user'])
+		:param objs: Model instances or rows of cls
+		:param paths: relation names, nested ones joined by '.'
+		:return: 
+		'''
+		if isinstance(paths, str):
+			paths = [paths]
+		tree = {}
+		for path in paths:
+			node = tree
+			for part in path.split('.'):
+				node = node.setdefault(part, {})
+		await cls._prefetch_tree(objs, tree)
+
+	@classmethod
+	async def _prefetch_tree(cls, objs, tree):
+		compact = isinstance(objs[0], Row)
+		for name, subtree in tree.items():
+			relation = cls.__relations__.get(name)
+			if relation is None:
+				raise ValueError('Relation {} not found in {}'.format(name, cls.__name__))
+			related = await relation.load(cls, objs, compact)
+			if subtree and related:
+				await relation.model._prefetch_tree(related, subtree)
+
+	@classmethod
+	async def iter_all(cls, where=None, args=None, chunk_size=500, **kw):
+		'''
+		iterate objects by where clause without loading the whole result:
+		    async for blog in Blog.iter_all(orderBy='created_at desc'): ...
+		keeps a pooled connection busy until the loop ends, so it raises
+		RuntimeError inside a transaction; use findAll/findAfter there.
+		:param where: 
+		:param args: 
+		:param chunk_size: rows fetched from the server-side cursor at a time
+		:param kw: orderBy / limit / compact as findAll
+		:return: 
+		'''
+		make = cls.__row__._make if kw.pop('compact', False) else (lambda r: cls(**r))
+		sql, args = cls._build_select(where, args, **kw)
+		async for rs in iter_select(sql, args, chunk_size):
+			for r in rs:
+				yield make(r)
+
+	@classmethod
+	async def findAfter(cls, after=None, where=None, args=None, limit=20, key='created_at', desc=True, compact=False):
+		'''
+		keyset pagination ordered by (key, primary key), instead of LIMIT offset, n.
+		pass the last object of the previous page (a Model, a dict, a compact Row
+		or anything with the key and pk attributes), or its (key, pk) tuple, as after.
+		:param after: 
+		:param where: 
+		:param args: 
+		:param limit: 
+		:param key: 
+		:param desc: 
+		:param compact: return Row objects as findAll(compact=True)
+		:return: 
+		'''
+		pk = cls.__primary_key__
+		args = [] if args is None else list(args)
+		conditions = ['(%s)' % where] if where else []
+		if after is not None:
+			if isinstance(after, dict):
+				after = (after[key], after[pk])
+			elif not isinstance(after, (tuple, list)):
+				after = (getattr(after, key), getattr(after, pk))
+			op = '<' if desc else '>'
+			conditions.append('(`{0}` {1} ? or (`{0}` = ? and `{2}` {1} ?))'.format(key, op, pk))
+			args.extend([after[0], after[0], after[1]])
+		direction = 'desc' if desc else 'asc'
+		return await cls.findAll(
+			' and '.join(conditions) or None, args,
+			orderBy='`{0}` {2}, `{1}` {2}'.format(key, pk, direction), limit=limit, compact=compact)
 
 	@classmethod
 	async def findNumber(cls, selectField, where=None, args=None):
@@ -238,46 +1224,163 @@ class Model(dict, metaclass=ModelMetaclass):
 		:param args: 
 		:return: 
 		'''
-		sql = ['select %s _num_ from `%s`' % (selectField, cls.__table_name__)]
-		if where:
-			sql.append('where')
-			sql.append(where)
-		rs = await select(' '.join(sql), args, 1)
+		key = (cls, 'number', selectField, where)
+		sql = _compiled.get(key)
+		if sql is None:
+			sql = 'select %s _num_ from `%s`' % (selectField, cls.__table_name__)
+			if where:
+				sql = '%s where %s' % (sql, where)
+			_compiled.set(key, sql)
+		_capture(sql, args)
+		rs = await select(sql, args, 1, cache=cls.__select_cache__)
 		if len(rs) == 0:
 			return None
 		return rs[0]['_num_']
 
 	@classmethod
-	async def find(cls, pk):
+	async def findVersion(cls, column='created_at', where=None, args=None):
+		'''
+		cheap version stamp of the rows for conditional GET.
+		:return: (count(*), max(column))
+		'''
+		key = (cls, 'version', column, where)
+		sql = _compiled.get(key)
+		if sql is None:
+			sql = 'select count(*) _count_, max(`%s`) _max_ from `%s`' % (column, cls.__table_name__)
+			if where:
+				sql = '%s where %s' % (sql, where)
+			_compiled.set(key, sql)
+		_capture(sql, args)
+		rs = await select(sql, args, 1, cache=cls.__select_cache__)
+		return rs[0]['_count_'], rs[0]['_max_']
+
+	@classmethod
+	async def find(cls, pk, primary=False):
 		'''
 		find object by primary key. '
+		inside loader_scope() (every web request) concurrent calls are batched into one query.
 		:param pk: 
+		:param primary: read from the primary, bypassing the batch loader and the query cache
 		:return: 
 		'''
-		rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+		if primary:
+			with read_primary():
+				rs = await select(cls.__select_pk__, [pk], 1)
+			return cls(**rs[0]) if rs else None
+		loaders = _loaders.get()
+		if loaders is not None and _tx_state.get() is None:
+			loader = loaders.get(cls)
+			if loader is None:
+				loader = loaders[cls] = DataLoader(cls)
+			obj = await loader.load(pk)
+			# 返回副本，调用方修改对象不会影响请求内的其他find()
+			return None if obj is None else cls(**obj)
+		rs = await select(cls.__select_pk__, [pk], 1, cache=cls.__select_cache__)
 		if len(rs) == 0:
 			return None
 		return cls(**rs[0])
 
+	# 批量写入后每个主键只通知一次(取最后一行)，监听器的开销不随重复行增长
+	@classmethod
+	def _notify_many(cls, rows, action):
+		if not cls.__listeners__:
+			return
+		latest = {}
+		for row in rows:
+			latest[row.getvalue(cls.__primary_key__)] = row
+		for row in latest.values():
+			row._notify(action)
+
+	@classmethod
+	def _to_instances(cls, rows):
+		return [r if isinstance(r, cls) else cls(**r) for r in rows]
+
+	@classmethod
+	async def _insert_many(cls, rows, batch_size, tail, action):
+		rows = cls._to_instances(rows)
+		batch_size = batch_size or BATCH_SIZE
+		affected = 0
+		for i in range(0, len(rows), batch_size):
+			batch = rows[i:i + batch_size]
+			args = []
+			for row in batch:
+				row._touch()
+				args.extend(map(row.getValueOrDefault, cls.__fields__))
+				args.append(row.getValueOrDefault(cls.__primary_key__))
+			sql = cls.__insert_head__ + ', '.join([cls.__insert_row__] * len(batch)) + tail
+			affected += await execute_batch([(sql, args)])
+			cls._notify_many(batch, action)
+		return affected
+
+	@classmethod
+	async def save_many(cls, rows, batch_size=None):
+		'''
+		insert rows (Model instances or dicts) with one multi-row INSERT per batch.
+		:param rows: 
+		:param batch_size: 
+		:return: total affected rows
+		'''
+		return await cls._insert_many(rows, batch_size, '', 'save')
+
+	@classmethod
+	async def upsert_many(cls, rows, batch_size=None):
+		'''
+		insert rows, updating the existing ones by primary/unique key (ON DUPLICATE KEY UPDATE).
+		MySQL counts 2 affected rows for every updated row.
+		:param rows: 
+		:param batch_size: 
+		:return: total affected rows
+		'''
+		return await cls._insert_many(rows, batch_size, cls.__upsert_tail__, 'update')
+
+	@classmethod
+	async def update_many(cls, rows, batch_size=None):
+		'''
+		update rows by primary key, one transaction per batch.
+		:param rows: 
+		:param batch_size: 
+		:return: total affected rows
+		'''
+		rows = cls._to_instances(rows)
+		batch_size = batch_size or BATCH_SIZE
+		affected = 0
+		for i in range(0, len(rows), batch_size):
+			batch = rows[i:i + batch_size]
+			statements = []
+			for row in batch:
+				row._touch()
+				args = list(map(row.getvalue, cls.__fields__))
+				args.append(row.getvalue(cls.__primary_key__))
+				statements.append((cls.__update__, args))
+			affected += await execute_batch(statements)
+			cls._notify_many(batch, 'update')
+		return affected
+
 	# 保存
 	async def save(self):
+		self._touch()
 		args = list(map(self.getValueOrDefault, self.__fields__))
 		args.append(self.getValueOrDefault(self.__primary_key__))
 		rows = await execute(self.__insert__, args)
 		if rows != 1:
 			logging.info('failed to insert record: affected rows: {}'.format(str(rows)))
+		self._notify('save')
 
 	# 更新
 	async def update(self):
-		args = list(map(self.getvalue(), self.__fields__))
+		self._touch()
+		args = list(map(self.getvalue, self.__fields__))
 		args.append(self.getvalue(self.__primary_key__))
 		rows = await execute(self.__update__, args)
 		if rows != 1:
-			logging.info('failed to insert record: affected rows: {}'.format(str(rows)))
+			logging.info('failed to update record: affected rows: {}'.format(str(rows)))
+		self._notify('update')
 
 	# 删除
 	async def remove(self):
-		args = [self.getValue(self.__primary_key__)]
+		args = [self.getvalue(self.__primary_key__)]
 		rows = await execute(self.__delete__, args)
 		if rows != 1:
-			logging.info('failed to insert record: affected rows: {}'.format(str(rows)))
+			logging.info('failed to remove record: affected rows: {}'.format(str(rows)))
+		self._notify('remove')
+
@@ -0,0 +1,340 @@
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tracemalloc
+
+import aiohttp
+from aiohttp.test_utils import TestServer, TestClient
+
+from webapp import async_orm, web_app, passwords
+from webapp.benchmark import memory_db
+from webapp.config.config import configs
+from webapp.models import User, Blog, Comment, next_id
+
+__author__ = 'Adam Lee'
+
+'''Load test of the whole stack: middlewares -> RequestHandler -> handlers -> async_orm.
+
+The app is created in-process with web_app.create_app() and driven over a local
+socket at a fixed concurrency with a weighted mix of requests. By default the
+database is an in-memory sqlite stand-in (memory_db); --db mysql uses configs.db.
+
+    python -m webapp.benchmark.bench_app --users 1000 --blogs 2000 --comments 10000 -c 32 -n 5000
+    python -m webapp.benchmark.bench_app --json after.json --compare before.json
+
+With --compare the run exits with status 1 when req/s or p95 of any endpoint is
+worse than the baseline by more than --tolerance.
+'''
+
+PASSWORD = 'benchpass1'
+
+
+# 写入测试数据，返回可登录的邮箱列表；密码是旧的sha1格式，第一次登录时升级
+async def seed(run_id, users, blogs, comments, rng):
+	now = time.time()
+	rows = []
+	for i in range(users):
+		uid = next_id()
+		rows.append(dict(id=uid, email='bench-{}-{}@example.com'.format(run_id, i), password=passwords.legacy_sha1(uid, PASSWORD),
+						 admin=False, name='user{}'.format(i), image='about:blank', created_at=now - i))
+	await User.save_many(rows)
+	authors = rows
+	rows = []
+	for i in range(blogs):
+		author = rng.choice(authors)
+		rows.append(dict(id=next_id(), user_id=author['id'], user_name=author['name'], user_image=author['image'],
+						 name='blog {}'.format(i), summary='summary of blog {}'.format(i), content='content ' * 50, created_at=now - i))
+	await Blog.save_many(rows)
+	blog_ids = [r['id'] for r in rows]
+	rows = []
+	for i in range(comments):
+		author = rng.choice(authors)
+		rows.append(dict(id=next_id(), blog_id=rng.choice(blog_ids), user_id=author['id'], user_name=author['name'],
+						 user_image=author['image'], content='comment {}'.format(i), created_at=now - i))
+	await Comment.save_many(rows)
+	return [a['email'] for a in authors], blog_ids
+
+
+class Workload:
+	def __init__(self, run_id, emails, rng):
+		self.run_id = run_id
+		self.emails = emails
+		self.rng = rng
+		self.registered = 0
+
+	def index(self):
+		return 'GET', '/', {}
+
+	def users(self):
+		return 'POST', '/api/users', {'json': {}}
+
+	def login(self):
+		return 'POST', '/api/login', {'json': {'email': self.rng.choice(self.emails), 'password': PASSWORD}}
+
+	def register(self):
+		self.registered += 1
+		email = 'new-{}-{}@example.com'.format(self.run_id, self.registered)
+		return 'POST', '/api/register', {'json': {'email': email, 'name': 'new user', 'password': PASSWORD}}
+
+
+ENDPOINTS = ('index', 'users', 'login', 'register')
+
+
+def parse_mix(text):
+	mix = {}
+	for part in text.split(','):
+		name, _, weight = part.partition(':')
+		if name not in ENDPOINTS:
+			raise argparse.ArgumentTypeError('unknown endpoint {}, expected one of {}'.format(name, ', '.join(ENDPOINTS)))
+		mix[name] = float(weight or 1)
+	return mix
+
+
+def percentile(sorted_values, p):
+	if not sorted_values:
+		return 0.0
+	rank = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+	return sorted_values[rank]
+
+
+async def request(client, method, path, kw):
+	'''Send one request, return (ok, seconds). API errors come back as 200 with an error field.
+	'''
+	start = time.perf_counter()
+	async with client.request(method, path, **kw) as resp:
+		body = await resp.read()
+	elapsed = time.perf_counter() - start
+	ok = resp.status < 400
+	if ok and resp.content_type == 'application/json' and body.startswith(b'{"error"'):
+		ok = False
+	return ok, elapsed
+
+
+async def drive(client, workload, mix, total, concurrency, rng):
+	names = list(mix)
+	weights = [mix[n] for n in names]
+	latencies = {n: [] for n in names}
+	errors = {n: 0 for n in names}
+	remaining = [total]
+
+	async def worker():
+		while remaining[0] > 0:
+			remaining[0] -= 1
+			name = rng.choices(names, weights)[0]
+			method, path, kw = getattr(workload, name)()
+			try:
+				ok, elapsed = await request(client, method, path, kw)
+			except aiohttp.ClientError:
+				ok, elapsed = False, 0.0
+			latencies[name].append(elapsed)
+			if not ok:
+				errors[name] += 1
+
+	start = time.perf_counter()
+	await asyncio.gather(*[worker() for _ in range(concurrency)])
+	wall = time.perf_counter() - start
+	results = {}
+	for name in names:
+		values = sorted(latencies[name])
+		results[name] = dict(
+			requests=len(values),
+			errors=errors[name],
+			rps=len(values) / wall if wall else 0.0,
+			p50=percentile(values, 50) * 1000,
+			p95=percentile(values, 95) * 1000,
+			p99=percentile(values, 99) * 1000
+		)
+	count = sum(len(v) for v in latencies.values())
+	results['total'] = dict(requests=count, errors=sum(errors.values()), rps=count / wall if wall else 0.0, seconds=wall)
+	return results
+
+
+# 逐个接口顺序请求，tracemalloc统计峰值和残留内存；与吞吐测量分开跑，避免拖慢它
+async def allocations(client, workload, names, n):
+	results = {}
+	tracemalloc.start()
+	try:
+		for name in names:
+			base, _ = tracemalloc.get_traced_memory()
+			tracemalloc.reset_peak()
+			before = tracemalloc.take_snapshot()
+			for _ in range(n):
+				method, path, kw = getattr(workload, name)()
+				await request(client, method, path, kw)
+			current, peak = tracemalloc.get_traced_memory()
+			diff = tracemalloc.take_snapshot().compare_to(before, 'filename')
+			results[name] = dict(
+				peak_kib=(peak - base) / 1024.0,
+				retained_bytes_per_request=(current - base) / n,
+				blocks_per_request=sum(d.count_diff for d in diff) / n
+			)
+	finally:
+		tracemalloc.stop()
+	return results
+
+
+# 直接测ORM的几个常用查询（微秒/次）
+async def bench_orm(blog_ids, n, rng):
+	cases = [
+		('User.findAll(limit=20)', lambda: User.findAll(orderBy='created_at desc', limit=20)),
+		('Blog.find', lambda: Blog.find(rng.choice(blog_ids))),
+		('Comment.findAll(blog_id)', lambda: Comment.findAll('blog_id=?', [rng.choice(blog_ids)], orderBy='created_at desc')),
+		('Blog.findAll(prefetch=user)', lambda: Blog.findAll(orderBy='created_at desc', limit=20, prefetch=['user'])),
+	]
+	results = {}
+	for name, fn in cases:
+		start = time.perf_counter()
+		for _ in range(n):
+			with async_orm.loader_scope():
+				await fn()
+		results[name] = (time.perf_counter() - start) / n * 1e6
+	return results
+
+
+def configure(options):
+	if options.no_query_cache:
+		configs.query_cache.enabled = False
+	if options.no_page_cache:
+		configs.template.page_cache.enabled = False
+	if options.no_profiler:
+		configs.profiler.enabled = False
+	configs.db.maxsize = options.pool_size
+	# 所有请求都来自同一个客户端，按客户端的限流会把压测本身挡掉
+	configs.admission.rate_limits = {}
+	configs.db.adaptive.enabled = False
+	if options.db == 'memory':
+		configs.db.replicas = []
+		database = memory_db.Database(latency=options.latency / 1000.0)
+		database.create_tables((User, Blog, Comment))
+		async_orm._open_pool = memory_db.pool_opener(database)
+
+
+async def run(options):
+	rng = random.Random(options.seed)
+	run_id = uuid.uuid4().hex[:8]
+	app = await web_app.create_app()
+	client = TestClient(TestServer(app))
+	await client.start_server()
+	try:
+		start = time.perf_counter()
+		emails, blog_ids = await seed(run_id, options.users, options.blogs, options.comments, rng)
+		seeded = time.perf_counter() - start
+		workload = Workload(run_id, emails, rng)
+		await drive(client, workload, options.mix, options.warmup, options.concurrency, rng)
+		results = dict(
+			http=await drive(client, workload, options.mix, options.requests, options.concurrency, rng),
+			orm=await bench_orm(blog_ids, options.orm_iterations, rng),
+			seed_seconds=seeded
+		)
+		if options.alloc_requests:
+			results['allocations'] = await allocations(client, workload, list(options.mix), options.alloc_requests)
+		results['pools'] = async_orm.pool_stats()['pools']
+		return results
+	finally:
+		await client.close()
+		await async_orm.destroy_pool()
+
+
+def describe(options):
+	return dict(
+		started=time.strftime('%Y-%m-%dT%H:%M:%S'),
+		python=platform.python_version(),
+		aiohttp=aiohttp.__version__,
+		db=options.db,
+		users=options.users,
+		blogs=options.blogs,
+		comments=options.comments,
+		concurrency=options.concurrency,
+		requests=options.requests,
+		mix=options.mix,
+		pool_size=options.pool_size,
+		query_cache=configs.query_cache.enabled,
+		page_cache=configs.template.page_cache.enabled,
+		profiler=configs.profiler.enabled if configs.profiler.enabled is not None else configs.debug,
+		json_backend=configs.json.backend
+	)
+
+
+def report(results):
+	print('{:<10}{:>9}{:>8}{:>10}{:>9}{:>9}{:>9}'.format('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+	for name, r in results['http'].items():
+		if name == 'total':
+			continue
+		print('{:<10}{:>9}{:>8}{:>10.1f}{:>9.2f}{:>9.2f}{:>9.2f}'.format(name, r['requests'], r['errors'], r['rps'], r['p50'], r['p95'], r['p99']))
+	total = results['http']['total']
+	print('{:<10}{:>9}{:>8}{:>10.1f}   in {:.2f}s'.format('total', total['requests'], total['errors'], total['rps'], total['seconds']))
+	print()
+	for name, us in results['orm'].items():
+		print('{:<30}{:>10.1f} us/op'.format(name, us))
+	for name, r in results.get('allocations', {}).items():
+		print('{:<10} peak {:>8.1f} KiB  retained {:>8.1f} B/req  blocks {:>6.1f}/req'.format(
+			name, r['peak_kib'], r['retained_bytes_per_request'], r['blocks_per_request']))
+
+
+# 与基线对比，返回超出容忍度的退化项
+def compare(results, baseline, tolerance):
+	regressions = []
+	for name, r in results['http'].items():
+		base = baseline['results']['http'].get(name)
+		if not base or name == 'total':
+			continue
+		if base['rps'] and r['rps'] < base['rps'] * (1 - tolerance):
+			regressions.append('{} req/s {:.1f} -> {:.1f}'.format(name, base['rps'], r['rps']))
+		if base['p95'] and r['p95'] > base['p95'] * (1 + tolerance):
+			regressions.append('{} p95 {:.2f}ms -> {:.2f}ms'.format(name, base['p95'], r['p95']))
+		print('{:<10} req/s {:+6.1f}%  p95 {:+6.1f}%'.format(
+			name, (r['rps'] / base['rps'] - 1) * 100 if base['rps'] else 0.0, (r['p95'] / base['p95'] - 1) * 100 if base['p95'] else 0.0))
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Load test of the web + ORM stack')
+	parser.add_argument('--db', choices=('memory', 'mysql'), default='memory', help='memory: sqlite stand-in, mysql: configs.db')
+	parser.add_argument('--latency', type=float, default=0.0, help='simulated round trip per statement of the memory db (ms)')
+	parser.add_argument('--users', type=int, default=200)
+	parser.add_argument('--blogs', type=int, default=500)
+	parser.add_argument('--comments', type=int, default=2000)
+	parser.add_argument('-c', '--concurrency', type=int, default=16)
+	parser.add_argument('-n', '--requests', type=int, default=2000)
+	parser.add_argument('--warmup', type=int, default=200)
+	parser.add_argument('--mix', type=parse_mix, default=parse_mix('index:50,users:30,login:15,register:5'),
+						help='weighted endpoints, e.g. index:50,users:30,login:15,register:5')
+	parser.add_argument('--orm-iterations', type=int, default=500)
+	parser.add_argument('--alloc-requests', type=int, default=100, help='requests per endpoint traced with tracemalloc, 0 to skip')
+	parser.add_argument('--pool-size', type=int, default=10)
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--no-query-cache', action='store_true')
+	parser.add_argument('--no-page-cache', action='store_true')
+	parser.add_argument('--no-profiler', action='store_true')
+	parser.add_argument('--log-level', default='WARNING')
+	parser.add_argument('--json', help='write results to this file')
+	parser.add_argument('--compare', help='baseline JSON from an earlier --json run')
+	parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression against --compare')
+	options = parser.parse_args(argv)
+	configs.logging.level = options.log_level
+	logging.getLogger().setLevel(options.log_level)
+	configure(options)
+	results = asyncio.run(run(options))
+	report(results)
+	if options.json:
+		with open(options.json, 'w') as f:
+			json.dump(dict(meta=describe(options), results=results), f, indent=2, default=str)
+	if options.compare:
+		with open(options.compare) as f:
+			baseline = json.load(f)
+		print()
+		regressions = compare(results, baseline, options.tolerance)
+		for r in regressions:
+			print('REGRESSION: ' + r)
+		if regressions:
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import logging
+import time
+from urllib import parse
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+from webapp import core_web
+from webapp.api_error import APIError
+from webapp.core_web import get, post
+
+__author__ = 'Adam Lee'
+
+'''Micro-benchmark: per-request overhead of RequestHandler's compiled binder
+against the previous per-request argument handling.
+
+    python -m webapp.benchmark.bench_binder -n 2000
+'''
+
+
+# 旧版本的RequestHandler：每个请求都按签名信息重新处理参数，仅用于对比
+class LegacyRequestHandler:
+	def __init__(self, app, fn):
+		self._app = app
+		self._func = fn
+		self._has_request_arg = core_web.has_request_arg(fn)
+		self._has_var_kw_arg = core_web.has_var_kw_arg(fn)
+		self._has_named_kw_args = core_web.has_named_kw_args(fn)
+		self._named_kw_args = core_web.get_named_kw_args(fn)
+		self._required_kw_args = core_web.get_required_kw_args(fn)
+
+	async def __call__(self, request):
+		kw = None
+		if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+			if request.method == 'POST':
+				if not request.content_type:
+					return web.HTTPBadRequest(text='Missing Content-Type.')
+				ct = request.content_type.lower()
+				if ct.startswith('application/json'):
+					params = await request.json()
+					if not isinstance(params, dict):
+						return web.HTTPBadRequest(text='JSON body must be object.')
+					kw = params
+				elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+					params = await request.post()
+					kw = dict(**params)
+				else:
+					return web.HTTPBadRequest(text='Unsupported Content-Type: {}'.format(request.content_type))
+			if request.method == 'GET':
+				qs = request.query_string
+				if qs:
+					kw = dict()
+					for key, value in parse.parse_qs(qs, True).items():
+						kw[key] = value[0]
+
+		if kw is None:
+			kw = dict(**request.match_info)
+		else:
+			if not self._has_var_kw_arg and self._named_kw_args:
+				copy = dict()
+				for name in self._named_kw_args:
+					if name in kw:
+						copy[name] = kw[name]
+				kw = copy
+			for key, value in request.match_info.items():
+				if key in kw:
+					logging.debug('Duplicate arg name in named arg and kw args: {}'.format(key))
+				kw[key] = value
+		if self._has_request_arg:
+			kw['request'] = request
+		if self._required_kw_args:
+			for name in self._required_kw_args:
+				if name not in kw:
+					return web.HTTPBadRequest(text='Missing argument: {}'.format(name))
+		logging.info('call with args: {}'.format(str(kw)))
+		try:
+			return await self._func(**kw)
+		except APIError as e:
+			return dict(error=e.error, data=e.data, message=e.message)
+
+
+@get('/none')
+async def no_args():
+	return web.Response(text='ok')
+
+
+@get('/item/{id}')
+async def match_info_only(id):
+	return web.Response(text=id)
+
+
+@get('/search')
+async def query_args(*, q, page='1'):
+	return web.Response(text=q)
+
+
+@post('/login')
+async def json_body(*, email, password):
+	return web.Response(text=email)
+
+
+# (名称, 方法, 路径, 请求参数)
+CASES = [
+	('no-args', 'GET', '/none', {}),
+	('match_info', 'GET', '/item/42', {}),
+	('query', 'GET', '/search?q=python&page=2&extra=1', {}),
+	('json-body', 'POST', '/login', {'json': {'email': 'a@example.com', 'password': 'secret', 'x': 1}}),
+]
+
+
+def make_app(handler_class):
+	app = web.Application()
+	for fn in (no_args, match_info_only, query_args, json_body):
+		app.router.add_route(fn.__method__, fn.__route__, handler_class(app, fn))
+	return app
+
+
+async def run_case(client, method, path, kw, n):
+	for _ in range(min(50, n)):
+		async with client.request(method, path, **kw) as resp:
+			await resp.read()
+	start = time.perf_counter()
+	for _ in range(n):
+		async with client.request(method, path, **kw) as resp:
+			assert resp.status == 200, resp.status
+			await resp.read()
+	return (time.perf_counter() - start) / n * 1e6
+
+
+async def run(n, rounds=3):
+	# 两种实现交替运行多轮，每种取最快的一轮，减少预热和顺序的影响
+	handlers = [('legacy', LegacyRequestHandler), ('compiled', core_web.RequestHandler)]
+	results = {}
+	for i in range(rounds):
+		for label, handler_class in (handlers if i % 2 == 0 else handlers[::-1]):
+			client = TestClient(TestServer(make_app(handler_class)))
+			await client.start_server()
+			try:
+				for name, method, path, kw in CASES:
+					us = await run_case(client, method, path, kw, n)
+					case = results.setdefault(name, {})
+					case[label] = min(us, case.get(label, us))
+			finally:
+				await client.close()
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description='RequestHandler argument binding benchmark')
+	parser.add_argument('-n', type=int, default=2000, help='requests per case')
+	parser.add_argument('--rounds', type=int, default=3, help='alternating rounds, the fastest one counts')
+	parser.add_argument('--log-level', default='WARNING', help='the legacy handler logs every call at INFO')
+	options = parser.parse_args()
+	logging.basicConfig(level=options.log_level)
+	results = asyncio.run(run(options.n, options.rounds))
+	print('{:<12}{:>14}{:>14}{:>10}'.format('case', 'legacy us/req', 'compiled', 'speedup'))
+	for name, r in results.items():
+		print('{:<12}{:>14.1f}{:>14.1f}{:>9.2f}x'.format(name, r['legacy'], r['compiled'], r['legacy'] / r['compiled']))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,178 @@
+import time
+import asyncio
+import logging
+import argparse
+
+from aiohttp.test_utils import TestServer, TestClient
+
+from webapp import async_orm, passwords, web_app
+from webapp.benchmark import memory_db
+from webapp.benchmark.bench_app import PASSWORD, percentile, request
+from webapp.config.config import configs
+from webapp.models import User, Blog, Comment, next_id
+from webapp.offload import BoundedExecutor
+
+__author__ = 'Adam Lee'
+
+'''Password verification throughput (logins/sec) and event loop lag.
+
+Compares verifying on the event loop (inline) with the thread and process
+executors, then optionally logs in over HTTP against the full app.
+
+    python -m webapp.benchmark.bench_passwords -n 200 -c 16
+    python -m webapp.benchmark.bench_passwords --scheme pbkdf2_sha256 --http
+'''
+
+
+# 在事件循环里直接计算，作为对比
+class InlineExecutor:
+	async def run(self, fn, *args):
+		return fn(*args)
+
+	def shutdown(self, wait=True):
+		pass
+
+	def stats(self):
+		return dict(kind='inline')
+
+
+# 每interval秒醒一次，记录比预期晚了多少：事件循环被阻塞的程度
+class LoopLag:
+	def __init__(self, interval=0.005):
+		self.interval = interval
+		self.lags = []
+		self._task = None
+		self._started = None
+
+	async def _tick(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			self._started = loop.time()
+			await asyncio.sleep(self.interval)
+			self.lags.append(loop.time() - self._started - self.interval)
+
+	def start(self):
+		self._task = asyncio.ensure_future(self._tick())
+
+	async def stop(self):
+		# 循环一直被阻塞时最后一次tick还没醒过来，也要算上
+		if self._started is not None:
+			self.lags.append(max(0.0, asyncio.get_running_loop().time() - self._started - self.interval))
+		self._task.cancel()
+		try:
+			await self._task
+		except asyncio.CancelledError:
+			pass
+		lags = sorted(self.lags)
+		return dict(p99=percentile(lags, 99) * 1000, max=(lags[-1] if lags else 0.0) * 1000)
+
+
+async def gather_timed(fn, n, concurrency):
+	latencies = []
+	remaining = [n]
+
+	async def worker():
+		while remaining[0] > 0:
+			remaining[0] -= 1
+			start = time.perf_counter()
+			await fn()
+			latencies.append(time.perf_counter() - start)
+
+	lag = LoopLag()
+	lag.start()
+	await asyncio.sleep(0)
+	start = time.perf_counter()
+	await asyncio.gather(*[worker() for _ in range(concurrency)])
+	wall = time.perf_counter() - start
+	lag = await lag.stop()
+	latencies.sort()
+	return dict(
+		per_sec=n / wall,
+		p50=percentile(latencies, 50) * 1000,
+		p95=percentile(latencies, 95) * 1000,
+		lag_p99=lag['p99'],
+		lag_max=lag['max']
+	)
+
+
+async def bench_verify(options, params):
+	results = {}
+	for kind in ('inline', 'thread', 'process'):
+		executor = InlineExecutor() if kind == 'inline' else BoundedExecutor('bench-' + kind, kind, options.workers, options.max_pending)
+		hasher = passwords.PasswordHasher(options.scheme, executor, **params)
+		encoded = await hasher.hash(PASSWORD)
+
+		async def verify():
+			ok, _ = await hasher.verify(PASSWORD, encoded)
+			assert ok
+
+		try:
+			await verify()  # 进程池启动
+			results[kind] = await gather_timed(verify, options.n, options.concurrency)
+		finally:
+			executor.shutdown()
+	return results
+
+
+# 通过HTTP登录：完整的中间件、查询和cookie生成
+async def bench_http(options, params):
+	configs.passwords.scheme = options.scheme
+	configs.passwords[options.scheme] = params
+	configs.admission.rate_limits = {}
+	database = memory_db.Database()
+	database.create_tables((User, Blog, Comment))
+	async_orm._open_pool = memory_db.pool_opener(database)
+	app = await web_app.create_app()
+	client = TestClient(TestServer(app))
+	await client.start_server()
+	try:
+		encoded = await passwords.hash_password(PASSWORD)
+		emails = ['login-{}@example.com'.format(i) for i in range(options.users)]
+		await User.save_many([dict(id=next_id(), email=e, password=encoded, admin=False, name='u', image='') for e in emails])
+		n = [0]
+
+		async def login():
+			n[0] += 1
+			ok, _ = await request(client, 'POST', '/api/login', {'json': {'email': emails[n[0] % len(emails)], 'password': PASSWORD}})
+			assert ok
+
+		return await gather_timed(login, options.n, options.concurrency)
+	finally:
+		await client.close()
+		await async_orm.destroy_pool()
+
+
+async def run(options):
+	params = {}
+	if options.scheme == 'scrypt' and options.n_cost:
+		params = dict(n=options.n_cost)
+	elif options.scheme == 'pbkdf2_sha256' and options.iterations:
+		params = dict(iterations=options.iterations)
+	results = await bench_verify(options, params)
+	if options.http:
+		results['http'] = await bench_http(options, params)
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Password hashing throughput benchmark')
+	parser.add_argument('-n', type=int, default=100, help='verifications per mode')
+	parser.add_argument('-c', '--concurrency', type=int, default=16)
+	parser.add_argument('--scheme', choices=sorted(passwords.SCHEMES), default=configs.passwords.scheme)
+	parser.add_argument('--n-cost', type=int, help='scrypt N')
+	parser.add_argument('--iterations', type=int, help='pbkdf2 iterations')
+	parser.add_argument('--workers', type=int, default=None)
+	parser.add_argument('--max-pending', type=int, default=64)
+	parser.add_argument('--http', action='store_true', help='also log in over HTTP with the full app')
+	parser.add_argument('--users', type=int, default=50)
+	options = parser.parse_args()
+	configs.logging.level = 'WARNING'
+	logging.getLogger().setLevel(logging.WARNING)
+	results = asyncio.run(run(options))
+	print('{:<8}{:>12}{:>10}{:>10}{:>14}{:>14}'.format('mode', 'logins/s', 'p50 ms', 'p95 ms', 'loop lag p99', 'loop lag max'))
+	for mode, r in results.items():
+		print('{:<8}{:>12.1f}{:>10.1f}{:>10.1f}{:>14.1f}{:>14.1f}'.format(mode, r['per_sec'], r['p50'], r['p95'], r['lag_p99'], r['lag_max']))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,162 @@
+import asyncio
+import sqlite3
+import collections
+
+__author__ = 'Adam Lee'
+
+'''In-memory stand-in for the aiomysql pool, backed by sqlite3, so the benchmarks
+can run the real async_orm code paths without a MySQL server.
+
+Only the parts async_orm uses are implemented: Pool.acquire/release/size/freesize
+(plus _free/_wakeup for adaptive sizing; like aiomysql, maxsize is _free.maxlen), Connection.cursor/begin/commit/
+rollback and DictCursor-style execute/fetchall/fetchmany/rowcount.
+'''
+
+
+# 所有连接共用一个sqlite连接；事务期间其他连接的语句等待事务结束
+class Database:
+	def __init__(self, latency=0.0):
+		self.conn = sqlite3.connect(':memory:', isolation_level=None, check_same_thread=False)
+		self.conn.row_factory = sqlite3.Row
+		self.latency = latency  # 模拟网络往返（秒）
+		self.owner = None
+		self.lock = asyncio.Lock()
+
+	def create_tables(self, models):
+		for model in models:
+			columns = ['`%s` %s not null' % (f.name or n, f.column_type) for n, f in model.__mappings__.items()]
+			columns.append('primary key (`%s`)' % model.__primary_key__)
+			self.conn.execute('create table `%s` (%s)' % (model.__table_name__, ', '.join(columns)))
+			for index in model.__indexes__:
+				self.conn.execute('create %s index `%s_%s` on `%s` (%s)' % (
+					'unique' if index.unique else '', model.__table_name__, index.name, model.__table_name__,
+					', '.join('`%s`' % c for c in index.columns)))
+
+	async def run(self, owner, sql, args):
+		if self.owner is not None and self.owner is not owner:
+			async with self.lock:
+				pass
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		return self.conn.execute(sql.replace('%s', '?'), tuple(args or ()))
+
+
+class Cursor:
+	def __init__(self, conn):
+		self._conn = conn
+		self._rows = collections.deque()
+		self.rowcount = -1
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc, tb):
+		return False
+
+	async def execute(self, sql, args=None):
+		cursor = await self._conn.db.run(self._conn, sql, args)
+		self._rows = collections.deque(dict(r) for r in cursor.fetchall())
+		self.rowcount = cursor.rowcount if cursor.rowcount >= 0 else len(self._rows)
+		return self.rowcount
+
+	async def fetchall(self):
+		rows = list(self._rows)
+		self._rows.clear()
+		return rows
+
+	async def fetchmany(self, size):
+		return [self._rows.popleft() for _ in range(min(size, len(self._rows)))]
+
+
+class Connection:
+	def __init__(self, db):
+		self.db = db
+		self.closed = False
+
+	def cursor(self, cursor_class=None):
+		return Cursor(self)
+
+	async def begin(self):
+		await self.db.lock.acquire()
+		self.db.owner = self
+		self.db.conn.execute('begin')
+
+	async def _end(self, sql):
+		try:
+			self.db.conn.execute(sql)
+		finally:
+			self.db.owner = None
+			self.db.lock.release()
+
+	async def commit(self):
+		if self.db.owner is self:
+			await self._end('commit')
+
+	async def rollback(self):
+		if self.db.owner is self:
+			await self._end('rollback')
+
+	async def ping(self, reconnect=False):
+		pass
+
+	def close(self):
+		self.closed = True
+
+
+class Pool:
+	def __init__(self, db, minsize=1, maxsize=10):
+		self.db = db
+		self.minsize = minsize
+		self._free = collections.deque(maxlen=maxsize)
+		self._used = set()
+		self._cond = asyncio.Condition()
+
+	@property
+	def maxsize(self):
+		return self._free.maxlen
+
+	@property
+	def size(self):
+		return len(self._free) + len(self._used)
+
+	@property
+	def freesize(self):
+		return len(self._free)
+
+	async def acquire(self):
+		async with self._cond:
+			while True:
+				while self._free and self._free[0].closed:
+					self._free.popleft()
+				if self._free:
+					conn = self._free.popleft()
+				elif self.size < self.maxsize:
+					conn = Connection(self.db)
+				else:
+					await self._cond.wait()
+					continue
+				self._used.add(conn)
+				return conn
+
+	def release(self, conn):
+		self._used.discard(conn)
+		if not conn.closed and len(self._free) < self.maxsize:
+			self._free.append(conn)
+		asyncio.ensure_future(self._wakeup())
+
+	async def _wakeup(self):
+		async with self._cond:
+			self._cond.notify()
+
+	def close(self):
+		self._free.clear()
+
+	async def wait_closed(self):
+		pass
+
+
+# 替换async_orm._open_pool时使用：所有命名连接池共用同一个Database
+def pool_opener(db):
+	async def open_pool(loop, kw):
+		return Pool(db, minsize=kw.get('minsize', 1), maxsize=kw.get('maxsize', 10))
+	return open_pool
@@ -0,0 +1,95 @@
+import time
+import threading
+from collections import OrderedDict
+
+__author__ = 'Adam Lee'
+
+'''进程内缓存
+'''
+
+_MISSING = object()
+
+
+# 带TTL的LRU缓存
+class LRUCache:
+	'''Bounded in-process cache with per-entry TTL and LRU eviction.
+
+	maxsize <= 0 means unbounded, ttl None means entries never expire unless
+	an explicit expires_at is given to set().
+	'''
+
+	def __init__(self, maxsize=1024, ttl=None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._data)
+
+	def __contains__(self, key):
+		return self.get(key, _MISSING, count=False) is not _MISSING
+
+	def get(self, key, default=None, count=True):
+		with self._lock:
+			entry = self._data.get(key, _MISSING)
+			if entry is not _MISSING:
+				value, expires_at = entry
+				if expires_at is None or expires_at > time.time():
+					self._data.move_to_end(key)
+					if count:
+						self.hits += 1
+					return value
+				del self._data[key]
+			if count:
+				self.misses += 1
+			return default
+
+	def set(self, key, value, ttl=None, expires_at=None):
+		ttl = self.ttl if ttl is None else ttl
+		if ttl is not None:
+			deadline = time.time() + ttl
+			expires_at = deadline if expires_at is None else min(expires_at, deadline)
+		with self._lock:
+			self._data[key] = (value, expires_at)
+			self._data.move_to_end(key)
+			while self.maxsize > 0 and len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+				self.evictions += 1
+
+	def pop(self, key, default=None):
+		with self._lock:
+			entry = self._data.pop(key, _MISSING)
+		return default if entry is _MISSING else entry[0]
+
+	def discard_if(self, predicate):
+		'''Drop every entry whose (key, value) matches predicate, return the count.
+		'''
+		with self._lock:
+			keys = [k for k, (v, _) in self._data.items() if predicate(k, v)]
+			for k in keys:
+				del self._data[k]
+		return len(keys)
+
+	def items(self):
+		now = time.time()
+		with self._lock:
+			return [(k, v) for k, (v, expires_at) in self._data.items() if expires_at is None or expires_at > now]
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+	def stats(self):
+		total = self.hits + self.misses
+		return dict(
+			size=len(self._data),
+			maxsize=self.maxsize,
+			hits=self.hits,
+			misses=self.misses,
+			evictions=self.evictions,
+			hit_rate=(self.hits / total) if total else 0.0
+		)
@@ -0,0 +1,230 @@
+import gzip
+import zlib
+import time
+import logging
+
+from aiohttp import web
+from aiohttp.web_response import ContentCoding
+
+from webapp import metrics
+from webapp.api_error import APIBusyError
+from webapp.offload import BoundedExecutor
+
+__author__ = 'Adam Lee'
+
+'''HTTP内容编码：gzip/deflate使用标准库，br在安装了brotli、zstd在安装了zstandard时可用；
+以及压缩动态响应的ResponseCompressor（由web_app.compression_factory调用）
+'''
+
+
+def _gzip(data, level):
+	# mtime=0使同样的内容压缩结果相同
+	return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+# 可用的编码 名称 -> (压缩函数(data, level), 预压缩使用的level)，按优先级排列
+CODECS = {}
+
+try:
+	import brotli
+	CODECS['br'] = (lambda data, level: brotli.compress(data, quality=level), 11)
+except ImportError:
+	logging.debug('brotli is not installed, br encoding disabled')
+
+try:
+	import zstandard
+	CODECS['zstd'] = (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data), 19)
+except ImportError:
+	logging.debug('zstandard is not installed, zstd encoding disabled')
+
+CODECS['gzip'] = (_gzip, 9)
+# HTTP的deflate是zlib格式
+CODECS['deflate'] = (zlib.compress, 9)
+
+# 静态文件预压缩的编码，deflate和gzip重复，不生成
+PRECOMPRESSED = tuple(name for name in CODECS if name != 'deflate')
+
+# 各编码动态压缩时的默认level：压缩率和CPU时间的折中
+LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6, 'deflate': 6}
+
+
+def compress(encoding, data, level=None):
+	fn, best = CODECS[encoding]
+	return fn(data, best if level is None else level)
+
+
+def accepted_encodings(header):
+	'''Parse Accept-Encoding into {coding: q}, codings with q=0 are left out.
+	'''
+	accepted = {}
+	for part in (header or '').lower().split(','):
+		name, _, params = part.strip().partition(';')
+		if not name:
+			continue
+		q = 1.0
+		params = params.strip()
+		if params.startswith('q='):
+			try:
+				q = float(params[2:])
+			except ValueError:
+				q = 0.0
+		if q > 0:
+			accepted[name] = q
+	return accepted
+
+
+def negotiate(header, available):
+	'''Best coding in available (ordered by our preference) acceptable to the client, or None.
+	'''
+	if not header or not available:
+		return None
+	accepted = accepted_encodings(header)
+	best, best_q = None, 0.0
+	for name in available:
+		q = accepted.get(name, accepted.get('*', 0.0))
+		if q > best_q:
+			best, best_q = name, q
+	return best
+
+
+# 本身已经压缩过的类型，再压缩只浪费CPU；+xml结尾的(例如image/svg+xml)除外
+SKIP_TYPES = ('image/', 'video/', 'audio/', 'font/woff', 'application/zip', 'application/gzip', 'application/x-gzip',
+			  'application/pdf', 'application/octet-stream', 'application/wasm')
+
+
+class ResponseCompressor:
+	'''Compress dynamic responses according to Accept-Encoding.
+
+	Bodies smaller than min_size and content types in skip_types are sent as is.
+	Bodies of offload_size bytes or more are compressed on the executor, smaller
+	ones inline; streamed responses are compressed chunk by chunk by aiohttp.
+	'''
+
+	def __init__(self, encodings=None, levels=None, min_size=1024, offload_size=64 * 1024, skip_types=SKIP_TYPES, executor=None):
+		self.encodings = [e for e in (encodings or CODECS) if e in CODECS]
+		self.levels = dict(LEVELS, **(levels or {}))
+		self.min_size = min_size
+		self.offload_size = offload_size
+		self.skip_types = tuple(skip_types)
+		self.executor = executor
+		self.bytes_in = {e: 0 for e in self.encodings}
+		self.bytes_out = {e: 0 for e in self.encodings}
+		self.seconds = {e: metrics.Histogram() for e in self.encodings}
+		self.skipped = {}
+
+	def _skip(self, reason):
+		self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+	def compressible(self, content_type):
+		return not (content_type.startswith(self.skip_types) and not content_type.endswith('+xml'))
+
+	# 流式响应(StreamResponse)在prepare之前调用，由aiohttp逐块压缩；只支持gzip/deflate
+	def enable_stream(self, request, resp):
+		if 'no-transform' in resp.headers.get('Cache-Control', '') or not self.compressible(resp.content_type):
+			return None
+		resp.headers['Vary'] = _add_vary(resp.headers.get('Vary'))
+		encoding = negotiate(request.headers.get('Accept-Encoding'), [e for e in self.encodings if e in ('gzip', 'deflate')])
+		if encoding is not None:
+			resp.enable_compression(ContentCoding(encoding))
+		return encoding
+
+	async def __call__(self, request, resp):
+		if not isinstance(resp, web.Response):
+			return resp  # 流式响应、FileResponse
+		if resp.prepared or request.method == 'HEAD' or resp.status < 200 or resp.status in (204, 304):
+			return resp
+		if 'Content-Encoding' in resp.headers or 'no-transform' in resp.headers.get('Cache-Control', ''):
+			return resp
+		body = resp.body
+		if not isinstance(body, (bytes, bytearray)):
+			return resp
+		if len(body) < self.min_size:
+			self._skip('small')
+			return resp
+		if not self.compressible(resp.content_type):
+			self._skip('type')
+			return resp
+		resp.headers['Vary'] = _add_vary(resp.headers.get('Vary'))
+		encoding = negotiate(request.headers.get('Accept-Encoding'), self.encodings)
+		if encoding is None:
+			self._skip('identity')
+			return resp
+		level = self.levels.get(encoding)
+		start = time.perf_counter()
+		if self.executor is not None and len(body) >= self.offload_size:
+			try:
+				encoded = await self.executor.run(compress, encoding, bytes(body), level)
+			except APIBusyError:
+				# 压缩只是优化，忙的时候直接发送原文
+				self._skip('busy')
+				return resp
+		else:
+			encoded = compress(encoding, body, level)
+		self.seconds[encoding].observe(time.perf_counter() - start)
+		if len(encoded) >= len(body):
+			self._skip('larger')
+			return resp
+		self.bytes_in[encoding] += len(body)
+		self.bytes_out[encoding] += len(encoded)
+		resp.body = encoded
+		resp.headers['Content-Encoding'] = encoding
+		# 编码后的内容不同，强ETag要变成弱ETag
+		etag = resp.headers.get('ETag')
+		if etag and not etag.startswith('W/'):
+			resp.headers['ETag'] = 'W/' + etag
+		return resp
+
+	def stats(self):
+		return dict(
+			encodings={e: dict(
+				bytes_in=self.bytes_in[e],
+				bytes_out=self.bytes_out[e],
+				ratio=(self.bytes_out[e] / self.bytes_in[e]) if self.bytes_in[e] else 1.0,
+				seconds=self.seconds[e].stats()
+			) for e in self.encodings},
+			skipped=dict(self.skipped)
+		)
+
+
+def _add_vary(vary):
+	if not vary:
+		return 'Accept-Encoding'
+	if 'accept-encoding' in vary.lower():
+		return vary
+	return vary + ', Accept-Encoding'
+
+
+compressor = None
+
+
+# 根据configs.compression创建compressor，enabled为False时不压缩
+def setup(enabled=True, encodings=None, levels=None, min_size=1024, offload_size=64 * 1024, skip_types=SKIP_TYPES,
+		  workers=None, max_pending=64, queue_timeout=0.5):
+	global compressor
+	if compressor is not None and compressor.executor is not None:
+		compressor.executor.shutdown(wait=False)
+	compressor = None
+	if not enabled:
+		return None
+	missing = [e for e in encodings or () if e not in CODECS]
+	if missing:
+		logging.info('compression encodings not available: {}'.format(', '.join(missing)))
+	executor = BoundedExecutor('compression', 'thread', workers, max_pending, queue_timeout)
+	compressor = ResponseCompressor(encodings, levels, min_size, offload_size, skip_types, executor)
+	logging.info('response compression: {}'.format(', '.join(compressor.encodings)))
+	return compressor
+
+
+@metrics.register_collector
+def _collect():
+	if compressor is None:
+		return []
+	lines = []
+	for encoding in compressor.encodings:
+		label = 'encoding="%s"' % encoding
+		lines.append('compression_bytes_in_total{%s} %d' % (label, compressor.bytes_in[encoding]))
+		lines.append('compression_bytes_out_total{%s} %d' % (label, compressor.bytes_out[encoding]))
+		lines.extend(compressor.seconds[encoding].samples('compression_seconds', label))
+	for reason, n in compressor.skipped.items():
+		lines.append('compression_skipped_total{reason="%s"} %d' % (reason, n))
+	return lines
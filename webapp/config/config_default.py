@@ -8,16 +8,161 @@ __author__ = 'Adam Lee'
 
 configs = {
 	'debug': True,
+	'server': {
+		'host': 'localhost',
+		'port': 9000,
+		'workers': 1,  # worker进程数，0表示CPU核数
+		'reuse_port': True,  # 各worker用SO_REUSEPORT各自监听；不支持时由主进程监听并共享socket
+		'uvloop': True,  # 安装了uvloop时使用
+		'backlog': 128,
+		'shutdown_timeout': 30,  # 停止或滚动重启时等待进行中请求的秒数
+		'max_body_size': 1024 * 1024
+	},
+	'json': {
+		'backend': 'auto',
+		'stream_chunk_size': 500  # 列表超过这么多元素时分块流式输出
+	},
+	'template': {
+		'bytecode_cache': None,  # 目录，例如 '/tmp/awesome-jinja2'
+		'precompile': True,
+		'page_cache': {
+			'enabled': True,
+			'maxsize': 1000,
+			'ttl': 60
+		}
+	},
+	'admission': {
+		'enabled': True,
+		# 各优先级的默认限额；pool_wait_budget：连接池最近的平均等待(秒)超过它时直接返回503，None表示不看
+		'classes': {
+			'critical': {'concurrency': 64, 'queue': 256, 'queue_timeout': 5.0, 'pool_wait_budget': None},
+			'default': {'concurrency': 32, 'queue': 64, 'queue_timeout': 2.0, 'pool_wait_budget': 0.5},
+			'heavy': {'concurrency': 8, 'queue': 16, 'queue_timeout': 1.0, 'pool_wait_budget': 0.1}
+		},
+		# 路由(aiohttp的canonical路径) -> 优先级以及覆盖的限额；静态文件默认critical，其他默认default
+		'routes': {
+			'/api/login': {'priority': 'critical'},
+			'/api/register': {'priority': 'critical'},
+			'/api/password': {'priority': 'critical'},
+			'/': {'priority': 'heavy'},
+			'/api/users': {'priority': 'heavy'}
+		},
+		# 按客户端的令牌桶：每秒rate个，最多攒burst个，超出返回429
+		'rate_limits': {
+			'/api/login': {'rate': 1.0, 'burst': 10},
+			'/api/register': {'rate': 0.1, 'burst': 5},
+			'/api/password': {'rate': 0.1, 'burst': 5}
+		},
+		'retry_after': 1,  # 503的Retry-After(秒)
+		'max_clients': 10000,  # 令牌桶最多记录这么多客户端
+		'trust_forwarded': False  # 在反向代理后面时用X-Forwarded-For区分客户端
+	},
+	'logging': {
+		'level': 'INFO',
+		'format': 'text',  # 或 'json'：每行一个JSON对象，带request_id和extra字段
+		'file': None,  # None表示stderr；文件用WatchedFileHandler，可以配合logrotate
+		'background': True,  # 记录放进队列，由后台线程格式化和写出
+		'queue_size': 10000,  # 队列满时丢弃并计数(log_dropped_total)
+		'levels': {  # 分类日志的级别，没有列出的(例如webapp.access)跟随level
+			'webapp.sql': 'WARNING',  # 'INFO'输出每条SQL，'DEBUG'还输出返回的行数
+			'webapp.auth': 'WARNING',
+			'aiohttp.access': 'WARNING'  # 已经由webapp.access代替
+		},
+		'access': {
+			'sample': 1.0,  # 访问日志的采样比例；错误和慢请求总是记录
+			'max_per_second': 0,  # 每秒最多记录多少条，0表示不限
+			'slow': 0.5  # 秒
+		}
+	},
+	'conditional': {
+		'body_etag': True,  # 没有@freshness的GET响应用响应体摘要作ETag，可以省下传输(但不省计算)
+		'cache_control': 'private, no-cache'  # 带ETag的动态响应：只能由浏览器缓存，每次使用前验证
+	},
+	'compression': {
+		'enabled': True,
+		'encodings': ['br', 'zstd', 'gzip', 'deflate'],  # 按优先级；br、zstd需要安装brotli、zstandard
+		'levels': {'br': 4, 'zstd': 3, 'gzip': 6, 'deflate': 6},
+		'min_size': 1024,  # 小于这个字节数不压缩
+		'offload_size': 64 * 1024,  # 达到这个字节数的响应放到线程池里压缩
+		'workers': None,
+		'max_pending': 64,
+		'queue_timeout': 0.5  # 线程池忙时最多等这么久，然后不压缩直接发送
+	},
+	'static': {
+		'path': None,  # None表示webapp/static
+		'prefix': '/static/',
+		'precompress': True,  # 启动时为文本类文件生成gzip/br版本
+		'build_dir': None,  # 预压缩文件的目录(以0700创建)，None表示webapp/.static-build
+		'min_compress_size': 256,
+		'max_age': 0,  # 不带指纹的URL的缓存时间；带指纹的URL总是一年且immutable
+		'watch': None,  # 文件变化时重新计算，None表示跟随debug
+		'hot': {
+			'maxsize': 256,  # 内存中缓存的文件数
+			'max_file_size': 64 * 1024  # 更大的文件用sendfile发送
+		}
+	},
 	'db': {
 		'host': 'localhost',
 		'port': 3306,
 		'user': 'root',
 		'password': 'root123',
-		'db': 'awesome'
+		'db': 'awesome',
+		'replicas': [],  # 只读从库，例如 [{'host': '10.0.0.2'}, {'host': '10.0.0.3', 'port': 3307}]
+		'balance': 'round_robin',  # 或 'least_busy'
+		'read_your_writes': 1.0,  # 写库后这么多秒内，同一请求的读仍走主库
+		'health_check_interval': 5.0,
+		'maxsize': 10,  # 多个worker时为所有worker合计，每个worker分到其中一份
+		'minsize': 1,
+		'max_lifetime': 3600,  # 连接最长使用时间（秒），到期后关闭重建
+		'pre_ping_idle': 30,  # 空闲超过这么多秒的连接，借出前先ping
+		'adaptive': {
+			'enabled': False,
+			'min': 1,
+			'max': 20,
+			'grow_wait': 0.02,  # 平均等待超过20ms时扩大连接池
+			'shrink_wait': 0.001,
+			'interval': 5.0
+		}
+	},
+	'profiler': {
+		'enabled': False,  # None表示跟随debug；/debug/sql、/debug/queries只对admin开放
+		'options': {
+			'slow': 0.2,  # 慢查询阈值（秒）
+			'n_plus_one': 3,
+			'history': 50
+		}
+	},
+	'metrics': {
+		'enabled': False,
+		'path': '/metrics'
+	},
+
+	'query_cache': {
+		'enabled': True,
+		'maxsize': 10000,
+		'backend': None  # 共享的后端：CacheBackend或者'redis://host:6379/0'；多worker时没有配置则不启用查询缓存
+	},
+
+	'passwords': {
+		'scheme': 'scrypt',  # 或 'pbkdf2_sha256'；旧的sha1摘要在登录成功时自动升级
+		'scrypt': {'n': 2 ** 14, 'r': 8, 'p': 1},
+		'pbkdf2_sha256': {'iterations': 600000},
+		'executor': 'thread',  # hashlib计算时释放GIL，线程池即可并行；也可以用 'process'
+		'workers': None,  # None表示CPU核数
+		'max_pending': 64,  # 排队和计算中的哈希上限，超出后等待queue_timeout秒再返回server:busy
+		'queue_timeout': 5.0
 	},
 
 	'session': {
-		'secret': 'Awesome'
+		'secret': 'Awesome',
+		'format': 'token',  # 'token'：HMAC-SHA256签名的无状态token；'legacy'：id-expires-sha1，两种cookie都会被接受
+		'keys': [],  # token签名密钥，例如 [{'id': '2024b', 'secret': '...'}, {'id': '2024a', 'secret': '...'}]，第一个用于签发；为空时用secret
+		'cache': {
+			'maxsize': 10000,
+			'ttl': 300,
+			# 缓存在进程内，一个worker里的撤销其他worker看不到；多个worker时ttl缩短到这么多秒
+			'prefork_ttl': 2
+		}
 	}
 
 }
@@ -1,12 +1,11 @@
 import hashlib
 import time
-import logging
 
 from webapp.config.config import configs
 from webapp.models import User
-
-
-logging.basicConfig(level=logging.INFO)
+from webapp.cookie import session_token
+from webapp.cookie.session_cache import session_cache, on_user_changed
+from webapp.logs import auth_log
 
 
 ''''Manage cookie.
@@ -16,18 +15,42 @@ __author__ = 'Adam Lee'
 _COOKIE_KEY = configs.session.secret
 COOKIE_NAME = 'awesession'
 
+User.add_listener(on_user_changed)
+User.add_listener(session_token.on_user_changed)
+
+
+# 根据configs.session.cache设置两个会话缓存；prefork_ttl由server在多worker时使用
+def setup(maxsize=10000, ttl=300, prefork_ttl=2):
+	session_cache.configure(maxsize, ttl)
+	session_token.generations.configure(maxsize, ttl)
+
 
-# 根据用户信息设置cookie
+# 旧格式cookie的签名：用会话代数而不是密码摘要，重新哈希密码不会让cookie失效
+def _legacy_sha1(uid, gen, expires):
+	key = '{}-{}-{}-{}'.format(uid, gen, expires, _COOKIE_KEY)
+	return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+# 根据用户信息设置cookie；configs.session.format为'legacy'时仍签发旧格式
 def user2cookie(user, max_age):
 	'''Generate cookie str by user.
 	'''
+	if configs.session.get('format', 'token') == 'token':
+		return session_token.issue(user, max_age)
 	# build cookie string by: id-expires-sha1
 	expires = str(int(time.time() + max_age))
-	key = '{}-{}-{}-{}'.format(user.id, user.password, expires, _COOKIE_KEY)
-	cookies = [user.id, expires, hashlib.sha1(key.encode('utf-8')).hexdigest()]
+	gen = session_token.generation(user.session_version, user.admin)
+	cookies = [user.id, expires, _legacy_sha1(user.id, gen, expires)]
 	return '-'.join(cookies)
 
 
+# 之前签发的旧cookie用密码摘要签名；用户的会话从未被撤销过时仍然接受
+def _signed_with_password(user, expires, sha1):
+	if user.session_version:
+		return False
+	return sha1 == _legacy_sha1(user.id, user.password, expires)
+
+
 # 解析cookie
 async def cookie2user(cookie_str):
 	'''Parse cookie and load user if cookie is valid.
@@ -36,21 +59,62 @@ async def cookie2user(cookie_str):
 	if not cookie_str:
 		return None
 	try:
+		if session_token.is_token(cookie_str):
+			return await token2user(cookie_str)
 		cookies = cookie_str.split('-')
 		if len(cookies) != 3:
 			return None
 		(uid, expires, sha1) = cookies
 		if int(expires) < time.time():
 			return None
-		user = await User.find(uid)
+		user = session_cache.get(cookie_str)
+		if user is not None:
+			return user
+		user = await User.find(uid, primary=True)
 		if user is None:
 			return None
-		key = '{}-{}-{}-{}'.format(user.id, user.password, expires, _COOKIE_KEY)
-		if sha1 != hashlib.sha1(key.encode('utf-8')).hexdigest():
-			logging.info('invalid sha1')
+		gen = session_token.generation(user.session_version, user.admin)
+		if session_token.generations.offer(uid, user.session_version, user.admin) != gen:
+			auth_log.info('user %s changed while loading the session', uid)
+			return None
+		if sha1 != _legacy_sha1(user.id, gen, expires) and not _signed_with_password(user, expires, sha1):
+			auth_log.info('invalid sha1')
 			return None
 		user.password = '******'
+		session_cache.put(cookie_str, user, gen, expires)
 		return user
 	except Exception as e:
-		logging.info(e)
+		auth_log.info('invalid session cookie: %s', e)
+		return None
+
+
+# 验证签名token：只在用户的会话代数不在缓存中时才查一次数据库
+async def token2user(token):
+	claims = session_token.parse(token)
+	if claims is None:
+		return None
+	uid = claims['id']
+	gen = session_token.generations.get(uid)
+	if gen is None:
+		user = await User.find(uid, primary=True)
+		if user is None:
+			return None
+		gen = session_token.generations.offer(uid, user.session_version, user.admin)
+	if gen != claims['gen']:
+		auth_log.info('revoked session token of user %s', uid)
+		return None
+	return User(id=uid, name=claims['name'], email=claims['email'], image=claims['image'], admin=claims['admin'], password='******')
+
+
+# 使用户已签发的所有会话失效，同时写入changes(例如新的password)；
+# 修改密码、修改admin、退出所有设备时调用。返回更新后的user，用户不存在时返回None
+async def revoke_sessions(uid, **changes):
+	user = await User.find(uid, primary=True)
+	if user is None:
 		return None
+	for key, value in changes.items():
+		setattr(user, key, value)
+	user.session_version = (user.session_version or 0) + 1
+	await user.update()
+	auth_log.info('revoked sessions of user %s', uid)
+	return user
@@ -0,0 +1,100 @@
+import time
+import logging
+
+from webapp.cache import LRUCache
+from webapp.config.config import configs
+from webapp.cookie.session_token import generation, generations
+
+
+''''Cache verified session cookies so auth does not hit MySQL on every request.
+'''
+__author__ = 'Adam Lee'
+
+
+# 会话缓存
+class SessionCache:
+	'''Map a verified cookie string to its user.
+
+	Entries never outlive the cookie's own expires field, and are dropped when
+	the cached user's session generation (session_version, admin) changes. Each get() returns a new
+	user object, so a handler modifying request.__user__ cannot affect others.
+	'''
+
+	def __init__(self, maxsize=10000, ttl=300):
+		self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+		self._maxsize = maxsize
+		# uid -> 该用户的cookie，失效时不用扫描整个缓存；被LRU淘汰的cookie在这里顺便清掉
+		self._by_user = {}
+
+	def get(self, cookie_str):
+		entry = self._cache.get(cookie_str)
+		if entry is None:
+			return None
+		cls, data, gen = entry
+		# 放入之后才知道的更新的代数(写入的监听器与加载并发时)，按失效处理
+		current = generations.get(data['id'])
+		if current is not None and current != gen:
+			self._cache.pop(cookie_str)
+			return None
+		return cls(**data)
+
+	def put(self, cookie_str, user, gen, expires):
+		# 缓存的是已经屏蔽密码的user的快照，额外记下会话代数用于失效判断
+		self._cache.set(cookie_str, (type(user), dict(user), gen), expires_at=float(expires))
+		keys = self._by_user.setdefault(user.id, set())
+		keys.add(cookie_str)
+		if len(keys) > 1:
+			keys.intersection_update([k for k in keys if k in self._cache])
+		if self._maxsize > 0 and len(self._by_user) > 2 * self._maxsize:
+			self._reindex()
+
+	def _reindex(self):
+		self._by_user = {}
+		for key, entry in self._cache.items():
+			self._by_user.setdefault(entry[1]['id'], set()).add(key)
+
+	def invalidate_user(self, uid, gen=None):
+		'''Drop cached sessions of uid, or only those of another generation when gen is given.
+		'''
+		keys = self._by_user.pop(uid, None)
+		if not keys:
+			return 0
+		count = 0
+		kept = set()
+		for key in keys:
+			entry = self._cache.get(key, count=False)
+			if entry is None:
+				continue
+			if gen is None or entry[2] != gen:
+				self._cache.pop(key)
+				count += 1
+			else:
+				kept.add(key)
+		if kept:
+			self._by_user[uid] = kept
+		if count:
+			logging.info('invalidated {} cached session(s) of user {}'.format(count, uid))
+		return count
+
+	def configure(self, maxsize, ttl):
+		self.clear()
+		self._cache.maxsize = self._maxsize = maxsize
+		self._cache.ttl = ttl
+
+	def clear(self):
+		self._cache.clear()
+		self._by_user.clear()
+
+	def stats(self):
+		return self._cache.stats()
+
+
+session_cache = SessionCache(maxsize=configs.session.cache.maxsize, ttl=configs.session.cache.ttl)
+
+
+# User写入后的回调：会话代数变化时使缓存失效
+def on_user_changed(action, user):
+	if action == 'remove' or user.getvalue('session_version') is None:
+		session_cache.invalidate_user(user.id)
+	else:
+		session_cache.invalidate_user(user.id, generation(user.getvalue('session_version'), user.getvalue('admin')))
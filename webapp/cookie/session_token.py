@@ -0,0 +1,140 @@
+import hmac
+import time
+import base64
+import hashlib
+import logging
+
+from webapp import json_codec
+from webapp.cache import LRUCache
+from webapp.config.config import configs
+
+
+''''Stateless session tokens signed with HMAC-SHA256.
+
+    2.<key id>.<base64url(json claims)>.<base64url(signature)>
+
+The claims carry the user's id, display fields and admin flag, so a request can
+be authenticated without loading the user. Each token also carries the user's
+session generation, made of the user's session_version and admin flag: bumping
+the version or changing the flag revokes every token issued before. Password
+changes go through cookie_manage.revoke_sessions, which bumps the version;
+rehashing the stored password does not, so it keeps users logged in.
+'''
+__author__ = 'Adam Lee'
+
+PREFIX = '2.'
+
+
+def _b64encode(data):
+	return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+	return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+# 签名密钥：configs.session.keys的第一个用于签发，其余的仍可验证，用于轮换；
+# configs.session.secret作为id为'0'的密钥一直可以验证，没有配置keys时也用它签发
+def _keys():
+	keys = [(str(k['id']), k['secret'].encode('utf-8')) for k in configs.session.get('keys') or []]
+	if not any(kid == '0' for kid, _ in keys):
+		keys.append(('0', configs.session.secret.encode('utf-8')))
+	return keys
+
+
+def _sign(secret, message):
+	return hmac.new(secret, message.encode('ascii'), hashlib.sha256).digest()
+
+
+def generation(session_version, admin):
+	return '{}.{}'.format(int(session_version or 0), int(bool(admin)))
+
+
+def is_token(cookie_str):
+	return cookie_str.startswith(PREFIX)
+
+
+def issue(user, max_age):
+	'''Sign a token for user, which must carry the stored session_version.
+	'''
+	kid, secret = _keys()[0]
+	claims = dict(
+		id=user.id,
+		name=user.name,
+		email=user.email,
+		image=user.image,
+		admin=bool(user.admin),
+		gen=generation(user.session_version, user.admin),
+		exp=int(time.time() + max_age)
+	)
+	message = '{}{}.{}'.format(PREFIX, kid, _b64encode(json_codec.dumps(claims)))
+	return '{}.{}'.format(message, _b64encode(_sign(secret, message)))
+
+
+def parse(token):
+	'''Return the claims of a validly signed, unexpired token, otherwise None.
+	'''
+	try:
+		message, signature = token.rsplit('.', 1)
+		_, kid, payload = message.split('.')
+		secret = dict(_keys()).get(kid)
+		if secret is None:
+			logging.info('unknown session key: {}'.format(kid))
+			return None
+		if not hmac.compare_digest(_sign(secret, message), _b64decode(signature)):
+			logging.info('invalid session token signature')
+			return None
+		claims = json_codec.loads(_b64decode(payload))
+	except (ValueError, UnicodeError):
+		return None
+	if claims.get('exp', 0) < time.time():
+		return None
+	return claims
+
+
+# 各用户当前的会话代数；缓存未命中时由调用方从数据库加载
+class Generations:
+	def __init__(self, maxsize=10000, ttl=300):
+		# uid -> (session_version, generation)
+		self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+	def get(self, uid):
+		entry = self._cache.get(uid)
+		return None if entry is None else entry[1]
+
+	# 写入之后的值，直接覆盖
+	def set(self, uid, session_version, admin):
+		self._cache.set(uid, (int(session_version or 0), generation(session_version, admin)))
+
+	def offer(self, uid, session_version, admin):
+		'''Store a generation read from the database, unless one at least as new is
+		already known: the write listener may have run while the read was in flight.
+		Return the current generation.
+		'''
+		entry = self._cache.get(uid, count=False)
+		if entry is not None and entry[0] >= int(session_version or 0):
+			return entry[1]
+		self.set(uid, session_version, admin)
+		return generation(session_version, admin)
+
+	def discard(self, uid):
+		self._cache.pop(uid)
+
+	def configure(self, maxsize, ttl):
+		self._cache.clear()
+		self._cache.maxsize = maxsize
+		self._cache.ttl = ttl
+
+	def stats(self):
+		return self._cache.stats()
+
+
+generations = Generations(maxsize=configs.session.cache.maxsize, ttl=configs.session.cache.ttl)
+
+
+# User写入后的回调：更新会话代数，旧代数的token随之失效
+def on_user_changed(action, user):
+	if action == 'remove' or user.getvalue('session_version') is None:
+		generations.discard(user.id)
+	else:
+		generations.set(user.id, user.getvalue('session_version'), user.getvalue('admin'))
@@ -1,9 +1,9 @@
-import logging, asyncio, inspect, os, functools
-from urllib import parse
+import logging, asyncio, inspect, os, functools, hashlib
 from aiohttp import web
+from webapp import json_codec, static_assets
 from webapp.api_error import APIError
+from webapp.logs import Redacted
 
-logging.basicConfig(level=logging.INFO)
 __author__ = 'Adam Lee'
 
 '''Web框架模块
@@ -38,6 +38,42 @@ def post(path):
 	return decorator
 
 
+def cache_page(ttl=None, vary=()):
+	''' Define decorator @cache_page(ttl=60, vary=('page',)) for GET template handlers.
+
+	The rendered page is cached per route, per value of the query args named in
+	vary, and per signed-in user (or anonymous).
+	'''
+
+	def decorator(func):
+		func.__page_cache__ = dict(ttl=ttl, vary=tuple(vary))
+		return func
+	return decorator
+
+
+def freshness(key_func):
+	''' Define decorator @freshness(key_func) for GET handlers.
+
+	key_func(request) returns a cheap version stamp of the data the handler would
+	return (e.g. max(created_at) of its rows), or None when unknown; it may also
+	return (version, last_modified) with last_modified a unix timestamp. A number
+	is used as both. When If-None-Match / If-Modified-Since match, response_factory
+	answers 304 without calling the handler.
+	'''
+
+	def decorator(func):
+		func.__freshness__ = key_func
+		return func
+	return decorator
+
+
+def no_compress(func):
+	''' Define decorator @no_compress to send the handler's responses uncompressed.
+	'''
+	func.__compress__ = False
+	return func
+
+
 def has_request_arg(fn):
 	sign = inspect.signature(fn)
 	params = sign.parameters
@@ -83,74 +119,229 @@ def get_required_kw_args(fn):
 	return tuple(args)
 
 
-# 请求管理类
-class RequestHandler:
-	def __init__(self, app, fn):
-		self._app = app
-		self._func = fn
-		self._has_request_arg = has_request_arg(fn)
-		self._has_var_kw_arg = has_var_kw_arg(fn)
-		self._has_named_kw_args = has_named_kw_args(fn)
-		self._named_kw_args = get_named_kw_args(fn)
-		self._required_kw_args = get_required_kw_args(fn)
+_NOT_PARSED = object()
 
-	async def __call__(self, request):
-		kw = None
-		if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-			if request.method == 'POST':
-				if not request.content_type:
-					return web.HTTPBadRequest('Missing Content-Type.')
-				ct = request.content_type.lower()
-				if ct.startswith('application/json'):
-					params = await request.json()
-					if not isinstance(params, dict):
-						return web.HTTPBadRequest('JSON body must be object.')
-					kw = params
-				elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-					params = await request.post()
-					kw = dict(**params)
-				else:
-					return web.HTTPBadRequest('Unsupported Content-Type: {}'.format(request.content_type))
-			if request.method == 'GET':
-				qs = request.query_string
-				if qs:
-					kw = dict()
-					for key, value in parse.parse_qs(qs, True).items():
-						kw[key] = value[0]
-
-		if kw is None:
-			kw = dict(**request.match_info)
+# 请求体大小上限（字节），None表示不限制
+max_body_size = None
+
+
+def is_json(content_type):
+	return content_type.startswith('application/json')
+
+
+def is_form(content_type):
+	return content_type.startswith('application/x-www-form-urlencoded') or content_type.startswith('multipart/form-data')
+
+
+def check_body_size(request):
+	if max_body_size is not None and request.content_length is not None and request.content_length > max_body_size:
+		raise web.HTTPRequestEntityTooLarge(max_size=max_body_size, actual_size=request.content_length)
+
+
+# 解析请求体，每个请求最多解析一次，结果缓存在request.__data__
+async def parse_body(request):
+	'''Return the decoded body: JSON value, form MultiDict, or None for other content types.
+	'''
+	data = getattr(request, '__data__', _NOT_PARSED)
+	if data is not _NOT_PARSED:
+		return data
+	check_body_size(request)
+	ct = request.content_type.lower()
+	if is_json(ct):
+		body = await request.read()
+		try:
+			data = json_codec.loads(body) if body else None
+		except ValueError:
+			raise web.HTTPBadRequest(text='Invalid JSON body.')
+	elif is_form(ct):
+		data = await request.post()
+	else:
+		data = None
+	request.__data__ = data
+	return data
+
+
+def _to_bool(value):
+	if isinstance(value, bool):
+		return value
+	return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+_CONVERTERS = {int: int, float: float, str: str, bool: _to_bool}
+
+
+def get_arg_converters(fn):
+	'''Map parameter name -> converter for params annotated with int/float/str/bool.
+	'''
+	converters = []
+	params = inspect.signature(fn).parameters
+	for name, param in params.items():
+		conv = _CONVERTERS.get(param.annotation)
+		if conv is not None and name != 'request':
+			converters.append((name, conv))
+	return tuple(converters)
+
+
+def _convert(kw, converters):
+	for name, conv in converters:
+		if name in kw:
+			try:
+				kw[name] = conv(kw[name])
+			except (TypeError, ValueError):
+				return web.HTTPBadRequest(text='Invalid argument: {}'.format(name))
+	return None
+
+
+# 根据处理函数的签名编译参数绑定器，每个handler只在add_route时编译一次
+def compile_binder(fn):
+	'''Return async bind(request) -> kw dict (or an error response) specialised for fn.
+	'''
+	params = inspect.signature(fn).parameters
+	need_request = has_request_arg(fn)
+	need_var_kw = bool(has_var_kw_arg(fn))
+	named_kw_args = get_named_kw_args(fn)
+	required_kw_args = get_required_kw_args(fn)
+	converters = get_arg_converters(fn)
+	positional = [name for name, param in params.items() if name != 'request' and param.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)]
+
+	# 无参数：不触碰请求
+	if not need_var_kw and not named_kw_args and not positional:
+		if need_request:
+			async def bind(request):
+				return {'request': request}
+		else:
+			async def bind(request):
+				return {}
+		return bind
+
+	# 只取路径参数
+	if not need_var_kw and not named_kw_args:
+		async def bind(request):
+			kw = dict(request.match_info)
+			if converters:
+				error = _convert(kw, converters)
+				if error is not None:
+					return error
+			if need_request:
+				kw['request'] = request
+			return kw
+		return bind
+
+	# 需要读取query string或者请求体
+	async def bind(request):
+		params = None
+		if request.method == 'POST':
+			if not request.content_type:
+				return web.HTTPBadRequest(text='Missing Content-Type.')
+			ct = request.content_type.lower()
+			if is_json(ct):
+				params = await parse_body(request)
+				if not isinstance(params, dict):
+					return web.HTTPBadRequest(text='JSON body must be object.')
+			elif is_form(ct):
+				params = await parse_body(request)
+			else:
+				return web.HTTPBadRequest(text='Unsupported Content-Type: {}'.format(request.content_type))
+		elif request.method == 'GET' and request.query_string:
+			params = request.query
+
+		# 只取出命名参数，不复制整个请求体；缓存的请求体不会被修改
+		if params is None:
+			kw = dict(request.match_info)
 		else:
-			if not self._has_var_kw_arg and self._named_kw_args:
-				# remove all unamed kw:
-				copy = dict()
-				for name in self._named_kw_args:
-					if name in kw:
-						copy[name] = kw[name]
-				kw = copy
+			if need_var_kw:
+				kw = dict(params)
+			else:
+				kw = {name: params[name] for name in named_kw_args if name in params}
 			# check named arg:
 			for key, value in request.match_info.items():
 				if key in kw:
-					logging.debug('Duplicate arg name in named arg and kw args: {}'.format(key))
+					logging.debug('Duplicate arg name in named arg and kw args: %s', key)
 				kw[key] = value
-		if self._has_request_arg:
+		if converters:
+			error = _convert(kw, converters)
+			if error is not None:
+				return error
+		if need_request:
 			kw['request'] = request
 		# check required kw
-		if self._required_kw_args:
-			for name in self._required_kw_args:
-				if name not in kw:
-					return web.HTTPBadRequest('Missing argument: {}'.format(name))  # 此处应该抛出参数错误
-		logging.info('call with args: {}'.format(str(kw)))
+		for name in required_kw_args:
+			if name not in kw:
+				return web.HTTPBadRequest(text='Missing argument: {}'.format(name))
+		return kw
+	return bind
+
+
+# 请求管理类
+class RequestHandler:
+	def __init__(self, app, fn):
+		self._app = app
+		self._func = fn
+		self._bind = compile_binder(fn)
+		self.page_cache = getattr(fn, '__page_cache__', None)
+		self.compress = getattr(fn, '__compress__', True)
+		self.freshness = getattr(fn, '__freshness__', None)
+
+	async def __call__(self, request):
+		kw = await self._bind(request)
+		if isinstance(kw, web.StreamResponse):
+			return kw
+		logging.debug('call with args: %s', Redacted(kw))
 		try:
 			return await self._func(**kw)
 		except APIError as e:
 			return dict(error=e.error, data=e.data, message=e.message)
 
 
-def add_static(app):
-	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-	app.router.add_static('/static/', path)
-	logging.info('add static {} => {}'.format('/static/', path))
+# 静态文件由static_assets处理：清单、预压缩、ETag和内存缓存
+def add_static(app, **kw):
+	return static_assets.setup(app, **kw)
+
+
+# 静态文件的请求，日志、认证等中间件直接跳过
+def is_static(request):
+	return getattr(request.match_info.handler, '__static__', False)
+
+
+# 弱ETag：响应体或版本戳的摘要
+def make_etag(data):
+	if isinstance(data, str):
+		data = data.encode('utf-8')
+	return 'W/"{}"'.format(hashlib.sha1(data).hexdigest()[:16])
+
+
+def _opaque_tag(etag):
+	return etag[2:] if etag.startswith('W/') else etag
+
+
+# 客户端缓存的版本是否仍然有效：有If-None-Match时只看它(弱比较)，否则看If-Modified-Since
+def is_fresh(request, etag, last_modified=None):
+	if request.method not in ('GET', 'HEAD'):
+		return False
+	if_none_match = request.headers.get('If-None-Match')
+	if if_none_match is not None:
+		tags = [_opaque_tag(t.strip()) for t in if_none_match.split(',')]
+		return '*' in tags or _opaque_tag(etag) in tags
+	if last_modified is not None and request.if_modified_since is not None:
+		return int(last_modified) <= request.if_modified_since.timestamp()
+	return False
+
+
+# 没有用@no_compress关闭压缩的路由
+def wants_compression(request):
+	return getattr(request.match_info.handler, 'compress', True)
+
+
+# 代替已移除的asyncio.coroutine：普通函数(包括@get/@post包装过的协程函数)包装成协程函数，
+# 返回值是awaitable时等待它；inspect.signature会沿__wrapped__取到原函数的参数
+def _as_coroutine(fn):
+	@functools.wraps(fn)
+	async def wrapper(*args, **kw):
+		result = fn(*args, **kw)
+		if inspect.isawaitable(result):
+			result = await result
+		return result
+	return wrapper
 
 
 def add_route(app, fn):
@@ -158,10 +349,19 @@ def add_route(app, fn):
 	path = getattr(fn, '__route__', None)
 	if path is None or method is None:
 		raise ValueError('@get or @post not defined in {}.'.format(str(fn)))
-	if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-		fn = asyncio.coroutine(fn)
+	if not asyncio.iscoroutinefunction(fn):
+		fn = _as_coroutine(fn)
 	logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-	app.router.add_route(method, path, RequestHandler(app, fn))
+	app.router.add_route(method, path, _route_handler(RequestHandler(app, fn)))
+
+
+# aiohttp只把协程函数当作新式handler，其他可调用对象会被包一层并要求直接返回StreamResponse，
+# 而RequestHandler可以返回dict/str交给response_factory；page_cache等属性经functools.wraps复制过来
+def _route_handler(handler):
+	@functools.wraps(handler)
+	async def route(request):
+		return await handler(request)
+	return route
 
 
 def add_routes(app, module_name):
@@ -169,7 +369,7 @@ def add_routes(app, module_name):
 	if index == (-1):
 		mod = __import__(module_name, globals(), locals())
 	else:
-		name = module_name[index + 1]
+		name = module_name[index + 1:]
 		mod = getattr(__import__(module_name[:index], globals(), locals(), [name]), name)
 
 	for attr in dir(mod):
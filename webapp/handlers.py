@@ -1,28 +1,45 @@
-import hashlib
 import re
-import json
-import logging
 from aiohttp import web
 
-from webapp.api_error import APIValueError, APIError
-from webapp.cookie.cookie_manage import COOKIE_NAME, user2cookie
-from webapp.core_web import get, post
+from webapp import json_codec, passwords
+from webapp.async_orm import read_primary
+from webapp.api_error import APIValueError, APIError, APIPermissionError
+from webapp.cookie.cookie_manage import COOKIE_NAME, user2cookie, revoke_sessions
+from webapp.core_web import get, post, cache_page, freshness
+from webapp.logs import auth_log
 from webapp.models import User, next_id
 
 
-logging.basicConfig(level=logging.INFO)
+# 用户列表的版本：用户数 + 最近一次写入的时间，注册、修改、删除都会改变它
+async def _users_version(request):
+	count, updated_at = await User.findVersion('updated_at')
+	return '{}-{}'.format(count, updated_at), updated_at
+
 
 @get('/')
+@cache_page(ttl=30)
+@freshness(_users_version)
 async def index_test():
-	users = await User.findAll()
+	users = await User.findAll(compact=True)
 	return {'__template__': 'html_test.html', 'users': users}
 
 
+# 用户列表只返回公开的字段，不包含密码摘要和邮箱
+_PUBLIC_USER_FIELDS = ('id', 'name', 'image', 'created_at')
+
+
 # 用户列表API
 @post('/api/users')
 async def api_get_users():
-	users = await User.findAll(orderBy='created_at desc')
-	return dict(users=users)
+	users = await User.findAll(orderBy='created_at desc', compact=True)
+	return dict(users=[{k: u[k] for k in _PUBLIC_USER_FIELDS} for u in users])
+
+
+# 轮询用的GET版本，数据没变时返回304
+@get('/api/users')
+@freshness(_users_version)
+async def api_list_users():
+	return await api_get_users()
 
 # 邮件地址正则匹配
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
@@ -41,20 +58,20 @@ async def api_register_user(*, email, name, password):
 
 	if not password or not _RE_PW.match(password):
 		raise APIValueError('password')
-	users = await User.findAll('email=?', [email])
+	with read_primary():
+		users = await User.findAll('email=?', [email])
 	if len(users) > 0:
 		raise APIError('register:failed', 'email', 'Email is already in use.')
 
 	uid = next_id()
-	sha1_pw = '{}:{}'.format(uid, password)
-	user = User(id=uid, name=name.strip(), email=email, password=hashlib.sha1(sha1_pw.encode('utf-8')).hexdigest(), image='')
+	user = User(id=uid, name=name.strip(), email=email, password=await passwords.hash_password(password), image='')
 	await user.save()
 	# make session cookie:
 	response = web.Response()
 	response.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)  # 此处设置cookie
 	user.password = '******'  # 密码不显示
 	response.content_type = 'application/json'
-	response.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+	response.body = json_codec.dumps(user)
 	return response
 
 
@@ -67,24 +84,49 @@ async def login(*, email, password):
 	if not password:
 		raise APIValueError('password', 'Invalid password.')
 
-	users = await User.findAll('email=?', [email])
+	# 密码刚修改过时从库可能还是旧的摘要
+	with read_primary():
+		users = await User.findAll('email=?', [email])
 
 	if len(users) == 0:
 		raise APIValueError('email', 'Email not exist.')
 	user = users[0]
 	# check passwd:
-	sha1 = hashlib.sha1()
-	sha1.update(user.id.encode('utf-8'))
-	sha1.update(b':')
-	sha1.update(password.encode('utf-8'))
-	if user.password != sha1.hexdigest():
+	ok, needs_rehash = await passwords.verify_password(password, user.password, user.id)
+	if not ok:
 		raise APIValueError('password', 'Invalid password.')
+	if needs_rehash:
+		# 旧的sha1摘要或过时的参数，换成当前的算法
+		user.password = await passwords.hash_password(password)
+		await user.update()
 	# authenticate ok, set cookie:
 	response = web.Response()
 	response.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
 	user.password = '******'
 	response.content_type = 'application/json'
-	response = json.dumps(user, ensure_ascii=False).encode('utf-8')
+	response.body = json_codec.dumps(user)
+	return response
+
+
+# 修改密码：之前签发的cookie全部失效(包括其他设备上的)，当前请求换发新的cookie
+@post('/api/password')
+async def api_change_password(request, *, old_password, password):
+	if request.__user__ is None:
+		raise APIPermissionError('Please sign in first.')
+	if not password or not _RE_PW.match(password):
+		raise APIValueError('password')
+	user = await User.find(request.__user__.id, primary=True)
+	if user is None:
+		raise APIPermissionError('Please sign in first.')
+	ok, _ = await passwords.verify_password(old_password or '', user.password, user.id)
+	if not ok:
+		raise APIValueError('old_password', 'Invalid password.')
+	user = await revoke_sessions(user.id, password=await passwords.hash_password(password))
+	response = web.Response()
+	response.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
+	user.password = '******'
+	response.content_type = 'application/json'
+	response.body = json_codec.dumps(user)
 	return response
 
 
@@ -93,7 +135,7 @@ def logout(request):
 	referer = request.headers.get('Referer')
 	found = web.HTTPFound(referer or '/')
 	found.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
-	logging.info('user signed out.')
+	auth_log.info('user signed out.')
 	return found
 
 
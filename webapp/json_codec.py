@@ -0,0 +1,115 @@
+import json
+import logging
+import datetime
+import decimal
+
+__author__ = 'Adam Lee'
+
+'''JSON编解码：优先使用orjson/ujson，没有安装时回退到标准库json
+'''
+
+
+def _stdlib_loads(data):
+	if isinstance(data, (bytes, bytearray)):
+		data = data.decode('utf-8')
+	return json.loads(data)
+
+
+# 编码时不认识的对象：async_orm.Row、日期时间、Decimal等
+def _default(ob):
+	if hasattr(ob, '_asdict'):
+		return ob._asdict()
+	if isinstance(ob, (datetime.datetime, datetime.date, datetime.time)):
+		return ob.isoformat()
+	if isinstance(ob, decimal.Decimal):
+		return float(ob)
+	if isinstance(ob, (set, frozenset, tuple)):
+		return list(ob)
+	if hasattr(ob, '__dict__'):
+		return ob.__dict__
+	raise TypeError('Object of type {} is not JSON serializable'.format(type(ob).__name__))
+
+
+_stdlib_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default)
+
+
+def _stdlib_dumps(obj):
+	return _stdlib_encoder.encode(obj).encode('utf-8')
+
+
+# 可用的后端 (名称, loads, dumps)，按优先级排列；dumps均返回bytes
+_BACKENDS = [('json', _stdlib_loads, _stdlib_dumps)]
+
+try:
+	import ujson
+	_BACKENDS.insert(0, ('ujson', ujson.loads, lambda obj: ujson.dumps(obj, ensure_ascii=False, default=_default).encode('utf-8')))
+except ImportError:
+	pass
+
+try:
+	import orjson
+	_BACKENDS.insert(0, ('orjson', orjson.loads, lambda obj: orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)))
+except ImportError:
+	pass
+
+backend = None
+_loads = None
+_dumps = None
+
+
+def use(name='auto'):
+	'''Select the JSON backend: 'auto' (fastest installed), 'orjson', 'ujson' or 'json'.
+	'''
+	global backend, _loads, _dumps
+	available = {b[0]: b for b in _BACKENDS}
+	if name == 'auto':
+		name = _BACKENDS[0][0]
+	elif name not in available:
+		logging.warning('json backend {} is not installed, fall back to {}'.format(name, _BACKENDS[0][0]))
+		name = _BACKENDS[0][0]
+	backend, _loads, _dumps = available[name]
+	logging.info('json backend: {}'.format(name))
+
+
+def loads(data):
+	'''Decode str or bytes; raises ValueError on malformed input for every backend.
+	'''
+	return _loads(data)
+
+
+def dumps(obj):
+	'''Encode obj to UTF-8 JSON bytes; understands Model/Row, datetime and Decimal.
+	'''
+	return _dumps(obj)
+
+
+def is_large(obj, chunk_size):
+	return isinstance(obj, list) and len(obj) > chunk_size
+
+
+# 分块编码：大列表每chunk_size个元素编码一次，供StreamResponse逐块写出
+def iter_encode(obj, chunk_size=500):
+	if isinstance(obj, dict):
+		yield b'{'
+		first = True
+		for key, value in obj.items():
+			prefix = dumps(str(key)) + b':' if first else b',' + dumps(str(key)) + b':'
+			first = False
+			if is_large(value, chunk_size):
+				yield prefix
+				yield from iter_encode(value, chunk_size)
+			else:
+				yield prefix + dumps(value)
+		yield b'}'
+	elif is_large(obj, chunk_size):
+		yield b'['
+		for i in range(0, len(obj), chunk_size):
+			if i:
+				yield b','
+			yield dumps(obj[i:i + chunk_size])[1:-1]
+		yield b']'
+	else:
+		yield dumps(obj)
+
+
+use()
@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import contextvars
+
+from webapp import json_codec, metrics
+
+__author__ = 'Adam Lee'
+
+'''日志：记录放进有界队列，由后台线程格式化和写出，请求处理中只付出创建LogRecord的代价；
+可选JSON格式，每条记录带上请求id；sql/access/auth分类各自设置级别，访问日志可以采样，
+敏感参数脱敏。
+
+	from webapp.logs import sql_log
+	sql_log.info('SQL: %s', sql)  # %-风格的参数在后台线程里才格式化，参数应当是不可变的值
+'''
+
+# 分类日志
+access_log = logging.getLogger('webapp.access')
+sql_log = logging.getLogger('webapp.sql')
+auth_log = logging.getLogger('webapp.auth')
+
+# 当前请求的id，logger_factory里设置
+request_id = contextvars.ContextVar('request_id', default='-')
+
+# 脱敏的参数名(包含这些词的都算)
+SENSITIVE = ('password', 'passwd', 'secret', 'token', 'cookie', 'authorization', 'sha1')
+_MASK = '******'
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'
+
+
+def new_request_id(incoming=None):
+	'''Use a well-formed X-Request-Id from upstream, otherwise generate one.
+	'''
+	if incoming and len(incoming) <= 64 and incoming.replace('-', '').replace('_', '').replace('.', '').isalnum():
+		return incoming
+	return os.urandom(8).hex()
+
+
+def redact(data):
+	if isinstance(data, dict):
+		return {k: _MASK if isinstance(k, str) and any(word in k.lower() for word in SENSITIVE) else redact(v) for k, v in data.items()}
+	if isinstance(data, (list, tuple)):
+		return type(data)(redact(v) for v in data)
+	return data
+
+
+# 只在真正输出时才脱敏和转成字符串
+class Redacted:
+	__slots__ = ('data',)
+
+	def __init__(self, data):
+		self.data = data
+
+	def __str__(self):
+		return str(redact(self.data))
+
+	__repr__ = __str__
+
+
+# 在调用线程里执行：记下当前请求的id
+class RequestIdFilter(logging.Filter):
+	def filter(self, record):
+		record.request_id = request_id.get()
+		return True
+
+
+class AccessSampler(logging.Filter):
+	'''Keep a sample of access records: errors and slow requests always, others
+	with probability sample and at most max_per_second per second (0 = no cap).
+	'''
+
+	def __init__(self, sample=1.0, max_per_second=0, slow=0.5):
+		super().__init__()
+		self.sample = sample
+		self.max_per_second = max_per_second
+		self.slow = slow
+		self.dropped = 0
+		self._second = 0
+		self._count = 0
+
+	def filter(self, record):
+		if getattr(record, 'status', 200) >= 400 or getattr(record, 'duration', 0.0) >= self.slow:
+			return True
+		if self.sample < 1.0 and random.random() >= self.sample:
+			self.dropped += 1
+			return False
+		if self.max_per_second:
+			second = int(time.monotonic())
+			if second != self._second:
+				self._second, self._count = second, 0
+			self._count += 1
+			if self._count > self.max_per_second:
+				self.dropped += 1
+				return False
+		return True
+
+
+# LogRecord自带的属性，其余的是extra=传入的字段
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+class JsonFormatter(logging.Formatter):
+	def format(self, record):
+		entry = dict(
+			ts=round(record.created, 3),
+			level=record.levelname,
+			logger=record.name,
+			request_id=getattr(record, 'request_id', '-'),
+			message=record.getMessage()
+		)
+		for key, value in record.__dict__.items():
+			if key not in _RECORD_ATTRS:
+				entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+		if record.exc_info:
+			entry['exc'] = self.formatException(record.exc_info)
+		return json_codec.dumps(entry).decode('utf-8')
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+	'''QueueHandler that drops records when the queue is full, and leaves the
+	formatting to the listener thread.
+	'''
+
+	def __init__(self, q):
+		super().__init__(q)
+		self.dropped = 0
+
+	def prepare(self, record):
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+
+_handler = None
+_listener = None
+_sampler = None
+_pid = None
+
+
+def _stop():
+	global _listener
+	if _listener is not None:
+		# fork出的子进程里没有监听线程，旧的队列直接丢弃
+		if _pid == os.getpid():
+			_listener.stop()
+			for handler in _listener.handlers:
+				handler.close()
+		_listener = None
+
+
+# 根据configs.logging配置根日志；可以重复调用，fork之后在子进程里要再调用一次
+def setup(level='INFO', format='text', file=None, background=True, queue_size=10000, levels=None, access=None):
+	global _handler, _listener, _sampler, _pid
+	root = logging.getLogger()
+	_stop()
+	for handler in list(root.handlers):
+		root.removeHandler(handler)
+		handler.close()
+	if file:
+		output = logging.handlers.WatchedFileHandler(file, encoding='utf-8')
+	else:
+		output = logging.StreamHandler(sys.stderr)
+	output.setFormatter(JsonFormatter() if format == 'json' else logging.Formatter(TEXT_FORMAT))
+	if background:
+		_handler = BoundedQueueHandler(queue.Queue(queue_size))
+		_listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+		_listener.start()
+	else:
+		_handler = output
+	_handler.addFilter(RequestIdFilter())
+	_pid = os.getpid()
+	root.addHandler(_handler)
+	root.setLevel(level)
+	for name, category_level in (levels or {}).items():
+		logging.getLogger(name).setLevel(category_level)
+	if _sampler is not None:
+		access_log.removeFilter(_sampler)
+	_sampler = AccessSampler(**(access or {}))
+	access_log.addFilter(_sampler)
+
+
+def shutdown():
+	'''Write out the queued records and stop the listener thread. os._exit() skips
+	atexit, so forked workers call this before exiting.
+	'''
+	global _handler
+	_stop()
+	if _handler is not None:
+		logging.getLogger().removeHandler(_handler)
+		_handler.flush()
+		_handler.close()
+		_handler = None
+
+
+# 退出前把队列里剩下的写完
+atexit.register(shutdown)
+
+
+@metrics.register_collector
+def _collect():
+	lines = []
+	if isinstance(_handler, BoundedQueueHandler):
+		lines.append('log_queue_size %d' % _handler.queue.qsize())
+		lines.append('log_dropped_total %d' % _handler.dropped)
+	if _sampler is not None:
+		lines.append('log_access_sampled_out_total %d' % _sampler.dropped)
+	return lines
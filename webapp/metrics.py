@@ -0,0 +1,89 @@
+import bisect
+import threading
+
+__author__ = 'Adam Lee'
+
+'''运行指标：直方图、计数器，以及Prometheus文本格式输出
+'''
+
+# 默认的直方图桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+# 直方图
+class Histogram:
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)  # 最后一个是+Inf
+		self.count = 0
+		self.sum = 0.0
+		self._lock = threading.Lock()
+
+	def observe(self, value):
+		with self._lock:
+			self.counts[bisect.bisect_left(self.buckets, value)] += 1
+			self.count += 1
+			self.sum += value
+
+	def percentile(self, p):
+		'''Upper bound of the bucket holding the p-th percentile (0 < p <= 100).
+		'''
+		if not self.count:
+			return 0.0
+		rank = self.count * p / 100.0
+		seen = 0
+		for i, n in enumerate(self.counts):
+			seen += n
+			if seen >= rank:
+				return self.buckets[i] if i < len(self.buckets) else float('inf')
+		return float('inf')
+
+	def stats(self):
+		return dict(
+			count=self.count,
+			sum=self.sum,
+			avg=(self.sum / self.count) if self.count else 0.0,
+			p50=self.percentile(50),
+			p95=self.percentile(95),
+			p99=self.percentile(99)
+		)
+
+	def samples(self, name, labels=''):
+		'''Prometheus exposition lines for this histogram.
+		'''
+		lines = []
+		cumulative = 0
+		sep = ',' if labels else ''
+		for bound, n in zip(self.buckets + ('+Inf',), self.counts):
+			cumulative += n
+			lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, bound, cumulative))
+		lines.append('%s_sum{%s} %s' % (name, labels, self.sum))
+		lines.append('%s_count{%s} %d' % (name, labels, self.count))
+		return lines
+
+
+# 指数加权移动平均，用于观察最近一段时间的趋势
+class EWMA:
+	def __init__(self, alpha=0.2):
+		self.alpha = alpha
+		self.value = 0.0
+
+	def update(self, sample):
+		self.value += self.alpha * (sample - self.value)
+		return self.value
+
+
+# 各模块注册的采集函数，每个返回Prometheus文本行列表
+_collectors = []
+
+
+def register_collector(fn):
+	_collectors.append(fn)
+	return fn
+
+
+def render():
+	lines = []
+	for fn in _collectors:
+		lines.extend(fn())
+	return '\n'.join(lines) + '\n'
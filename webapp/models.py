@@ -1,6 +1,6 @@
 import time
 import uuid
-from webapp.async_orm import Model, StringField, BooleanField, FloatField, TextField
+from webapp.async_orm import Model, StringField, BooleanField, IntegerField, FloatField, TextField, BelongsTo, HasMany, Index
 
 
 def next_id():
@@ -10,19 +10,29 @@ def next_id():
 # 用户表
 class User(Model):
 	__table_name__ = 'users'
+	# 列表、首页和条件GET的版本查询走缓存；登录、注册和会话的查询用read_primary()绕过
+	__cache__ = dict(ttl=30)
+	__indexes__ = (Index('email', unique=True), Index('created_at'), Index('updated_at'))
 
 	id = StringField(primary_key=True, default=next_id, column_type='varchar(50)')
 	email = StringField(column_type='varchar(50)')
-	password = StringField(column_type='varchar(50)')
+	password = StringField(column_type='varchar(255)')
 	admin = BooleanField()
 	name = StringField(column_type='varchar(50)')
 	image = StringField(column_type='varchar(500)')
 	created_at = FloatField(default=time.time)
+	updated_at = FloatField(default=time.time)  # 每次写入时由Model更新
+	# 会话版本：加一使该用户已签发的所有会话失效，见cookie_manage.revoke_sessions
+	session_version = IntegerField()
+
+	blogs = HasMany('Blog', 'user_id')
+	comments = HasMany('Comment', 'user_id')
 
 
 # 博客表
 class Blog(Model):
 	__table_name__ = 'blogs'
+	__indexes__ = (Index('user_id'), Index('created_at'))
 
 	id = StringField(primary_key=True, default=next_id, column_type='varchar(50)')
 	user_id = StringField(column_type='varchar(50)')
@@ -30,18 +40,25 @@ class Blog(Model):
 	user_image = StringField(column_type='varchar(500)')
 	name = StringField(column_type='varchar(50)')
 	summary = StringField(column_type='varchar(200)')
-	content = TextField()
+	content = TextField(column_type='mediumtext')
 	created_at = FloatField(default=time.time)
 
+	user = BelongsTo('User', 'user_id')
+	comments = HasMany('Comment', 'blog_id')
+
 
 # 评论表
 class Comment(Model):
 	__table_name__ = 'comments'
+	__indexes__ = (Index('blog_id', 'created_at'), Index('user_id'), Index('created_at'))
 
 	id = StringField(primary_key=True, default=next_id, column_type='varchar(50)')
 	blog_id = StringField(column_type='varchar(50)')
 	user_id = StringField(column_type='varchar(50)')
 	user_name = StringField(column_type='varchar(50)')
 	user_image = StringField(column_type='varchar(500)')
-	content = TextField()
-	created_at = FloatField(default=time.time)
\ No newline at end of file
+	content = TextField(column_type='mediumtext')
+	created_at = FloatField(default=time.time)
+
+	blog = BelongsTo('Blog', 'blog_id')
+	user = BelongsTo('User', 'user_id')
@@ -0,0 +1,101 @@
+import os
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from webapp import metrics
+from webapp.api_error import APIBusyError
+
+__author__ = 'Adam Lee'
+
+'''把CPU密集的计算（密码哈希、压缩等）放到线程池/进程池里执行，不阻塞事件循环
+'''
+
+# 所有BoundedExecutor，供指标采集
+_executors = []
+
+
+class BoundedExecutor:
+	'''Run blocking callables in a thread or process pool with bounded pending work.
+
+	At most max_pending calls are queued or running; callers beyond that wait up
+	to queue_timeout seconds for a slot and then get APIBusyError, so overload
+	turns into fast failures instead of an ever growing queue.
+	'''
+
+	def __init__(self, name, kind='thread', workers=None, max_pending=64, queue_timeout=5.0):
+		if kind not in ('thread', 'process'):
+			raise ValueError('unknown executor kind: {}'.format(kind))
+		self.name = name
+		self.kind = kind
+		self.workers = workers or os.cpu_count() or 1
+		self.max_pending = max_pending
+		self.queue_timeout = queue_timeout
+		self.pending = 0
+		self.completed = 0
+		self.rejected = 0
+		self.latency = metrics.Histogram()
+		self._slots = None
+		self._pool = None
+		_executors.append(self)
+
+	# 第一次使用时才创建，这样fork出的每个worker进程各有自己的线程池/进程池
+	def _executor(self):
+		if self._pool is None:
+			if self.kind == 'process':
+				self._pool = ProcessPoolExecutor(max_workers=self.workers)
+			else:
+				self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+		return self._pool
+
+	async def run(self, fn, *args, **kw):
+		if self._slots is None:
+			self._slots = asyncio.Semaphore(self.max_pending)
+		try:
+			await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+		except asyncio.TimeoutError:
+			self.rejected += 1
+			logging.warning('{} executor is busy ({} pending), reject'.format(self.name, self.pending))
+			raise APIBusyError('Server is busy, please retry later.')
+		self.pending += 1
+		loop = asyncio.get_running_loop()
+		start = loop.time()
+		try:
+			return await loop.run_in_executor(self._executor(), functools.partial(fn, *args, **kw))
+		finally:
+			self.pending -= 1
+			self.completed += 1
+			self.latency.observe(loop.time() - start)
+			self._slots.release()
+
+	def shutdown(self, wait=True):
+		if self in _executors:
+			_executors.remove(self)
+		if self._pool is not None:
+			self._pool.shutdown(wait=wait)
+			self._pool = None
+		self._slots = None
+
+	def stats(self):
+		return dict(
+			kind=self.kind,
+			workers=self.workers,
+			pending=self.pending,
+			max_pending=self.max_pending,
+			completed=self.completed,
+			rejected=self.rejected,
+			latency=self.latency.stats()
+		)
+
+
+@metrics.register_collector
+def _collect():
+	lines = []
+	for executor in _executors:
+		label = 'executor="%s"' % executor.name
+		lines.append('offload_pending{%s} %d' % (label, executor.pending))
+		lines.append('offload_completed_total{%s} %d' % (label, executor.completed))
+		lines.append('offload_rejected_total{%s} %d' % (label, executor.rejected))
+		lines.extend(executor.latency.samples('offload_seconds', label))
+	return lines
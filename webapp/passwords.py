@@ -0,0 +1,123 @@
+import os
+import hmac
+import hashlib
+import logging
+
+from webapp.offload import BoundedExecutor
+
+__author__ = 'Adam Lee'
+
+'''密码哈希：scrypt / PBKDF2-SHA256，在线程池或进程池中计算，不阻塞事件循环
+
+保存的格式为 scheme$参数...$salt$hash，例如
+    scrypt$16384$8$1$<salt hex>$<hash hex>
+    pbkdf2_sha256$600000$<salt hex>$<hash hex>
+旧的 sha1(id:password) 摘要（40位hex）仍可验证，验证成功后由调用方换成新格式。
+'''
+
+
+class Scrypt:
+	name = 'scrypt'
+
+	def __init__(self, n=2 ** 14, r=8, p=1):
+		self.params = (n, r, p)
+
+	@staticmethod
+	def derive(password, salt, params):
+		n, r, p = params
+		return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=max(32 * 1024 * 1024, 256 * n * r), dklen=32)
+
+
+class Pbkdf2Sha256:
+	name = 'pbkdf2_sha256'
+
+	def __init__(self, iterations=600000):
+		self.params = (iterations,)
+
+	@staticmethod
+	def derive(password, salt, params):
+		return hashlib.pbkdf2_hmac('sha256', password, salt, params[0])
+
+
+# 可用的算法，新增算法在这里注册
+SCHEMES = {s.name: s for s in (Scrypt, Pbkdf2Sha256)}
+
+
+def register_scheme(scheme_class):
+	SCHEMES[scheme_class.name] = scheme_class
+	return scheme_class
+
+
+def legacy_sha1(uid, password):
+	return hashlib.sha1('{}:{}'.format(uid, password).encode('utf-8')).hexdigest()
+
+
+def is_legacy(encoded):
+	return '$' not in encoded
+
+
+class PasswordHasher:
+	'''Hash and verify passwords with one scheme, computed on a BoundedExecutor.
+	'''
+
+	def __init__(self, scheme='scrypt', executor=None, **params):
+		scheme_class = SCHEMES.get(scheme)
+		if scheme_class is None:
+			raise ValueError('unknown password scheme: {}'.format(scheme))
+		if scheme == 'scrypt' and not hasattr(hashlib, 'scrypt'):
+			logging.warning('hashlib.scrypt is not available, use pbkdf2_sha256')
+			scheme_class, params = Pbkdf2Sha256, {}
+		self.scheme = scheme_class(**params)
+		self.executor = executor or BoundedExecutor('passwords')
+
+	def _encode(self, salt, digest):
+		return '$'.join([self.scheme.name] + [str(p) for p in self.scheme.params] + [salt.hex(), digest.hex()])
+
+	async def hash(self, password):
+		salt = os.urandom(16)
+		digest = await self.executor.run(self.scheme.derive, password.encode('utf-8'), salt, self.scheme.params)
+		return self._encode(salt, digest)
+
+	async def verify(self, password, encoded, uid=None):
+		'''Return (ok, needs_rehash). uid is the salt of legacy sha1(id:password) hashes.
+		'''
+		if is_legacy(encoded):
+			ok = uid is not None and hmac.compare_digest(encoded, legacy_sha1(uid, password))
+			return ok, ok
+		parts = encoded.split('$')
+		scheme_class = SCHEMES.get(parts[0])
+		if scheme_class is None:
+			logging.warning('unknown password scheme: {}'.format(parts[0]))
+			return False, False
+		try:
+			params = tuple(int(p) for p in parts[1:-2])
+			salt, expected = bytes.fromhex(parts[-2]), bytes.fromhex(parts[-1])
+		except ValueError:
+			return False, False
+		digest = await self.executor.run(scheme_class.derive, password.encode('utf-8'), salt, params)
+		ok = hmac.compare_digest(digest, expected)
+		return ok, ok and (scheme_class.name != self.scheme.name or params != self.scheme.params)
+
+	def stats(self):
+		return dict(scheme=self.scheme.name, params=list(self.scheme.params), executor=self.executor.stats())
+
+
+hasher = PasswordHasher()
+
+
+# 根据configs.passwords重新创建hasher
+def setup(scheme='scrypt', executor='thread', workers=None, max_pending=64, queue_timeout=5.0, **params):
+	global hasher
+	hasher.executor.shutdown(wait=False)
+	params = params.get(scheme) or {}
+	hasher = PasswordHasher(scheme, BoundedExecutor('passwords', executor, workers, max_pending, queue_timeout), **params)
+	logging.info('password scheme: {} {}'.format(hasher.scheme.name, hasher.scheme.params))
+	return hasher
+
+
+async def hash_password(password):
+	return await hasher.hash(password)
+
+
+async def verify_password(password, encoded, uid=None):
+	return await hasher.verify(password, encoded, uid)
@@ -0,0 +1,140 @@
+import math
+import hashlib
+import logging
+
+from webapp import json_codec
+from webapp.cache import LRUCache
+
+__author__ = 'Adam Lee'
+
+'''SELECT结果缓存：按表的版本号失效，写表时版本号加一
+'''
+
+
+# 缓存后端接口，共享后端（redis、memcached等）实现同样的四个方法即可
+class CacheBackend:
+	async def get(self, key):
+		raise NotImplementedError
+
+	async def set(self, key, value, ttl=None):
+		raise NotImplementedError
+
+	async def incr(self, key):
+		'''Atomically increase an integer counter (missing counts as 0), return the new value.
+		'''
+		raise NotImplementedError
+
+	async def clear(self):
+		raise NotImplementedError
+
+
+# 进程内后端
+class MemoryBackend(CacheBackend):
+	def __init__(self, maxsize=10000, ttl=None):
+		self._values = LRUCache(maxsize=maxsize, ttl=ttl)
+		self._counters = {}
+
+	async def get(self, key):
+		if key in self._counters:
+			return self._counters[key]
+		return self._values.get(key, count=False)
+
+	async def set(self, key, value, ttl=None):
+		self._values.set(key, value, ttl=ttl)
+
+	async def incr(self, key):
+		value = self._counters.get(key, 0) + 1
+		self._counters[key] = value
+		return value
+
+	async def clear(self):
+		self._values.clear()
+		self._counters.clear()
+
+
+# 多个worker共享的后端，需要安装redis；行用JSON编码，所以列的值只能是JSON能表示的类型
+class RedisBackend(CacheBackend):
+	def __init__(self, url='redis://localhost:6379/0', prefix='awesome:qc:'):
+		try:
+			import redis.asyncio as aioredis
+		except ImportError:
+			raise RuntimeError('query cache backend {} needs the redis package'.format(url))
+		self._redis = aioredis.from_url(url)
+		self.prefix = prefix
+
+	async def get(self, key):
+		value = await self._redis.get(self.prefix + key)
+		return None if value is None else json_codec.loads(value)
+
+	async def set(self, key, value, ttl=None):
+		# 没有ttl的行靠redis的maxmemory-policy淘汰
+		await self._redis.set(self.prefix + key, json_codec.dumps(value), ex=math.ceil(ttl) if ttl else None)
+
+	async def incr(self, key):
+		return await self._redis.incr(self.prefix + key)
+
+	async def clear(self):
+		async for key in self._redis.scan_iter(match=self.prefix + '*'):
+			await self._redis.delete(key)
+
+
+# 查询缓存
+class QueryCache:
+	'''Cache rows returned by select(), keyed on table version + SQL + args.
+
+	Writes bump the table version instead of scanning for keys, so stale
+	entries simply stop being reachable and age out of the backend.
+	'''
+
+	def __init__(self, backend=None):
+		self.backend = backend or MemoryBackend()
+		self.enabled = True
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+
+	async def _key(self, table, sql, args, size):
+		version = await self.backend.get('version:' + table) or 0
+		digest = hashlib.sha1(repr((' '.join(sql.split()), list(args or ()), size)).encode('utf-8')).hexdigest()
+		return 'rows:{}:{}:{}'.format(table, version, digest)
+
+	async def get(self, table, sql, args, size):
+		key = await self._key(table, sql, args, size)
+		rs = await self.backend.get(key)
+		if rs is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return key, rs
+
+	async def set(self, key, rs, ttl):
+		await self.backend.set(key, rs, ttl=ttl)
+
+	async def invalidate(self, table):
+		self.invalidations += 1
+		await self.backend.incr('version:' + table)
+
+	def stats(self):
+		total = self.hits + self.misses
+		return dict(
+			enabled=self.enabled,
+			backend=self.backend.__class__.__name__,
+			hits=self.hits,
+			misses=self.misses,
+			invalidations=self.invalidations,
+			hit_rate=(self.hits / total) if total else 0.0
+		)
+
+
+query_cache = QueryCache()
+
+
+def setup(enabled=True, maxsize=10000, backend=None):
+	'''Configure the global query cache; backend (a CacheBackend or a redis:// url)
+	overrides the in-process one.
+	'''
+	if isinstance(backend, str):
+		backend = RedisBackend(backend)
+	query_cache.enabled = enabled
+	query_cache.backend = backend or MemoryBackend(maxsize=maxsize)
+	logging.info('query cache: enabled={}, backend={}'.format(enabled, query_cache.backend.__class__.__name__))
@@ -9,13 +9,16 @@ grant select, insert, update, delete on awesome.* to 'root'@'localhost' identifi
 create table users (
     `id` varchar(50) not null,
     `email` varchar(50) not null,
-    `password` varchar(50) not null,
+    `password` varchar(255) not null,
     `admin` bool not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
     `created_at` real not null,
+    `updated_at` real not null,
+    `session_version` bigint not null,
     unique key `idx_email` (`email`),
     key `idx_created_at` (`created_at`),
+    key `idx_updated_at` (`updated_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
@@ -28,6 +31,7 @@ create table blogs (
     `summary` varchar(200) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
@@ -40,6 +44,8 @@ create table comments (
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
\ No newline at end of file
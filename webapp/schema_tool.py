@@ -0,0 +1,199 @@
+import re
+import sys
+import asyncio
+import logging
+import argparse
+
+from webapp import async_orm, json_codec
+from webapp.config.config import configs
+from webapp.models import User, Blog, Comment
+
+__author__ = 'Adam Lee'
+
+'''根据ModelMetaclass的映射生成DDL、与线上库对比生成迁移语句，以及用EXPLAIN推荐索引
+
+    python -m webapp.schema_tool ddl
+    python -m webapp.schema_tool diff
+    python -m webapp.schema_tool advise queries.json   # queries.json来自 GET /debug/queries
+'''
+
+MODELS = (User, Blog, Comment)
+
+
+def _q(name):
+	return '`%s`' % name
+
+
+# 生成建表语句，格式与schema.sql一致
+def create_table_sql(model):
+	lines = []
+	for name, field in model.__mappings__.items():
+		lines.append('    %s %s not null' % (_q(field.name or name), field.column_type))
+	for index in model.__indexes__:
+		lines.append('    %s %s (%s)' % ('unique key' if index.unique else 'key', _q(index.name), ', '.join(map(_q, index.columns))))
+	lines.append('    primary key (%s)' % _q(model.__primary_key__))
+	return 'create table %s (\n%s\n) engine=innodb default charset=utf8;' % (model.__table_name__, ',\n'.join(lines))
+
+
+def ddl(models=MODELS):
+	return '\n\n'.join(create_table_sql(m) for m in models)
+
+
+_INT_TYPES = re.compile(r'^(smallint|mediumint|int|bigint)\(\d+\)')
+_TYPE_ALIASES = {'boolean': 'tinyint(1)', 'bool': 'tinyint(1)', 'real': 'double', 'integer': 'int'}
+
+
+# 统一列类型的写法，information_schema里是 tinyint(1)、double、bigint(20) 这样的形式
+def normalize_type(column_type):
+	t = ' '.join(column_type.lower().split())
+	t = _TYPE_ALIASES.get(t, t)
+	return _INT_TYPES.sub(r'\1', t)
+
+
+# 读取线上库结构：{table: {'columns': {name: type}, 'indexes': {name: (unique, (cols...))}}}
+async def fetch_schema(db):
+	schema = {}
+	columns = await async_orm.select(
+		'select table_name as tbl, column_name as col, column_type as type from information_schema.columns where table_schema=? order by tbl, ordinal_position', [db])
+	for r in columns:
+		schema.setdefault(r['tbl'], dict(columns={}, indexes={}))['columns'][r['col']] = r['type']
+	stats = await async_orm.select(
+		'select table_name as tbl, index_name as idx, non_unique, column_name as col from information_schema.statistics where table_schema=? order by tbl, idx, seq_in_index', [db])
+	for r in stats:
+		indexes = schema.setdefault(r['tbl'], dict(columns={}, indexes={}))['indexes']
+		unique, cols = indexes.get(r['idx'], (not int(r['non_unique']), ()))
+		indexes[r['idx']] = (unique, cols + (r['col'],))
+	return schema
+
+
+# 对比模型和线上库，返回迁移语句列表；多出来的列和索引只给出注释，不会删除
+def diff(schema, models=MODELS):
+	statements = []
+	for model in models:
+		table = model.__table_name__
+		live = schema.get(table)
+		if live is None:
+			statements.append(create_table_sql(model))
+			continue
+		for name, field in model.__mappings__.items():
+			column = field.name or name
+			live_type = live['columns'].get(column)
+			if live_type is None:
+				statements.append('alter table %s add column %s %s not null;' % (_q(table), _q(column), field.column_type))
+			elif normalize_type(live_type) != normalize_type(field.column_type):
+				statements.append('alter table %s modify column %s %s not null; -- was %s' % (_q(table), _q(column), field.column_type, live_type))
+		mapped = set(f.name or n for n, f in model.__mappings__.items())
+		for column in live['columns']:
+			if column not in mapped:
+				statements.append('-- %s.%s is not mapped by %s' % (table, column, model.__name__))
+		live_indexes = {cols: (name, unique) for name, (unique, cols) in live['indexes'].items()}
+		for index in model.__indexes__:
+			found = live_indexes.get(tuple(index.columns))
+			if found is not None and found[1] == index.unique:
+				continue
+			if index.name in live['indexes']:
+				statements.append('alter table %s drop key %s;' % (_q(table), _q(index.name)))
+			statements.append('alter table %s add %s %s (%s);' % (_q(table), 'unique key' if index.unique else 'key', _q(index.name), ', '.join(map(_q, index.columns))))
+	return statements
+
+
+_RE_WHERE = re.compile(r'\bwhere\b(.*?)(?:\border\s+by\b|\blimit\b|$)', re.IGNORECASE | re.DOTALL)
+_RE_ORDER = re.compile(r'\border\s+by\b(.*?)(?:\blimit\b|$)', re.IGNORECASE | re.DOTALL)
+_RE_COND = re.compile(r'`?(\w+)`?\s*(=|<=|>=|<|>|\bin\b|\blike\b)', re.IGNORECASE)
+
+
+# 从语句里取出适合建索引的列：等值条件、范围条件、排序列
+def index_columns(sql):
+	equal, ranged, order = [], [], []
+	m = _RE_WHERE.search(sql)
+	if m:
+		for column, op in _RE_COND.findall(m.group(1)):
+			(equal if op.lower() in ('=', 'in') else ranged).append(column)
+	m = _RE_ORDER.search(sql)
+	if m:
+		for part in m.group(1).split(','):
+			words = part.replace('`', ' ').split()
+			if words:
+				order.append(words[0])
+	columns = []
+	for column in equal + ranged[:1] + order:
+		if column not in columns:
+			columns.append(column)
+	return columns
+
+
+def _covered(columns, indexes):
+	return any(tuple(cols[:len(columns)]) == tuple(columns) for cols in indexes)
+
+
+# 对采集到的查询执行EXPLAIN，对全表扫描和filesort推荐索引
+async def advise(queries, schema=None, models=MODELS):
+	by_table = {m.__table_name__: m for m in models}
+	recommendations = []
+	for sql, args in queries:
+		try:
+			plan = await async_orm.select('explain ' + sql, args)
+		except Exception as e:
+			logging.warning('explain failed for {}: {}'.format(sql, e))
+			continue
+		for row in plan:
+			row = {k.lower(): v for k, v in row.items()}
+			extra = row.get('extra') or ''
+			if row.get('type') != 'ALL' and 'filesort' not in extra:
+				continue
+			model = by_table.get(row.get('table'))
+			if model is None:
+				continue
+			known = set(f.name or n for n, f in model.__mappings__.items())
+			columns = [c for c in index_columns(sql) if c in known]
+			if not columns:
+				continue
+			indexes = [tuple(i.columns) for i in model.__indexes__]
+			if schema and model.__table_name__ in schema:
+				indexes += [cols for _, cols in schema[model.__table_name__]['indexes'].values()]
+			reason = 'full table scan' if row.get('type') == 'ALL' else 'filesort'
+			if _covered(columns, indexes):
+				reason += ' (an index exists on these columns, check the live schema with diff)'
+			recommendations.append(dict(
+				table=model.__table_name__,
+				sql=sql,
+				reason=reason,
+				rows=row.get('rows'),
+				ddl='alter table %s add key %s (%s);' % (_q(model.__table_name__), _q('idx_' + '_'.join(columns)), ', '.join(map(_q, columns)))
+			))
+	return recommendations
+
+
+async def _run(options):
+	await async_orm.create_pool(loop=asyncio.get_event_loop(), **configs.db)
+	try:
+		if options.command == 'diff':
+			for statement in diff(await fetch_schema(configs.db.db)):
+				print(statement)
+		elif options.command == 'advise':
+			with open(options.queries, 'rb') as f:
+				queries = json_codec.loads(f.read())
+			schema = await fetch_schema(configs.db.db)
+			for r in await advise(queries, schema):
+				print('-- {} on {} ({} rows): {}'.format(r['reason'], r['table'], r['rows'], r['sql']))
+				print(r['ddl'])
+	finally:
+		await async_orm.destroy_pool()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Schema DDL, migrations and index advice from the models')
+	sub = parser.add_subparsers(dest='command', required=True)
+	sub.add_parser('ddl', help='print create table statements for all models')
+	sub.add_parser('diff', help='print migrations from the live database to the models')
+	advise_parser = sub.add_parser('advise', help='EXPLAIN captured queries and recommend indexes')
+	advise_parser.add_argument('queries', help='JSON list of [sql, args], e.g. saved from GET /debug/queries')
+	options = parser.parse_args(argv)
+	if options.command == 'ddl':
+		print(ddl())
+		return
+	asyncio.run(_run(options))
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
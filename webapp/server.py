@@ -0,0 +1,277 @@
+import os
+import sys
+import time
+import signal
+import select
+import socket
+import asyncio
+import logging
+import argparse
+import importlib
+
+from aiohttp import web
+
+from webapp import logs
+from webapp.config.config import configs
+
+
+__author__ = 'Adam Lee'
+
+'''启动入口：单进程，或者prefork多个worker进程
+
+    python -m webapp.server                 # configs.server.workers个worker
+    python -m webapp.server --workers 4 --port 8000
+
+每个worker有自己的事件循环和数据库连接池（configs.db.maxsize按worker数平分），
+用SO_REUSEPORT各自监听同一端口，由内核分发连接；不支持SO_REUSEPORT时由主进程
+监听，worker共享这个socket。
+
+主进程的信号：
+    SIGHUP          滚动重启：逐个启动新worker，新worker就绪后再优雅停止一个旧worker
+    SIGTERM/SIGINT  优雅停止：worker停止接受连接，等待进行中的请求（shutdown_timeout）
+'''
+
+_READY_TIMEOUT = 30
+
+
+def worker_count(workers=None):
+	workers = configs.server.workers if workers is None else workers
+	return workers if workers and workers > 0 else (os.cpu_count() or 1)
+
+
+def use_uvloop():
+	if not configs.server.uvloop:
+		return False
+	try:
+		import uvloop
+	except ImportError:
+		return False
+	asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+	return True
+
+
+def _can_reuse_port():
+	return configs.server.reuse_port and hasattr(socket, 'SO_REUSEPORT')
+
+
+# 每个worker的连接池是总数的一份
+def share_pool(workers):
+	if workers <= 1:
+		return
+	db = configs.db
+	db.maxsize = max(db.minsize, -(-db.maxsize // workers))
+	adaptive = db.get('adaptive')
+	if adaptive:
+		adaptive.max = max(db.maxsize, -(-adaptive.max // workers))
+
+
+# 进程内的查询缓存只在本worker里失效，多个worker会互相读到旧数据；没有共享的backend时关掉
+def check_query_cache(workers):
+	cache = configs.query_cache
+	if workers > 1 and cache.enabled and cache.get('backend') is None:
+		logging.warning('query cache disabled: the in-process backend is not shared by {} workers'.format(workers))
+		cache.enabled = False
+
+
+# 会话缓存同样在进程内：多个worker时只缓存很短的时间，撤销会话、修改admin在各worker上很快生效
+def check_session_cache(workers):
+	cache = configs.session.cache
+	if workers > 1 and cache.ttl > cache.prefork_ttl:
+		logging.info('session cache ttl {}s -> {}s for {} workers'.format(cache.ttl, cache.prefork_ttl, workers))
+		cache.ttl = cache.prefork_ttl
+
+
+def bind_socket(host, port, backlog):
+	sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind((host, port))
+	sock.listen(backlog)
+	sock.setblocking(False)
+	sock.set_inheritable(True)
+	return sock
+
+
+# 在当前进程里运行一个服务，直到收到SIGTERM/SIGINT
+async def serve(host, port, sock=None, ready=None):
+	from webapp import async_orm, web_app
+	app = await web_app.create_app()
+	runner = web.AppRunner(app, shutdown_timeout=configs.server.shutdown_timeout)
+	await runner.setup()
+	if sock is not None:
+		site = web.SockSite(runner, sock, backlog=configs.server.backlog)
+	else:
+		site = web.TCPSite(runner, host, port, backlog=configs.server.backlog, reuse_port=_can_reuse_port() or None)
+	await site.start()
+	logging.info('worker {} serving on http://{}:{}...'.format(os.getpid(), host, port))
+	if ready is not None:
+		ready()
+	stopping = asyncio.Event()
+	loop = asyncio.get_running_loop()
+	for sig in (signal.SIGTERM, signal.SIGINT):
+		loop.add_signal_handler(sig, stopping.set)
+	await stopping.wait()
+	logging.info('worker {} stopping...'.format(os.getpid()))
+	await runner.cleanup()
+	await async_orm.destroy_pool()
+
+
+# fork出来的子进程：重新读取配置，取自己的一份连接池，运行服务
+def _worker_main(host, port, workers, sock, ready_fd):
+	for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+		signal.signal(sig, signal.SIG_DFL)
+	# 滚动重启时让新worker读到新的配置
+	for name in ('webapp.config.config_default', 'webapp.config.config_override', 'webapp.config.config'):
+		if name in sys.modules:
+			importlib.reload(sys.modules[name])
+	global configs
+	configs = sys.modules['webapp.config.config'].configs
+	# 父进程的日志线程没有被fork过来
+	logs.setup(**configs.logging)
+	share_pool(workers)
+	check_query_cache(workers)
+	check_session_cache(workers)
+	use_uvloop()
+
+	def ready():
+		try:
+			os.write(ready_fd, b'1')
+		except OSError:
+			pass  # 主进程没有等待就绪
+		os.close(ready_fd)
+
+	try:
+		asyncio.run(serve(host, port, sock, ready))
+	except Exception:
+		logging.exception('worker {} failed'.format(os.getpid()))
+		return 1
+	finally:
+		# 随后的os._exit不执行atexit，在这里把队列里的日志写完
+		logs.shutdown()
+	return 0
+
+
+class Arbiter:
+	'''Pre-fork master: keeps `workers` worker processes alive and handles signals.
+	'''
+
+	def __init__(self, host, port, workers):
+		self.host = host
+		self.port = port
+		self.workers = workers
+		self.sock = None if _can_reuse_port() else bind_socket(host, port, configs.server.backlog)
+		self.children = {}  # pid -> 启动时间
+		self._signals = []
+
+	def spawn(self):
+		read_fd, write_fd = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			os.close(read_fd)
+			code = 1
+			try:
+				code = _worker_main(self.host, self.port, self.workers, self.sock, write_fd)
+			finally:
+				os._exit(code)
+		os.close(write_fd)
+		self.children[pid] = time.monotonic()
+		return pid, read_fd
+
+	# 等待worker写入就绪标记
+	def wait_ready(self, pid, read_fd, timeout=_READY_TIMEOUT):
+		try:
+			readable, _, _ = select.select([read_fd], [], [], timeout)
+			return bool(readable) and os.read(read_fd, 1) == b'1'
+		finally:
+			os.close(read_fd)
+
+	def stop_worker(self, pid, timeout=None):
+		timeout = configs.server.shutdown_timeout if timeout is None else timeout
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except ProcessLookupError:
+			self.children.pop(pid, None)
+			return
+		deadline = time.monotonic() + timeout + 5
+		while time.monotonic() < deadline:
+			done, _ = os.waitpid(pid, os.WNOHANG)
+			if done:
+				break
+			time.sleep(0.1)
+		else:
+			logging.warning('worker {} did not stop in time, killing it'.format(pid))
+			os.kill(pid, signal.SIGKILL)
+			os.waitpid(pid, 0)
+		self.children.pop(pid, None)
+
+	def rolling_restart(self):
+		logging.info('rolling restart of {} workers...'.format(len(self.children)))
+		for old in list(self.children):
+			pid, read_fd = self.spawn()
+			if not self.wait_ready(pid, read_fd):
+				logging.error('new worker {} did not become ready, keep worker {}'.format(pid, old))
+				self.stop_worker(pid, timeout=0)
+				return
+			self.stop_worker(old)
+		logging.info('rolling restart done')
+
+	def reap(self):
+		while True:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				return
+			if not pid:
+				return
+			started = self.children.pop(pid, None)
+			if started is not None:
+				logging.warning('worker {} exited with status {}'.format(pid, status))
+				if time.monotonic() - started < 1:
+					time.sleep(1)  # 启动即退出时不要忙着重启
+
+	def _on_signal(self, sig, frame):
+		self._signals.append(sig)
+
+	def run(self):
+		for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+			signal.signal(sig, self._on_signal)
+		logging.info('master {} starting {} workers on http://{}:{} ({})...'.format(
+			os.getpid(), self.workers, self.host, self.port, 'SO_REUSEPORT' if self.sock is None else 'shared socket'))
+		while True:
+			while len(self.children) < self.workers:
+				os.close(self.spawn()[1])
+			if self._signals:
+				sig = self._signals.pop(0)
+				if sig == signal.SIGHUP:
+					self.rolling_restart()
+				else:
+					break
+			time.sleep(0.5)
+			self.reap()
+		logging.info('master {} stopping workers...'.format(os.getpid()))
+		for pid in list(self.children):
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				self.children.pop(pid, None)
+		for pid in list(self.children):
+			self.stop_worker(pid)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Run the web app')
+	parser.add_argument('--host', default=configs.server.host)
+	parser.add_argument('--port', type=int, default=configs.server.port)
+	parser.add_argument('--workers', type=int, default=None, help='worker processes, 0 for one per CPU')
+	options = parser.parse_args(argv)
+	logs.setup(**configs.logging)
+	workers = worker_count(options.workers)
+	if workers == 1 or not hasattr(os, 'fork'):
+		if use_uvloop():
+			logging.info('using uvloop')
+		asyncio.run(serve(options.host, options.port))
+		return
+	Arbiter(options.host, options.port, workers).run()
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,84 @@
+import time
+import contextvars
+from collections import deque, Counter
+
+from webapp.logs import sql_log
+
+__author__ = 'Adam Lee'
+
+'''按请求统计SQL：语句、参数形状、耗时、行数，找出N+1查询和慢查询
+'''
+
+# 当前请求的profile，由web_app的profiler中间件设置；为None时不记录
+_current = contextvars.ContextVar('sql_profile', default=None)
+
+# 慢查询阈值（秒），None表示关闭慢查询日志
+slow_threshold = 0.2
+# 同一请求中同样形状的语句出现这么多次即视为N+1
+n_plus_one_threshold = 3
+# 最近的请求profile，供调试接口查看
+recent = deque(maxlen=50)
+
+
+def setup(slow=0.2, n_plus_one=3, history=50):
+	global slow_threshold, n_plus_one_threshold, recent
+	slow_threshold = slow
+	n_plus_one_threshold = n_plus_one
+	recent = deque(recent, maxlen=history)
+
+
+# 一个请求内的全部SQL
+class RequestProfile:
+	def __init__(self, method, path):
+		self.method = method
+		self.path = path
+		self.started = time.time()
+		self.queries = []
+
+	def record(self, sql, args, duration, rows):
+		shape = tuple(type(a).__name__ for a in args) if args else ()
+		self.queries.append((sql, shape, duration, rows))
+
+	def n_plus_one(self):
+		counts = Counter((sql, shape) for sql, shape, _, _ in self.queries)
+		return [dict(sql=sql, args=list(shape), count=n) for (sql, shape), n in counts.items() if n >= n_plus_one_threshold]
+
+	def total_time(self):
+		return sum(q[2] for q in self.queries)
+
+	def header(self):
+		return 'queries={}; time={:.1f}ms; n+1={}'.format(len(self.queries), self.total_time() * 1000, len(self.n_plus_one()))
+
+	def summary(self):
+		return dict(
+			method=self.method,
+			path=self.path,
+			started=self.started,
+			count=len(self.queries),
+			time=self.total_time(),
+			n_plus_one=self.n_plus_one(),
+			queries=[dict(sql=sql, args=list(shape), time=duration, rows=rows) for sql, shape, duration, rows in self.queries]
+		)
+
+
+def start(method, path):
+	profile = RequestProfile(method, path)
+	return profile, _current.set(profile)
+
+
+def finish(profile, token):
+	_current.reset(token)
+	suspects = profile.n_plus_one()
+	for s in suspects:
+		sql_log.warning('possible N+1 query in %s %s: %s x%d', profile.method, profile.path, s['sql'], s['count'])
+	if profile.queries:
+		recent.append(profile.summary())
+
+
+# async_orm每执行一条语句调用一次
+def observe(sql, args, duration, rows):
+	if slow_threshold is not None and duration >= slow_threshold:
+		sql_log.warning('slow query (%.1fms): %s', duration * 1000, sql)
+	profile = _current.get()
+	if profile is not None:
+		profile.record(sql, args, duration, rows)
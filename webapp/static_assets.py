@@ -0,0 +1,276 @@
+import os
+import stat
+import asyncio
+import hashlib
+import logging
+import tempfile
+import mimetypes
+
+from aiohttp import web
+
+from webapp import compression
+from webapp.cache import LRUCache
+
+__author__ = 'Adam Lee'
+
+'''静态文件：启动时建立清单(内容摘要、带指纹的URL、预压缩的gzip/br文件)，
+按Accept-Encoding返回预压缩版本，强ETag/304，带指纹的URL长期缓存；
+小文件放在有界的内存缓存里，大文件用FileResponse(sendfile)发送。
+
+模板中使用 {{ static_url('css/app.css') }} 得到 /static/css/app.<hash>.css
+'''
+
+# 值得压缩的类型
+_COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+_IMMUTABLE = 'public, max-age=31536000, immutable'
+# 预压缩文件的默认目录，在应用目录下
+_BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.static-build')
+
+
+def _digest(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+# 只有当前用户能写的文件/目录才是自己生成的
+def _private(st):
+	owned = not hasattr(os, 'getuid') or st.st_uid == os.getuid()
+	return owned and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+# 预压缩文件的目录：不存在时以0700创建；已有的目录不是私有的(例如共享的临时目录)时改用新的临时目录
+def private_dir(path):
+	os.makedirs(path, mode=0o700, exist_ok=True)
+	st = os.stat(path)
+	if stat.S_ISDIR(st.st_mode) and _private(st):
+		return path
+	fallback = tempfile.mkdtemp(prefix='awesome-static-')
+	logging.warning('static build dir {} is writable by others, using {}'.format(path, fallback))
+	return fallback
+
+
+def fingerprinted(rel, digest):
+	root, ext = os.path.splitext(rel)
+	return '{}.{}{}'.format(root, digest[:12], ext)
+
+
+class Asset:
+	__slots__ = ('rel', 'file', 'size', 'mtime', 'digest', 'content_type', 'url', 'variants')
+
+	def __init__(self, rel, file, st, digest):
+		self.rel = rel
+		self.file = file
+		self.size = st.st_size
+		self.mtime = st.st_mtime
+		self.digest = digest
+		content_type, _ = mimetypes.guess_type(rel)
+		self.content_type = content_type or 'application/octet-stream'
+		self.url = fingerprinted(rel, digest)
+		self.variants = {}  # encoding -> (文件, 大小)
+
+	def etag(self, encoding=None):
+		return '"{}{}"'.format(self.digest[:16], '-' + encoding if encoding else '')
+
+	@property
+	def compressible(self):
+		return self.content_type.startswith(_COMPRESSIBLE)
+
+
+class Manifest:
+	'''Content hashes and precompressed variants of every file under root.
+	'''
+
+	def __init__(self, root, prefix='/static/', build_dir=None, precompress=True, min_compress_size=256):
+		self.root = root
+		self.prefix = prefix
+		self.build_dir = build_dir or _BUILD_DIR
+		self._checked_dir = False
+		self.precompress = precompress
+		self.min_compress_size = min_compress_size
+		self.assets = {}  # rel -> Asset
+		self.urls = {}  # 带指纹的rel -> Asset
+
+	def build(self):
+		self.assets.clear()
+		self.urls.clear()
+		if not os.path.isdir(self.root):
+			return self
+		for dirpath, _, filenames in os.walk(self.root):
+			for name in filenames:
+				file = os.path.join(dirpath, name)
+				self.add(os.path.relpath(file, self.root).replace(os.sep, '/'), file)
+		logging.info('static manifest: {} files under {}'.format(len(self.assets), self.root))
+		return self
+
+	def add(self, rel, file):
+		asset = Asset(rel, file, os.stat(file), _digest(file))
+		if self.precompress and asset.compressible and asset.size >= self.min_compress_size:
+			self._precompress(asset)
+		old = self.assets.get(rel)
+		if old is not None:
+			self.urls.pop(old.url, None)
+		self.assets[rel] = asset
+		self.urls[asset.url] = asset
+		return asset
+
+	# 压缩结果按内容摘要命名，重启时直接复用；不是自己生成的文件重新生成
+	def _precompress(self, asset):
+		if not self._checked_dir:
+			self.build_dir = private_dir(self.build_dir)
+			self._checked_dir = True
+		data = None
+		for encoding in compression.PRECOMPRESSED:
+			target = os.path.join(self.build_dir, '{}.{}'.format(asset.digest, encoding))
+			try:
+				st = os.lstat(target)
+				reuse = stat.S_ISREG(st.st_mode) and _private(st)
+			except FileNotFoundError:
+				reuse = False
+			if not reuse:
+				if data is None:
+					with open(asset.file, 'rb') as f:
+						data = f.read()
+				encoded = compression.compress(encoding, data)
+				if len(encoded) >= asset.size:
+					continue
+				tmp = target + '.tmp%d' % os.getpid()
+				with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+					f.write(encoded)
+				os.replace(tmp, target)
+			asset.variants[encoding] = (target, os.path.getsize(target))
+
+	def lookup(self, rel):
+		'''Return (asset, fingerprinted) for a request path, or (None, False).
+		'''
+		asset = self.urls.get(rel)
+		if asset is not None:
+			return asset, True
+		return self.assets.get(rel), False
+
+	# 启动之后新增的文件
+	def discover(self, rel):
+		root = os.path.abspath(self.root)
+		file = os.path.normpath(os.path.join(root, rel))
+		if not file.startswith(root + os.sep) or not os.path.isfile(file):
+			return None
+		return self.add(rel, file)
+
+	# 开发时文件会变化，重新计算
+	def refresh(self, asset):
+		try:
+			st = os.stat(asset.file)
+		except OSError:
+			return None
+		if st.st_mtime == asset.mtime and st.st_size == asset.size:
+			return asset
+		return self.add(asset.rel, asset.file)
+
+	def url(self, rel):
+		asset = self.assets.get(rel.lstrip('/'))
+		return self.prefix + (asset.url if asset is not None else rel.lstrip('/'))
+
+
+# 大文件用FileResponse(sendfile)发送。它会把ETag换成自己的mtime-size，这里始终写回清单的
+# 内容摘要ETag；If-None-Match在StaticFiles里已经按清单ETag判断过
+class AssetFileResponse(web.FileResponse):
+	def __init__(self, path, etag, **kw):
+		self._asset_etag = etag
+		super().__init__(path, **kw)
+
+	@property
+	def etag(self):
+		return web.FileResponse.etag.fget(self)
+
+	@etag.setter
+	def etag(self, value):
+		self.headers['ETag'] = self._asset_etag
+
+
+class StaticFiles:
+	'''aiohttp handler for manifest assets.
+	'''
+
+	def __init__(self, manifest, hot_maxsize=256, hot_max_file_size=64 * 1024, max_age=0, watch=False):
+		self.manifest = manifest
+		self.hot = LRUCache(maxsize=hot_maxsize)
+		self.hot_max_file_size = hot_max_file_size
+		self.cache_control = 'public, max-age={}'.format(max_age) if max_age else 'no-cache'
+		self.watch = watch
+
+	async def _read(self, file):
+		def read():
+			with open(file, 'rb') as f:
+				return f.read()
+		return await asyncio.get_running_loop().run_in_executor(None, read)
+
+	async def __call__(self, request):
+		rel = request.match_info['path']
+		asset, immutable = self.manifest.lookup(rel)
+		if self.watch:
+			asset = self.manifest.refresh(asset) if asset is not None else self.manifest.discover(rel)
+		if asset is None:
+			raise web.HTTPNotFound()
+		encoding = compression.negotiate(request.headers.get('Accept-Encoding'), asset.variants)
+		etag = asset.etag(encoding)
+		headers = {
+			'ETag': etag,
+			'Cache-Control': _IMMUTABLE if immutable else self.cache_control
+		}
+		if asset.variants:
+			headers['Vary'] = 'Accept-Encoding'
+		if_none_match = request.headers.get('If-None-Match')
+		if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+			return web.Response(status=304, headers=headers)
+		if encoding:
+			headers['Content-Encoding'] = encoding
+			file, size = asset.variants[encoding]
+		else:
+			file, size = asset.file, asset.size
+		content_type = asset.content_type
+		if content_type.startswith('text/') or content_type == 'application/javascript':
+			content_type += '; charset=utf-8'
+		headers['Content-Type'] = content_type
+		if size > self.hot_max_file_size:
+			return AssetFileResponse(file, etag, headers=headers)
+		key = (asset.digest, encoding)
+		body = self.hot.get(key)
+		if body is None:
+			body = await self._read(file)
+			self.hot.set(key, body)
+		return web.Response(body=body, headers=headers)
+
+	def stats(self):
+		return dict(files=len(self.manifest.assets), hot=self.hot.stats())
+
+
+static_files = None
+
+
+# 挂载静态文件路由，app['__static__']保存StaticFiles
+def setup(app, path=None, prefix='/static/', build_dir=None, precompress=True, min_compress_size=256,
+		  max_age=0, watch=False, hot=None):
+	global static_files
+	path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+	manifest = Manifest(path, prefix, build_dir, precompress, min_compress_size).build()
+	hot = hot or {}
+	static_files = StaticFiles(manifest, hot.get('maxsize', 256), hot.get('max_file_size', 64 * 1024), max_age, watch)
+
+	async def static_handler(request):
+		return await static_files(request)
+	static_handler.__static__ = True
+
+	app.router.add_get(prefix + '{path:.+}', static_handler)
+	app['__static__'] = static_files
+	logging.info('add static {} => {}'.format(prefix, path))
+	return static_files
+
+
+def url(rel):
+	'''Fingerprinted URL of a static file, for templates.
+	'''
+	if static_files is None:
+		return '/static/' + rel.lstrip('/')
+	return static_files.manifest.url(rel)
@@ -0,0 +1,55 @@
+import asyncio
+import contextlib
+
+from aiohttp.test_utils import TestServer, TestClient
+
+from webapp import async_orm
+from webapp.benchmark import memory_db
+from webapp.config.config import configs
+from webapp.models import User, Blog, Comment
+
+__author__ = 'Adam Lee'
+
+'''测试使用benchmark/memory_db的sqlite代替MySQL，不需要数据库服务
+'''
+
+# 测试中的日志只看警告以上
+configs.logging.level = 'WARNING'
+
+
+def run(coro):
+	return asyncio.run(coro)
+
+
+@contextlib.asynccontextmanager
+async def database(latency=0.0, maxsize=10):
+	db = memory_db.Database(latency=latency)
+	db.create_tables((User, Blog, Comment))
+	opener = async_orm._open_pool
+	async_orm._open_pool = memory_db.pool_opener(db)
+	try:
+		await async_orm.create_pool(loop=None, maxsize=maxsize)
+		yield db
+	finally:
+		await async_orm.destroy_pool()
+		async_orm._open_pool = opener
+
+
+# 完整的应用：中间件、路由、模板
+@contextlib.asynccontextmanager
+async def app_client(latency=0.0):
+	from webapp import web_app
+	db = memory_db.Database(latency=latency)
+	db.create_tables((User, Blog, Comment))
+	opener = async_orm._open_pool
+	async_orm._open_pool = memory_db.pool_opener(db)
+	client = None
+	try:
+		client = TestClient(TestServer(await web_app.create_app()))
+		await client.start_server()
+		yield client
+	finally:
+		if client is not None:
+			await client.close()
+		await async_orm.destroy_pool()
+		async_orm._open_pool = opener
@@ -0,0 +1,109 @@
+import copy
+import asyncio
+import contextlib
+
+from webapp import admission, async_orm
+from webapp.config.config import configs
+from webapp.tests.conftest import run, app_client
+
+
+@contextlib.contextmanager
+def admission_config(**kw):
+	saved = copy.deepcopy(configs.admission)
+	configs.admission.update(kw)
+	try:
+		yield
+	finally:
+		configs.admission = saved
+
+
+def test_limiter_queue_full_timeout_and_handoff():
+	async def main():
+		limiter = admission.Limiter(concurrency=1, queue=1, queue_timeout=0.05)
+		assert await limiter.acquire() is None
+		waiter = asyncio.ensure_future(limiter.acquire())
+		await asyncio.sleep(0)
+		assert limiter.waiting == 1
+		assert await limiter.acquire() == 'queue_full'
+		# 名额直接交给等待者
+		limiter.release()
+		assert await waiter is None
+		assert limiter.active == 1 and limiter.waiting == 0
+		assert await limiter.acquire() == 'queue_timeout'
+		assert limiter.waiting == 0
+		limiter.release()
+		assert limiter.active == 0
+	run(main())
+
+
+def test_slot_handed_over_as_the_wait_times_out(monkeypatch):
+	async def main():
+		limiter = admission.Limiter(concurrency=1, queue=1, queue_timeout=1.0)
+		assert await limiter.acquire() is None
+
+		# release()在超时触发之前把名额交给了等待者，wait_for仍然抛出TimeoutError
+		async def wait_for(fut, timeout):
+			limiter.release()
+			raise asyncio.TimeoutError()
+
+		monkeypatch.setattr(admission.asyncio, 'wait_for', wait_for)
+		assert await limiter.acquire() is None
+		assert limiter.active == 1 and limiter.waiting == 0
+		limiter.release()
+		assert limiter.active == 0
+	run(main())
+
+
+def test_token_bucket():
+	bucket = admission.TokenBucket(rate=1.0, burst=2)
+	assert bucket.take('a') == 0
+	assert bucket.take('a') == 0
+	wait = bucket.take('a')
+	assert 0 < wait <= 1.0
+	assert bucket.take('b') == 0
+
+
+def test_heavy_route_sheds_under_load():
+	routes = dict(configs.admission.routes)
+	routes['/api/users'] = dict(priority='heavy', concurrency=1, queue=1, queue_timeout=5.0, pool_wait_budget=None)
+
+	async def main():
+		with admission_config(routes=routes, rate_limits={}):
+			async with app_client(latency=0.02) as client:
+				async def get():
+					resp = await client.get('/api/users')
+					await resp.read()
+					return resp.status, resp.headers.get('Retry-After')
+				results = await asyncio.gather(*[get() for _ in range(8)])
+				assert results.count((200, None)) == 2
+				assert results.count((503, '1')) == 6
+				assert admission.controller.stats()['/api/users']['rejected'] == dict(queue_full=6)
+	run(main())
+
+
+def test_pool_wait_budget_sheds(monkeypatch):
+	async def main():
+		with admission_config(rate_limits={}):
+			async with app_client() as client:
+				monkeypatch.setattr(async_orm, 'recent_wait', lambda *args, **kw: 1.0)
+				resp = await client.get('/api/users')
+				assert resp.status == 503
+				assert (await resp.json())['error'] == 'server:busy'
+				# critical路由不看连接池等待
+				resp = await client.post('/api/login', json=dict(email='x@y.com', password='nopass1'))
+				assert resp.status != 503
+	run(main())
+
+
+def test_login_rate_limited():
+	async def main():
+		with admission_config(rate_limits={'/api/login': dict(rate=0.01, burst=2)}):
+			async with app_client() as client:
+				statuses = []
+				for _ in range(3):
+					resp = await client.post('/api/login', json=dict(email='x@y.com', password='nopass1'))
+					statuses.append(resp.status)
+				assert 429 not in statuses[:2] and statuses[2] == 429
+				assert (await resp.json())['error'] == 'server:rate_limited'
+				assert int(resp.headers['Retry-After']) >= 1
+	run(main())
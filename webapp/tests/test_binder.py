@@ -0,0 +1,79 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+from webapp import core_web
+from webapp.core_web import get, post
+from webapp.tests.conftest import run
+
+
+@get('/ping')
+async def ping():
+	return web.json_response('pong')
+
+
+@get('/items/{id}')
+async def item(id: int, request):
+	return web.json_response(dict(id=id, method=request.method))
+
+
+@get('/search')
+async def search(*, q, page: int = 1):
+	return web.json_response(dict(q=q, page=page))
+
+
+@post('/items/{id}')
+async def update_item(id, *, name, count: int):
+	return web.json_response(dict(id=id, name=name, count=count))
+
+
+async def _client():
+	app = web.Application()
+	for fn in (ping, item, search, update_item):
+		core_web.add_route(app, fn)
+	client = TestClient(TestServer(app))
+	await client.start_server()
+	return client
+
+
+async def _json(resp):
+	return resp.status, (await resp.json() if resp.status == 200 else await resp.text())
+
+
+def test_no_args_binder():
+	async def main():
+		client = await _client()
+		try:
+			assert await _json(await client.get('/ping')) == (200, 'pong')
+		finally:
+			await client.close()
+	run(main())
+
+
+def test_path_only_binder_converts_annotations():
+	async def main():
+		client = await _client()
+		try:
+			assert await _json(await client.get('/items/42')) == (200, dict(id=42, method='GET'))
+			status, _ = await _json(await client.get('/items/abc'))
+			assert status == 400
+		finally:
+			await client.close()
+	run(main())
+
+
+def test_query_and_body_binder():
+	async def main():
+		client = await _client()
+		try:
+			assert await _json(await client.get('/search?q=x&page=2&extra=1')) == (200, dict(q='x', page=2))
+			status, text = await _json(await client.get('/search'))
+			assert status == 400 and 'q' in text
+			resp = await client.post('/items/7', json=dict(name='n', count='3', ignored=True))
+			assert await _json(resp) == (200, dict(id='7', name='n', count=3))
+			resp = await client.post('/items/7', data=dict(name='n', count='4'))
+			assert await _json(resp) == (200, dict(id='7', name='n', count=4))
+			resp = await client.post('/items/7', data='[1]', headers={'Content-Type': 'application/json'})
+			assert resp.status == 400
+		finally:
+			await client.close()
+	run(main())
@@ -0,0 +1,29 @@
+from webapp.async_orm import Model, StringField, IntegerField
+from webapp.tests.conftest import run, database
+
+
+class Item(Model):
+	__table_name__ = 'test_items'
+
+	id = StringField(primary_key=True, column_type='varchar(50)')
+	qty = IntegerField()
+
+
+def test_bulk_writes_notify_once_per_primary_key():
+	calls = []
+	Item.add_listener(lambda action, item: calls.append((action, item.id, item.qty)))
+
+	async def main():
+		async with database() as db:
+			db.create_tables((Item,))
+			assert await Item.save_many([dict(id='a', qty=1), dict(id='b', qty=1)]) == 2
+			assert sorted(calls) == [('save', 'a', 1), ('save', 'b', 1)]
+			del calls[:]
+			await Item.update_many([dict(id='a', qty=2), dict(id='a', qty=3), dict(id='b', qty=2)])
+			assert sorted(calls) == [('update', 'a', 3), ('update', 'b', 2)]
+			assert (await Item.find('a')).qty == 3
+
+	try:
+		run(main())
+	finally:
+		Item.__listeners__.clear()
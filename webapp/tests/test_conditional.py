@@ -0,0 +1,39 @@
+from webapp.models import User
+from webapp.tests.conftest import run, app_client
+
+
+async def _add_user(name):
+	user = User(name=name, email='%s@x.com' % name, password='hash', image='')
+	await user.save()
+	return user
+
+
+def test_user_list_hides_private_fields():
+	async def main():
+		async with app_client() as client:
+			await _add_user('alice')
+			for method in ('GET', 'POST'):
+				resp = await client.request(method, '/api/users')
+				assert resp.status == 200
+				users = (await resp.json())['users']
+				assert [u['name'] for u in users] == ['alice']
+				assert set(users[0]) == {'id', 'name', 'image', 'created_at'}
+	run(main())
+
+
+def test_etag_changes_after_update():
+	async def main():
+		async with app_client() as client:
+			user = await _add_user('alice')
+			for path in ('/api/users', '/'):
+				resp = await client.get(path)
+				etag = resp.headers['ETag']
+				resp = await client.get(path, headers={'If-None-Match': etag})
+				assert resp.status == 304
+				user.name = 'bob-' + path
+				await user.update()
+				resp = await client.get(path, headers={'If-None-Match': etag})
+				assert resp.status == 200
+				assert resp.headers['ETag'] != etag
+				assert 'bob-' + path in await resp.text()
+	run(main())
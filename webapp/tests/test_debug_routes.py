@@ -0,0 +1,33 @@
+from webapp.config.config import configs
+from webapp.cookie import cookie_manage
+from webapp.models import User
+from webapp.tests.conftest import run, app_client
+
+
+def test_debug_routes_need_an_admin():
+	async def main():
+		saved = configs.profiler.enabled
+		configs.profiler.enabled = True
+		try:
+			async with app_client() as client:
+				users = {}
+				for admin in (False, True):
+					user = User(name='u%d' % admin, email='u%d@x.com' % admin, password='hash', image='', admin=admin)
+					await user.save()
+					users[admin] = cookie_manage.user2cookie(await User.find(user.id), 3600)
+				for path in ('/debug/sql', '/debug/queries'):
+					assert (await client.get(path)).status == 403
+					resp = await client.get(path, cookies={cookie_manage.COOKIE_NAME: users[False]})
+					assert resp.status == 403
+					resp = await client.get(path, cookies={cookie_manage.COOKIE_NAME: users[True]})
+					assert resp.status == 200
+		finally:
+			configs.profiler.enabled = saved
+	run(main())
+
+
+def test_profiler_is_off_by_default():
+	async def main():
+		async with app_client() as client:
+			assert (await client.get('/debug/queries')).status == 404
+	run(main())
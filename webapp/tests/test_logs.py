@@ -0,0 +1,23 @@
+import os
+import logging
+import tempfile
+
+from webapp import logs
+from webapp.config.config import configs
+
+
+def test_shutdown_writes_out_queued_records():
+	with tempfile.TemporaryDirectory() as root:
+		file = os.path.join(root, 'app.log')
+		try:
+			logs.setup(level='INFO', file=file, background=True)
+			for i in range(200):
+				logging.getLogger('webapp.test').info('record %d', i)
+			logs.shutdown()
+			with open(file, encoding='utf-8') as f:
+				lines = f.read().splitlines()
+			assert len(lines) == 200 and lines[-1].endswith('record 199')
+			# 之后的记录不再进入没有人消费的队列
+			assert logs._handler is None
+		finally:
+			logs.setup(**configs.logging)
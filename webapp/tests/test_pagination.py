@@ -0,0 +1,38 @@
+import pytest
+
+from webapp.async_orm import transaction
+from webapp.models import Blog
+from webapp.tests.conftest import run, database
+
+
+async def _seed():
+	await Blog.save_many([dict(id='b%d' % i, user_id='u1', user_name='u', user_image='', name='blog %d' % i, summary='', content='', created_at=float(i)) for i in range(5)])
+
+
+def test_find_after_accepts_compact_rows():
+	async def main():
+		async with database():
+			await _seed()
+			page = await Blog.findAfter(limit=2, compact=True)
+			assert [b.id for b in page] == ['b4', 'b3']
+			page = await Blog.findAfter(page[-1], limit=2, compact=True)
+			assert [b.id for b in page] == ['b2', 'b1']
+			# Model、dict和(key, pk)元组得到同样的下一页
+			model = await Blog.find('b1')
+			for after in (model, dict(model), (1.0, 'b1')):
+				assert [b.id for b in await Blog.findAfter(after, limit=2)] == ['b0']
+
+	run(main())
+
+
+def test_iter_all_rejected_inside_transaction():
+	async def main():
+		async with database():
+			await _seed()
+			assert [b.id async for b in Blog.iter_all(orderBy='created_at', chunk_size=2)] == ['b0', 'b1', 'b2', 'b3', 'b4']
+			async with transaction():
+				with pytest.raises(RuntimeError):
+					async for blog in Blog.iter_all():
+						pass
+
+	run(main())
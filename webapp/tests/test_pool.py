@@ -0,0 +1,50 @@
+import asyncio
+
+import aiomysql
+
+from webapp import async_orm
+from webapp.benchmark import memory_db
+from webapp.tests.conftest import run
+
+
+def test_resize_changes_aiomysql_maxsize():
+	async def main():
+		pool = aiomysql.Pool(minsize=0, maxsize=5, echo=False, pool_recycle=-1, loop=asyncio.get_running_loop())
+		assert async_orm._resizable(pool)
+		async_orm._resize(pool, 8)
+		assert pool.maxsize == 8
+		async_orm._resize(pool, 3)
+		assert pool.maxsize == 3
+		await asyncio.sleep(0)
+	run(main())
+
+
+def test_tuner_grows_and_shrinks_pool():
+	async def main():
+		pool = memory_db.Pool(memory_db.Database(), minsize=1, maxsize=2)
+		tuner = async_orm._PoolTuner()
+		tuner.configure(min=1, max=3)
+		stats = async_orm._stats_of('test_tuner')
+		stats.observe_wait(1.0)
+		tuner.adjust('test_tuner', pool)
+		assert pool.maxsize == 3
+		# 空闲且没有等待时收缩
+		conns = [await pool.acquire() for _ in range(3)]
+		for conn in conns:
+			pool.release(conn)
+		tuner.adjust('test_tuner', pool)
+		assert pool.maxsize == 2
+		assert pool.size == pool.freesize == 2
+		await asyncio.sleep(0)
+	run(main())
+
+
+def test_tuner_leaves_pools_alone_on_untested_aiomysql(monkeypatch):
+	async def main():
+		monkeypatch.setattr(aiomysql, '__version__', '9.0.0')
+		pool = memory_db.Pool(memory_db.Database(), minsize=1, maxsize=2)
+		tuner = async_orm._PoolTuner()
+		async_orm._stats_of('test_untested').observe_wait(1.0)
+		tuner.adjust('test_untested', pool)
+		assert pool.maxsize == 2
+	run(main())
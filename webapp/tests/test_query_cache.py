@@ -0,0 +1,67 @@
+import pytest
+
+from webapp import server
+from webapp.query_cache import QueryCache, MemoryBackend
+from webapp.tests.conftest import run
+
+
+def test_version_bump_hides_cached_rows():
+	async def main():
+		cache = QueryCache(MemoryBackend())
+		key, rs = await cache.get('t', 'select 1', (), None)
+		assert rs is None
+		await cache.set(key, [dict(a=1)], None)
+		assert (await cache.get('t', 'select 1', (), None))[1] == [dict(a=1)]
+		await cache.invalidate('t')
+		assert (await cache.get('t', 'select 1', (), None))[1] is None
+	run(main())
+
+
+def test_in_process_cache_is_disabled_with_workers():
+	cache = server.configs.query_cache
+	saved = dict(cache)
+	try:
+		cache.enabled, cache.backend = True, None
+		server.check_query_cache(1)
+		assert cache.enabled
+		server.check_query_cache(4)
+		assert not cache.enabled
+		cache.enabled, cache.backend = True, MemoryBackend()
+		server.check_query_cache(4)
+		assert cache.enabled
+	finally:
+		cache.clear()
+		cache.update(saved)
+
+
+def test_user_list_is_cached_but_auth_reads_are_not():
+	from webapp import async_orm
+	from webapp.models import User
+	from webapp.query_cache import query_cache
+	from webapp.tests.conftest import database
+
+	async def main():
+		async with database():
+			await User(name='a', email='a@x.com', password='hash', image='').save()
+			hits = query_cache.hits
+			assert len(await User.findAll(orderBy='created_at desc')) == 1
+			assert len(await User.findAll(orderBy='created_at desc')) == 1
+			assert query_cache.hits == hits + 1
+			with async_orm.read_primary():
+				await User.findAll('email=?', ['a@x.com'])
+				await User.findAll('email=?', ['a@x.com'])
+			assert query_cache.hits == hits + 1
+			await User(name='b', email='b@x.com', password='hash', image='').save()
+			assert len(await User.findAll(orderBy='created_at desc')) == 2
+	run(main())
+
+
+def test_redis_url_needs_the_redis_package():
+	from webapp import query_cache
+	try:
+		import redis  # noqa: F401
+	except ImportError:
+		with pytest.raises(RuntimeError):
+			query_cache.setup(backend='redis://localhost:6379/0')
+	else:
+		pytest.skip('redis is installed')
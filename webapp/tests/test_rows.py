@@ -0,0 +1,19 @@
+import pytest
+
+from webapp.models import Blog
+
+
+def test_row_mapping_access_only_sees_columns_and_relations():
+	row = Blog.__row__(id='b1', name='hello')
+	assert row.get('name') == 'hello'
+	assert row['id'] == 'b1'
+	# 方法名不是列
+	for key in ('get', 'items', 'keys', 'to_model', '__model__'):
+		assert row.get(key) is None
+		with pytest.raises(KeyError):
+			row[key]
+	# 未预取的关联返回默认值，预取之后可以取到
+	assert row.get('user', 'missing') == 'missing'
+	row.user = 'u1'
+	assert row.get('user') == 'u1'
+	assert 'user' in row.keys()
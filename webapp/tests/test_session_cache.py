@@ -0,0 +1,60 @@
+from webapp.cookie.session_cache import SessionCache
+from webapp.models import User
+
+
+def _user(uid='u1', password='hash', admin=False):
+	return User(id=uid, name='n', email='e@x.com', image='', admin=admin, password=password)
+
+
+def test_get_returns_a_copy():
+	cache = SessionCache()
+	user = _user()
+	user.password = '******'
+	cache.put('cookie', user, '0.0', 2 ** 40)
+	first = cache.get('cookie')
+	first.name = 'changed'
+	second = cache.get('cookie')
+	assert second.name == 'n'
+	assert second is not first
+	assert isinstance(second, User)
+
+
+def test_invalidate_user_only_touches_that_user():
+	cache = SessionCache()
+	cache.put('a1', _user('a'), '0.0', 2 ** 40)
+	cache.put('a2', _user('a'), '0.0', 2 ** 40)
+	cache.put('b1', _user('b'), '0.0', 2 ** 40)
+	assert cache.invalidate_user('a', '0.0') == 0
+	assert cache.invalidate_user('a', '1.0') == 2
+	assert cache.get('a1') is None and cache.get('a2') is None
+	assert cache.get('b1') is not None
+	assert cache.invalidate_user('b') == 1
+
+
+def test_index_follows_lru_eviction():
+	cache = SessionCache(maxsize=2)
+	for i in range(5):
+		cache.put('c%d' % i, _user('u%d' % i), '0.0', 2 ** 40)
+	assert len(cache._by_user) <= 4
+	assert cache.invalidate_user('u0') == 0
+	assert cache.invalidate_user('u4') == 1
+
+
+def test_prefork_workers_shorten_session_cache_ttl():
+	from webapp import server
+	from webapp.cookie import cookie_manage, session_token
+	from webapp.cookie.session_cache import session_cache
+	cache = server.configs.session.cache
+	saved = dict(cache)
+	try:
+		server.check_session_cache(1)
+		assert cache.ttl == saved['ttl']
+		server.check_session_cache(4)
+		assert cache.ttl == cache.prefork_ttl
+		cookie_manage.setup(**cache)
+		assert session_cache._cache.ttl == cache.prefork_ttl
+		assert session_token.generations._cache.ttl == cache.prefork_ttl
+	finally:
+		cache.clear()
+		cache.update(saved)
+		cookie_manage.setup(**cache)
@@ -0,0 +1,145 @@
+import time
+import hashlib
+
+from webapp import async_orm
+from webapp.config.config import configs
+from webapp.cookie import cookie_manage, session_token
+from webapp.cookie.session_cache import session_cache
+from webapp.models import User
+from webapp.tests.conftest import run, database, app_client
+
+
+async def _new_user(admin=False):
+	user = User(name='n', email='%s@x.com' % time.monotonic_ns(), password='hash-1', admin=admin, image='')
+	await user.save()
+	return await User.find(user.id)
+
+
+def _reset():
+	session_cache.clear()
+	session_token.generations._cache.clear()
+
+
+def _legacy(user, max_age=3600):
+	saved = configs.session.format
+	configs.session.format = 'legacy'
+	try:
+		return cookie_manage.user2cookie(user, max_age)
+	finally:
+		configs.session.format = saved
+
+
+def test_token_round_trip_and_tampering():
+	user = User(id='u1', name='n', email='e@x.com', image='', admin=True, session_version=3)
+	token = session_token.issue(user, 60)
+	claims = session_token.parse(token)
+	assert claims['id'] == 'u1' and claims['admin'] is True
+	assert claims['gen'] == session_token.generation(3, True)
+	message, signature = token.rsplit('.', 1)
+	assert session_token.parse(message + '.' + signature[::-1]) is None
+	assert session_token.parse(token.replace('2.0.', '2.9.', 1)) is None
+	assert session_token.parse('2.garbage') is None
+	assert session_token.parse(session_token.issue(user, -1)) is None
+
+
+def test_rehash_keeps_sessions():
+	async def main():
+		_reset()
+		async with database():
+			user = await _new_user()
+			token, legacy = cookie_manage.user2cookie(user, 3600), _legacy(user)
+			assert (await cookie_manage.cookie2user(token)).id == user.id
+			assert (await cookie_manage.cookie2user(legacy)).id == user.id
+			# 登录时升级密码摘要
+			user.password = 'hash-2'
+			await user.update()
+			_reset()
+			assert (await cookie_manage.cookie2user(token)).id == user.id
+			assert (await cookie_manage.cookie2user(legacy)).id == user.id
+	run(main())
+
+
+def test_revoke_and_admin_change_revoke_sessions():
+	async def main():
+		_reset()
+		async with database():
+			user = await _new_user()
+			token, legacy = cookie_manage.user2cookie(user, 3600), _legacy(user)
+			assert await cookie_manage.cookie2user(token) is not None
+			assert await cookie_manage.cookie2user(legacy) is not None
+			assert await cookie_manage.revoke_sessions(user.id)
+			assert await cookie_manage.cookie2user(token) is None
+			assert await cookie_manage.cookie2user(legacy) is None
+			# 新签发的不受影响；admin变化同样使其失效
+			user = await User.find(user.id)
+			token = cookie_manage.user2cookie(user, 3600)
+			assert await cookie_manage.cookie2user(token) is not None
+			user.admin = True
+			await user.update()
+			assert await cookie_manage.cookie2user(token) is None
+	run(main())
+
+
+def test_password_signed_legacy_cookie_until_revoked():
+	async def main():
+		_reset()
+		async with database():
+			user = await _new_user()
+			expires = str(int(time.time() + 3600))
+			key = '{}-{}-{}-{}'.format(user.id, user.password, expires, configs.session.secret)
+			cookie = '-'.join([user.id, expires, hashlib.sha1(key.encode('utf-8')).hexdigest()])
+			assert (await cookie_manage.cookie2user(cookie)).id == user.id
+			await cookie_manage.revoke_sessions(user.id)
+			assert await cookie_manage.cookie2user(cookie) is None
+	run(main())
+
+
+def test_password_change_revokes_other_sessions():
+	async def main():
+		_reset()
+		async with app_client() as client:
+			resp = await client.post('/api/register', json=dict(email='pw@x.com', name='pw', password='secret1'))
+			assert resp.status == 200
+			old = resp.cookies[cookie_manage.COOKIE_NAME].value
+			assert await cookie_manage.cookie2user(old) is not None
+			resp = await client.post('/api/password', json=dict(old_password='wrong1', password='secret2'))
+			assert (await resp.json())['error'] == 'value:invalid'
+			resp = await client.post('/api/password', json=dict(old_password='secret1', password='secret2'))
+			assert resp.status == 200
+			new = resp.cookies[cookie_manage.COOKIE_NAME].value
+			assert await cookie_manage.cookie2user(old) is None
+			assert await cookie_manage.cookie2user(new) is not None
+			client.session.cookie_jar.clear()
+			resp = await client.post('/api/password', json=dict(old_password='secret2', password='secret3'))
+			assert (await resp.json())['error'] == 'permission:forbidden'
+	run(main())
+
+
+def test_loaded_generation_never_overwrites_a_newer_one():
+	_reset()
+	generations = session_token.generations
+	generations.set('u9', 2, False)
+	# 加载开始时读到的是旧行，写入的监听器在这期间已经放入了新的代数
+	assert generations.offer('u9', 1, False) == session_token.generation(2, False)
+	assert generations.offer('u9', 2, True) == session_token.generation(2, False)
+	assert generations.offer('u9', 3, False) == session_token.generation(3, False)
+	assert generations.get('u9') == session_token.generation(3, False)
+
+
+def test_cached_session_of_an_older_generation_is_dropped():
+	_reset()
+	user = User(id='u8', name='n', email='e@x.com', image='', admin=False, password='******')
+	session_cache.put('cookie-u8', user, session_token.generation(0, False), 2 ** 40)
+	assert session_cache.get('cookie-u8') is not None
+	session_token.generations.set('u8', 1, False)
+	assert session_cache.get('cookie-u8') is None
+
+
+def test_auth_reads_go_to_the_primary(monkeypatch):
+	router = async_orm._router
+	monkeypatch.setattr(router, 'replicas', ['replica'])
+	monkeypatch.setattr(router, 'pick', lambda: 'replica')
+	assert async_orm._read_replica() == 'replica'
+	with async_orm.read_primary():
+		assert async_orm._read_replica() is None
+	assert async_orm._read_replica() == 'replica'
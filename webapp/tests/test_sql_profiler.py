@@ -0,0 +1,15 @@
+import logging
+
+from webapp import sql_profiler
+
+
+def test_warnings_go_to_the_sql_logger(caplog):
+	with caplog.at_level(logging.WARNING, logger='webapp.sql'):
+		profile, token = sql_profiler.start('GET', '/x')
+		for _ in range(3):
+			sql_profiler.observe('select 1 where id=?', ['a'], 10.0, 1)
+		sql_profiler.finish(profile, token)
+	records = [r for r in caplog.records if r.name == 'webapp.sql']
+	assert len(records) == 4
+	assert records[0].args == (10000.0, 'select 1 where id=?')
+	assert 'N+1' in records[-1].getMessage()
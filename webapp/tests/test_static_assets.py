@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+from webapp import static_assets
+from webapp.tests.conftest import run
+
+
+async def _client(root, **kw):
+	app = web.Application()
+	files = static_assets.setup(app, path=root, **kw)
+	client = TestClient(TestServer(app))
+	await client.start_server()
+	return client, files
+
+
+def test_large_assets_keep_the_manifest_etag():
+	async def main():
+		with tempfile.TemporaryDirectory() as root:
+			with open(os.path.join(root, 'big.js'), 'w') as f:
+				f.write('var x = 1;\n' * 2000)
+			client, files = await _client(root, build_dir=os.path.join(root, '.build'), hot=dict(max_file_size=1024))
+			try:
+				asset = files.manifest.assets['big.js']
+				for encoding in (None, 'gzip'):
+					headers = {'Accept-Encoding': encoding or 'identity'}
+					resp = await client.get('/static/big.js', headers=headers)
+					assert resp.status == 200
+					assert resp.headers['ETag'] == asset.etag(encoding)
+					assert len(await resp.read()) > 0
+					headers['If-None-Match'] = asset.etag(encoding)
+					resp = await client.get('/static/big.js', headers=headers)
+					assert resp.status == 304
+					assert resp.headers['ETag'] == asset.etag(encoding)
+			finally:
+				await client.close()
+	run(main())
+
+
+def test_build_dir_is_private_and_foreign_files_are_rebuilt():
+	with tempfile.TemporaryDirectory() as root:
+		with open(os.path.join(root, 'app.css'), 'w') as f:
+			f.write('body { color: red; }\n' * 100)
+		shared = os.path.join(root, 'shared')
+		os.mkdir(shared)
+		os.chmod(shared, 0o777)
+		manifest = static_assets.Manifest(root, build_dir=shared).build()
+		assert manifest.build_dir != shared
+		assert os.stat(manifest.build_dir).st_mode & 0o077 == 0
+		shutil.rmtree(manifest.build_dir)
+		build = os.path.join(root, 'build')
+		manifest = static_assets.Manifest(root, build_dir=build).build()
+		asset = manifest.assets['app.css']
+		target, _ = asset.variants['gzip']
+		# 别人能写的文件不复用
+		with open(target, 'wb') as f:
+			f.write(b'planted')
+		os.chmod(target, 0o666)
+		asset = static_assets.Manifest(root, build_dir=build).build().assets['app.css']
+		with open(asset.variants['gzip'][0], 'rb') as f:
+			assert f.read() != b'planted'
@@ -0,0 +1,65 @@
+import pytest
+
+from webapp import async_orm
+from webapp.async_orm import Model, StringField, IntegerField, transaction, in_transaction
+from webapp.tests.conftest import run, database
+
+
+class Account(Model):
+	__table_name__ = 'test_accounts'
+	__cache__ = dict(ttl=30)
+
+	id = StringField(primary_key=True, column_type='varchar(50)')
+	balance = IntegerField()
+
+
+async def _ids():
+	return sorted(a.id for a in await Account.findAll())
+
+
+def test_nested_rollback_keeps_outer_writes():
+	async def main():
+		async with database() as db:
+			db.create_tables((Account,))
+			async with transaction():
+				await Account(id='a', balance=1).save()
+				with pytest.raises(ValueError):
+					async with transaction():
+						await Account(id='b', balance=1).save()
+						assert await _ids() == ['a', 'b']
+						raise ValueError()
+				assert in_transaction()
+				assert await _ids() == ['a']
+			assert not in_transaction()
+			assert await _ids() == ['a']
+	run(main())
+
+
+def test_outer_rollback_discards_released_savepoints():
+	async def main():
+		async with database() as db:
+			db.create_tables((Account,))
+			with pytest.raises(ValueError):
+				async with transaction():
+					await Account(id='a', balance=1).save()
+					async with transaction():
+						await Account(id='b', balance=1).save()
+					raise ValueError()
+			assert await _ids() == []
+	run(main())
+
+
+def test_query_cache_invalidated_by_committed_write():
+	async def main():
+		async with database() as db:
+			db.create_tables((Account,))
+			assert await _ids() == []  # 缓存空结果
+			async with transaction():
+				await Account(id='a', balance=1).save()
+			assert await _ids() == ['a']
+			account = await Account.find('a')
+			account.balance = 5
+			await account.update()
+			assert (await Account.findAll())[0].balance == 5
+			assert async_orm.query_cache.invalidations > 0
+	run(main())
@@ -1,13 +1,13 @@
 from datetime import datetime
 from aiohttp import web
-import logging, os, json, time, asyncio
-from jinja2 import Environment, FileSystemLoader
-from webapp import core_web, async_orm
+import logging, os, time, asyncio, inspect, email.utils
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from webapp import core_web, async_orm, json_codec, query_cache, metrics, sql_profiler, passwords, static_assets, compression, logs, admission
+from webapp.cache import LRUCache
 from webapp.config.config import configs
+from webapp.cookie import cookie_manage
 from webapp.cookie.cookie_manage import COOKIE_NAME, cookie2user
 
-logging.basicConfig(level=logging.INFO)
-
 __author__ = 'Adam Lee'
 
 '''
@@ -38,51 +38,144 @@ def init_jinja2(app, **kw):
 		block_end_string=kw.get('block_end_string', '%}'),
 		variable_start_string=kw.get('variable_start_string', '{{'),
 		variable_end_string=kw.get('variable_end_string', '}}'),
-		auto_reload=kw.get('auto_reload', True)
+		auto_reload=kw.get('auto_reload', configs.debug)
 	)
+	bytecode_cache = kw.get('bytecode_cache', configs.template.bytecode_cache)
+	if bytecode_cache:
+		os.makedirs(bytecode_cache, exist_ok=True)
+		options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
+		logging.info('set jinja2 bytecode cache: {}'.format(bytecode_cache))
 	path = kw.get('path', None)
 	if path is None:
 		path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 	logging.info('set jinja2 template path: {}'.format(path))
 	env = Environment(loader=FileSystemLoader(path), **options)
+	env.globals['static_url'] = static_assets.url
 	filters = kw.get('filters', None)
 	if filters is not None:
 		for name, f in filters.items():
 			env.filters[name] = f
+	if kw.get('precompile', configs.template.precompile):
+		# 启动时编译全部模板，避免第一次请求时才编译
+		names = env.list_templates()
+		for name in names:
+			env.get_template(name)
+		logging.info('precompiled {} templates'.format(len(names)))
 	app['__templating__'] = env
+	page_cache = configs.template.page_cache
+	app['__page_cache__'] = LRUCache(maxsize=page_cache.maxsize, ttl=page_cache.ttl) if page_cache.enabled else None
 
 
+# 每个请求一个id(沿用上游的X-Request-Id)，请求结束后写一条访问日志
 async def logger_factory(app, handler):
 	async def logger(request):
-		logging.info('Request: {} {}'.format(request.method, request.path))
-		# await asyncio.sleep(0.3)
-		return (await handler(request))
+		if core_web.is_static(request):
+			return (await handler(request))
+		rid = logs.new_request_id(request.headers.get('X-Request-Id'))
+		token = logs.request_id.set(rid)
+		start = time.perf_counter()
+		status = 500
+		try:
+			resp = await handler(request)
+			status = resp.status
+			if not resp.prepared:
+				resp.headers['X-Request-Id'] = rid
+			return resp
+		except web.HTTPException as e:
+			status = e.status
+			raise
+		finally:
+			duration = time.perf_counter() - start
+			logs.access_log.info('%s %s %s %.1fms', request.method, request.path, status, duration * 1000,
+								 extra=dict(method=request.method, path=request.path, status=status, duration=round(duration, 4)))
+			logs.request_id.reset(token)
 	return logger
 
 
+# 按请求统计SQL，结果放在X-SQL-Profile响应头以及/debug/sql接口
+async def profiler_factory(app, handler):
+	async def profile_sql(request):
+		if core_web.is_static(request):
+			return await handler(request)
+		profile, token = sql_profiler.start(request.method, request.path)
+		try:
+			resp = await handler(request)
+		finally:
+			sql_profiler.finish(profile, token)
+		if isinstance(resp, web.StreamResponse) and not resp.prepared:
+			resp.headers['X-SQL-Profile'] = profile.header()
+		return resp
+	return profile_sql
+
+
+# 调试接口只对admin开放：/debug/queries里是真实的查询参数(例如登录时的邮箱)
+def admin_only(handler):
+	async def check(request):
+		user = getattr(request, '__user__', None)
+		if user is None or not user.admin:
+			raise web.HTTPForbidden()
+		return (await handler(request))
+	return check
+
+
+async def sql_profile_handler(request):
+	return web.Response(body=json_codec.dumps(list(sql_profiler.recent)), content_type='application/json')
+
+
+# 采集到的查询，保存下来交给 python -m webapp.schema_tool advise
+async def captured_queries_handler(request):
+	return web.Response(body=json_codec.dumps(async_orm.captured_queries()), content_type='application/json')
+
+
+# 准入控制：按路由限制并发，队列满、等待超时或连接池拥塞时返回503，登录注册按客户端限流
+async def admission_factory(app, handler):
+	async def admit(request):
+		if admission.controller is None:
+			return (await handler(request))
+		return (await admission.controller(request, handler))
+	return admit
+
+
+# 按Accept-Encoding压缩响应；静态文件已经预压缩，@no_compress的路由不压缩
+async def compression_factory(app, handler):
+	async def compress(request):
+		resp = await handler(request)
+		if compression.compressor is None or core_web.is_static(request) or not core_web.wants_compression(request):
+			return resp
+		return await compression.compressor(request, resp)
+	return compress
+
+
+# 统一解析请求体，handler的参数绑定直接复用request.__data__
 async def data_factory(app, handler):
 	async def parse_data(request):
 		if request.method == 'POST':
-			if request.content_type.startswith('application/json'):
-				request.__data__ = await request.json()
-				logging.info('request json: {}'.format(str(request.__data__)))
-			elif request.content_type.startswith('application/x-www-form-urlencoded'):
-				request.__data__ = await request.post()
-				logging.info('request form: {}'.format(str(request.__data__)))
+			await core_web.parse_body(request)
+			logging.debug('request body: %s (%s bytes)', request.content_type, request.content_length)
 		return (await handler(request))
 	return parse_data
 
 
+# 每个请求一个DataLoader作用域，合并同一请求内并发的find(pk)
+async def dataloader_factory(app, handler):
+	async def batch_loads(request):
+		with async_orm.loader_scope():
+			return (await handler(request))
+	return batch_loads
+
+
 # 自动登录验证
 async def auth_factory(app, hander):
 	async def auth(request):
-		logging.info('check user: {} {}'.format(request.method, request.path))
+		if core_web.is_static(request):
+			return (await hander(request))
+		logs.auth_log.debug('check user: %s %s', request.method, request.path)
 		request.__user__ = None
 		cookie_str = request.cookies.get(COOKIE_NAME)
 		if cookie_str:
 			user = await cookie2user(cookie_str)
 			if user:
-				logging.info('set current user: {}'.format(user.email))
+				logs.auth_log.debug('set current user: %s', user.id)
 				request.__user__ = user
 		if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
 			return web.HTTPFound('/login')
@@ -90,10 +183,95 @@ async def auth_factory(app, hander):
 	return auth
 
 
+# 大列表用分块传输编码逐块写出，避免一次性生成整个响应体
+async def stream_json(request, data, chunk_size, headers=None):
+	resp = web.StreamResponse(headers=headers)
+	resp.content_type = 'application/json'
+	resp.charset = 'utf-8'
+	resp.enable_chunked_encoding()
+	if compression.compressor is not None and core_web.wants_compression(request):
+		compression.compressor.enable_stream(request, resp)
+	await resp.prepare(request)
+	for chunk in json_codec.iter_encode(data, chunk_size):
+		await resp.write(chunk)
+	await resp.write_eof()
+	return resp
+
+
+# 页面缓存的key：路由 + vary参数 + 当前用户(匿名为None) + 数据版本
+def page_cache_key(request, options, version=None):
+	user = request.__user__
+	return (request.path, tuple(request.query.get(name) for name in options['vary']), user.id if user else None, version)
+
+
+def html_response(body):
+	resp = web.Response(body=body)
+	resp.content_type = 'text/html;charset=utf-8'
+	return resp
+
+
+# @freshness声明了版本戳的handler：(ETag, Last-Modified)，ETag还区分URL和当前用户
+async def freshness_validator(request):
+	key_func = getattr(request.match_info.handler, 'freshness', None)
+	if key_func is None or request.method not in ('GET', 'HEAD'):
+		return None
+	version = key_func(request)
+	if inspect.isawaitable(version):
+		version = await version
+	if version is None:
+		return None
+	last_modified = None
+	if isinstance(version, tuple):
+		version, last_modified = version
+	elif isinstance(version, (int, float)):
+		last_modified = version
+	user = request.__user__
+	etag = core_web.make_etag('{}|{}|{}'.format(request.path_qs, user.id if user else '', version))
+	return etag, last_modified
+
+
+def validator_headers(validator):
+	etag, last_modified = validator
+	headers = {'ETag': etag, 'Cache-Control': configs.conditional.cache_control}
+	if last_modified is not None:
+		headers['Last-Modified'] = email.utils.formatdate(last_modified, usegmt=True)
+	return headers
+
+
+# 给200的GET响应加上ETag(没有版本戳时用响应体的摘要)，客户端的缓存仍然有效时改为304
+def conditional(request, resp, validator):
+	if request.method not in ('GET', 'HEAD') or not isinstance(resp, web.Response) or resp.status != 200 or 'ETag' in resp.headers:
+		return resp
+	if validator is None:
+		if not configs.conditional.body_etag or not isinstance(resp.body, bytes):
+			return resp
+		validator = (core_web.make_etag(resp.body), None)
+	headers = validator_headers(validator)
+	if core_web.is_fresh(request, *validator):
+		return web.Response(status=304, headers=headers)
+	for name, value in headers.items():
+		resp.headers.setdefault(name, value)
+	return resp
+
+
 # 返回数据
 async def response_factory(app, handler):
 	async def response(request):
-		logging.info('Response handler...')
+		logging.debug('Response handler...')
+		validator = await freshness_validator(request)
+		if validator is not None and core_web.is_fresh(request, *validator):
+			return web.Response(status=304, headers=validator_headers(validator))
+		return conditional(request, await render(request, validator), validator)
+
+	async def render(request, validator):
+		page_key = None
+		page_options = getattr(request.match_info.handler, 'page_cache', None)
+		page_cache = app['__page_cache__']
+		if page_options is not None and page_cache is not None and request.method == 'GET':
+			page_key = page_cache_key(request, page_options, validator and validator[0])
+			body = page_cache.get(page_key)
+			if body is not None:
+				return html_response(body)
 		hr = await handler(request)
 		if isinstance(hr, web.StreamResponse):
 			return hr
@@ -110,21 +288,25 @@ async def response_factory(app, handler):
 		if isinstance(hr, dict):
 			template = hr.get('__template__')
 			if template is None:
-				resp = web.Response(body=json.dumps(hr, ensure_ascii=False, default=lambda ob: ob.__dict__).encode('utf-8'))
+				chunk_size = configs.json.stream_chunk_size
+				if any(json_codec.is_large(v, chunk_size) for v in hr.values()):
+					return await stream_json(request, hr, chunk_size, validator and validator_headers(validator))
+				resp = web.Response(body=json_codec.dumps(hr))
 				resp.content_type = 'application/json;charset=utf-8'
 				return resp
 			else:
 				hr['__user__'] = request.__user__
-				resp = web.Response(body=app['__templating__'].get_template(template).render(**hr).encode('utf-8'))
-				resp.content_type = 'text/html;charset=utf-8'
-				return resp
+				body = app['__templating__'].get_template(template).render(**hr).encode('utf-8')
+				if page_key is not None:
+					page_cache.set(page_key, body, ttl=page_options['ttl'])
+				return html_response(body)
 
 		if isinstance(hr, int) and hr >= 100 and hr <= 600:
-			return web.Response(hr)
+			return web.Response(status=hr)
 		if isinstance(hr, tuple) and len(hr) == 2:
 			code, msg = hr
 			if isinstance(code, int) and code >=100 and code <= 600:
-				return web.Response(code, str(msg))
+				return web.Response(status=code, text=str(msg))
 		# default:
 		resp = web.Response(body=str(hr).encode('utf-8'))
 		resp.content_type = 'text/plain;charset=utf-8'
@@ -132,6 +314,11 @@ async def response_factory(app, handler):
 	return response
 
 
+# Prometheus格式的运行指标
+async def metrics_handler(request):
+	return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+
 def datetime_filter(tm):
 	delta = int(time.time() - tm)
 	if delta < 60:
@@ -146,18 +333,39 @@ def datetime_filter(tm):
 	return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
-async def init(loop):
+# 创建应用：连接池、各模块的配置、中间件和路由；启动服务和benchmark都使用它
+async def create_app(loop=None):
+	logs.setup(**configs.logging)
+	loop = loop or asyncio.get_event_loop()
 	await async_orm.create_pool(loop=loop, **configs.db)
-	app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
+	query_cache.setup(**configs.query_cache)
+	core_web.max_body_size = configs.server.max_body_size
+	sql_profiler.setup(**configs.profiler.options)
+	json_codec.use(configs.json.backend)
+	passwords.setup(**configs.passwords)
+	cookie_manage.setup(**configs.session.cache)
+	compression.setup(**configs.compression)
+	admission.setup(**configs.admission)
+	middlewares = [logger_factory, admission_factory, compression_factory, dataloader_factory, auth_factory, data_factory, response_factory]
+	profiling = configs.profiler.enabled if configs.profiler.enabled is not None else configs.debug
+	if profiling:
+		middlewares.insert(1, profiler_factory)
+		async_orm.capture_queries()
+	app = web.Application(client_max_size=configs.server.max_body_size, middlewares=middlewares)
 	init_jinja2(app, filters=dict(datetime=datetime_filter))
-	core_web.add_routes(app, 'handlers')
-	core_web.add_static(app)
-	srv = await loop.create_server(app.make_handler(), 'localhost', 9000)
-	logging.info('server started at http://localhost:9000...')
-	return srv
-
-async_loop = asyncio.get_event_loop()
-async_loop.run_until_complete(init(async_loop))
-async_loop.run_forever()
+	core_web.add_routes(app, 'webapp.handlers')
+	static = dict(configs.static)
+	if static['watch'] is None:
+		static['watch'] = configs.debug
+	core_web.add_static(app, **static)
+	if configs.metrics.enabled:
+		app.router.add_route('GET', configs.metrics.path, metrics_handler)
+	if profiling:
+		app.router.add_route('GET', '/debug/sql', admin_only(sql_profile_handler))
+		app.router.add_route('GET', '/debug/queries', admin_only(captured_queries_handler))
+	return app
 
 
+if __name__ == '__main__':
+	from webapp import server
+	server.main()